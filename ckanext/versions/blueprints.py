@@ -1,7 +1,10 @@
+import hmac
+
 from ckan import model
 from ckan.plugins import toolkit
-from flask import Blueprint
+from flask import Blueprint, Response, jsonify
 
+from ckanext.versions.lib import metrics, profiling, queries
 from ckanext.versions.logic import action
 
 blueprint = Blueprint(
@@ -10,6 +13,27 @@ blueprint = Blueprint(
 )
 
 
+@blueprint.before_app_request
+def start_query_tracking():
+    """Count the SQL statements run by the actions and helpers of the
+    extension in each request, when `ckanext.versions.queries.debug` is set.
+    """
+    if toolkit.asbool(
+            toolkit.config.get('ckanext.versions.queries.debug', False)):
+        queries.start_request()
+
+
+@blueprint.teardown_app_request
+def finish_query_tracking(exception=None):
+    if queries.in_request():
+        queries.finish_request(
+            toolkit.request.path,
+            threshold=toolkit.asint(toolkit.config.get(
+                'ckanext.versions.queries.threshold', 50)),
+            repeat_threshold=toolkit.asint(toolkit.config.get(
+                'ckanext.versions.queries.repeat_threshold', 10)))
+
+
 def version_download(id, resource_id, version_id):
     """Download resource blueprint supporting version id.
 
@@ -31,6 +55,10 @@ def version_download(id, resource_id, version_id):
     except toolkit.ObjectNotFound:
         return toolkit.abort(404, toolkit._(u'Version not found'))
 
+    return _redirect_to_download(id, resource_id, activity_id)
+
+
+def _redirect_to_download(id, resource_id, activity_id):
     # Preserve any existing URL params
     params = {k: v for k, v in toolkit.request.params.items() if k != "activity_id"}
 
@@ -47,5 +75,152 @@ def version_download(id, resource_id, version_id):
 
 blueprint.add_url_rule(
     u'/dataset/<id>/resource/<resource_id>/version/<version_id>/download',
-    view_func=version_download
+    view_func=metrics.instrument('view', 'version_download', version_download)
+)
+
+
+def version_at_download(id, resource_id, timestamp):
+    """Download the version of a resource that was current at a timestamp.
+
+    Redirects like `version_download`, to the version returned by the
+    `resource_version_at` action, so data can be cited by date.
+    """
+    context = {
+        'model': model,
+        'user': toolkit.c.user
+    }
+
+    try:
+        version = action.resource_version_at(
+            context, {'resource_id': resource_id, 'timestamp': timestamp}
+        )
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._(u'Resource not found'))
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, str(e.error_dict))
+    if version is None:
+        return toolkit.abort(404, toolkit._(u'Version not found'))
+
+    return _redirect_to_download(id, resource_id, version['activity_id'])
+
+
+blueprint.add_url_rule(
+    u'/dataset/<id>/resource/<resource_id>/at/<timestamp>/download',
+    view_func=metrics.instrument(
+        'view', 'version_at_download', version_at_download)
+)
+
+
+def version_feed():
+    """List versions created or edited across the site as JSON.
+
+    Accepts the same query parameters as the `version_feed` action. The
+    response includes a `next` URL that returns the versions created or
+    edited after the ones listed, which mirrors can poll.
+    """
+    context = {
+        'model': model,
+        'user': toolkit.c.user
+    }
+    data_dict = {
+        k: v for k, v in toolkit.request.args.items()
+        if k in ('cursor', 'since', 'organization', 'package_id', 'limit')
+    }
+
+    try:
+        result = action.version_feed(context, data_dict)
+    except toolkit.ObjectNotFound as e:
+        return toolkit.abort(404, str(e))
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, str(e.error_dict))
+
+    params = dict(data_dict)
+    if result['cursor']:
+        params.pop('since', None)
+        params['cursor'] = result['cursor']
+    result['next'] = toolkit.url_for(
+        'versions.version_feed', _external=True, **params)
+    return jsonify(result)
+
+
+blueprint.add_url_rule(
+    u'/versions/feed',
+    view_func=metrics.instrument('view', 'version_feed', version_feed)
+)
+
+
+def version_metrics():
+    """Metrics of the actions, views and template helpers of the extension
+    in the Prometheus text format.
+
+    Available to sysadmins, or to scrapers sending the token set in
+    `ckanext.versions.metrics.token` as a bearer token.
+    """
+    if not metrics.enabled():
+        return toolkit.abort(404, toolkit._(u'Metrics are not enabled'))
+
+    token = toolkit.config.get('ckanext.versions.metrics.token')
+    authorization = toolkit.request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(
+            authorization, 'Bearer {}'.format(token)):
+        context = {
+            'model': model,
+            'user': toolkit.c.user
+        }
+        try:
+            toolkit.check_access('version_metrics', context, {})
+        except toolkit.NotAuthorized:
+            return toolkit.abort(403, toolkit._(u'Not authorized'))
+
+    return Response(metrics.render(metrics.get_metrics().collect()),
+                    content_type=metrics.CONTENT_TYPE)
+
+
+blueprint.add_url_rule(
+    u'/versions/metrics',
+    view_func=version_metrics
+)
+
+
+def version_profile():
+    """Profiles of the actions and resource view hooks of the extension, as
+    text, when `ckanext.versions.profiling.enabled` is set.
+
+    Accepts `name` (repeatable) to show some functions only, `sort`
+    (`cumulative`, `tottime` or `calls`) and `limit`. Available to sysadmins,
+    or with the token set in `ckanext.versions.profiling.token` as a bearer
+    token.
+    """
+    if not profiling.enabled():
+        return toolkit.abort(404, toolkit._(u'Profiling is not enabled'))
+
+    token = toolkit.config.get('ckanext.versions.profiling.token')
+    authorization = toolkit.request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(
+            authorization, 'Bearer {}'.format(token)):
+        context = {
+            'model': model,
+            'user': toolkit.c.user
+        }
+        try:
+            toolkit.check_access('version_profile', context, {})
+        except toolkit.NotAuthorized:
+            return toolkit.abort(403, toolkit._(u'Not authorized'))
+
+    sort = toolkit.request.args.get('sort', 'cumulative')
+    if sort not in profiling.SORT_KEYS:
+        return toolkit.abort(400, toolkit._(u'Invalid sort'))
+    try:
+        limit = toolkit.asint(toolkit.request.args.get('limit', 20))
+    except ValueError:
+        return toolkit.abort(400, toolkit._(u'Invalid limit'))
+
+    report = profiling.get_profiler().report(
+        toolkit.request.args.getlist('name'), sort=sort, limit=limit)
+    return Response(report, content_type='text/plain; charset=utf-8')
+
+
+blueprint.add_url_rule(
+    u'/versions/profile',
+    view_func=version_profile
 )
@@ -1,8 +1,27 @@
 # encoding: utf-8
 
+import csv
+import functools
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
 import click
+from ckan.plugins import toolkit
+
+from ckanext.versions.lib import backfill as backfill_lib
+from ckanext.versions.lib import report as report_lib
+from ckanext.versions.lib import transfer
+from ckanext.versions.lib import verify as verify_lib
+from ckanext.versions.lib.parallel import imap_batches
+from ckanext.versions.logic.action import clear_version_cache
+from ckanext.versions.model import create_tables, tables_exist, update_tables
 
-from ckanext.versions.model import create_tables, tables_exist
+
+def _get_site_user_context():
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'user': site_user['name'], 'ignore_auth': True}
 
 
 @click.group()
@@ -17,7 +36,11 @@ def versions():
 def initdb(ctx):
     """Creates the necessary tables in the database.
     """
+    # Versions cached on this host may come from a previous database
+    clear_version_cache()
     if tables_exist():
+        for name in update_tables():
+            click.secho('Created {}'.format(name), fg="green")
         click.secho('Dataset versions tables already exist', fg="green")
         ctx.exit(0)
 
@@ -30,6 +53,8 @@ def initdb(ctx):
 def cleandb(ctx):
     """Creates the necessary tables in the database.
     """
+    # Versions cached on this host may come from a previous database
+    clear_version_cache()
     if tables_exist():
         click.secho('Dataset versions tables already exist', fg="green")
         ctx.exit(0)
@@ -38,5 +63,265 @@ def cleandb(ctx):
     click.secho('Dataset versions tables created', fg="green")
 
 
+@versions.command()
+@click.option('--resource-id', default=None,
+              help='Only prune the versions of this resource.')
+@click.option('--keep-last', type=click.IntRange(min=0), default=None,
+              help='Number of most recent versions to keep per resource.')
+@click.option('--older-than-days', type=click.IntRange(min=0), default=None,
+              help='Only delete versions older than this many days.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+              show_default=True,
+              help='Number of versions deleted per transaction.')
+@click.pass_context
+def prune(ctx, resource_id, keep_last, older_than_days, batch_size):
+    """Deletes old versions following a retention policy.
+
+    Versions are deleted in small batches, each one committed on its own.
+    It is safe to interrupt the command and run it again later.
+    """
+    if keep_last is None and older_than_days is None:
+        click.secho('Provide --keep-last, --older-than-days or both', fg='red')
+        ctx.exit(1)
+
+    data_dict = {
+        'resource_id': resource_id,
+        'keep_last': keep_last,
+        'batch_size': batch_size,
+        'max_batches': 1,
+    }
+    if older_than_days is not None:
+        older_than = datetime.utcnow() - timedelta(days=older_than_days)
+        data_dict['older_than'] = older_than.isoformat()
+
+    context = _get_site_user_context()
+    deleted = 0
+    while True:
+        result = toolkit.get_action('version_prune')(
+            context.copy(), data_dict)
+        deleted += result['deleted']
+        if result['cursor'] is None:
+            break
+        click.echo('{} versions deleted, up to resource {}'.format(
+            deleted, result['cursor']['resource_id']))
+        data_dict['cursor'] = result['cursor']
+
+    click.secho('{} versions deleted'.format(deleted), fg='green')
+
+
+@versions.command()
+@click.option('--name', default='1.0', show_default=True,
+              help='Name of the versions to create.')
+@click.option('--notes', default=None, help='Notes of the versions to create.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=100,
+              show_default=True, help='Number of datasets per batch.')
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              show_default=True, help='Number of worker processes.')
+@click.option('--checkpoint', default='versions-backfill.json',
+              show_default=True, type=click.Path(dir_okay=False),
+              help='File where progress is saved after every batch.')
+@click.option('--restart', is_flag=True,
+              help='Ignore any saved progress and start from the beginning.')
+def backfill(name, notes, batch_size, workers, checkpoint, restart):
+    """Creates an initial version for resources without versions.
+
+    Each version points to the latest activity of its dataset. Progress is
+    saved to the checkpoint file, and running the command again resumes
+    after the last completed batch.
+    """
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    progress = backfill_lib.read_checkpoint(checkpoint)
+    if progress['last_package_id']:
+        click.echo('Resuming after dataset {}'.format(
+            progress['last_package_id']))
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    func = functools.partial(
+        backfill_lib.backfill_packages,
+        name=name, notes=notes, creator_user_id=site_user['id'])
+    batches = backfill_lib.iter_package_id_batches(
+        batch_size, after=progress['last_package_id'])
+
+    start = time.time()
+    resources = 0
+    for result in imap_batches(func, batches, workers):
+        resources += result['resources']
+        progress['last_package_id'] = result['last_package_id']
+        for key in ('packages', 'resources', 'versions'):
+            progress[key] += result[key]
+        backfill_lib.write_checkpoint(checkpoint, progress)
+
+        elapsed = time.time() - start
+        click.echo(
+            '{packages} datasets, {resources} resources, {versions} versions '
+            'created ({rate:.1f} resources/s)'.format(
+                rate=resources / elapsed if elapsed else 0, **progress))
+
+    clear_version_cache()
+    click.secho('Backfill finished: {} versions created for {} resources '
+                'in {:.1f}s'.format(progress['versions'],
+                                    progress['resources'],
+                                    time.time() - start), fg='green')
+
+
+@versions.command('backfill-changes')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+              show_default=True,
+              help='Number of versions read and committed at a time.')
+def backfill_changes(batch_size):
+    """Computes the changelog of versions that do not have it yet.
+
+    Versions created before the changelog was stored are compared with the
+    previous version of the same resource. Running the command again only
+    processes the versions still missing their changes.
+    """
+    start = time.time()
+    result = backfill_lib.backfill_changes(batch_size)
+    click.secho('{} versions checked, changes computed for {} in {:.1f}s'
+                .format(result['versions'], result['changes'],
+                        time.time() - start), fg='green')
+
+
+@versions.command('changes-report')
+@click.option('--organization', default=None,
+              help='Only report the datasets of this organization (name or '
+                   'id). Defaults to the whole site.')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='Compare each dataset as it was at this date instead of '
+                   'its last two versions.')
+@click.option('--until', type=click.DateTime(), default=None,
+              help='Compare against each dataset as it was at this date. '
+                   'Defaults to now. Requires --since.')
+@click.option('--format', 'output_format',
+              type=click.Choice(['csv', 'ndjson']), default='csv',
+              show_default=True, help='Output format.')
+@click.option('--output', default='-', type=click.File('w'),
+              help='File where the report is written. Defaults to stdout.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=100,
+              show_default=True, help='Number of datasets per batch.')
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              show_default=True, help='Number of worker processes.')
+@click.pass_context
+def changes_report(ctx, organization, since, until, output_format, output,
+                   batch_size, workers):
+    """Reports the changes of every dataset of a site or organization.
+
+    Each dataset is compared between its last two versions, or between the
+    dates given with --since and --until. Datasets without changes are left
+    out. The csv format has a row per change; the ndjson format has a JSON
+    object per dataset with the list of its changes.
+    """
+    if until is not None and since is None:
+        click.secho('--until requires --since', fg='red')
+        ctx.exit(1)
+
+    owner_org = None
+    if organization:
+        try:
+            owner_org = toolkit.get_action('organization_show')(
+                _get_site_user_context(), {'id': organization})['id']
+        except toolkit.ObjectNotFound:
+            click.secho('Organization not found: {}'.format(organization),
+                        fg='red')
+            ctx.exit(1)
+
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(report_lib.CSV_FIELDS)
+
+        def write(report):
+            writer.writerows(report_lib.csv_rows(report))
+    else:
+        def write(report):
+            output.write(json.dumps(report) + '\n')
+
+    func = functools.partial(
+        report_lib.report_packages, since=since, until=until)
+    batches = backfill_lib.iter_package_id_batches(
+        batch_size, owner_org=owner_org)
+
+    start = time.time()
+    changed = 0
+    for result in imap_batches(func, batches, workers):
+        for report in result:
+            write(report)
+        changed += len(result)
+        output.flush()
+
+    click.secho('{} datasets changed, report written in {:.1f}s'.format(
+        changed, time.time() - start), fg='green', err=True)
+
+
+@versions.command()
+@click.argument('path', default='-')
+@click.option('--gzip/--no-gzip', 'compress', default=None,
+              help='Compress the output. Defaults to on when PATH ends '
+                   'with .gz.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+              show_default=True, help='Number of rows fetched at a time.')
+def export(path, compress, batch_size):
+    """Exports all versions as newline delimited JSON.
+
+    Writes to PATH, or to stdout if PATH is - or not given.
+    """
+    with transfer.open_ndjson(path, 'w', compress) as f:
+        count = transfer.export_versions(f, batch_size)
+    click.secho('{} versions exported'.format(count), fg='green', err=True)
+
+
+@versions.command('import')
+@click.argument('path', default='-')
+@click.option('--gzip/--no-gzip', 'compress', default=None,
+              help='Decompress the input. Defaults to on when PATH ends '
+                   'with .gz.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+              show_default=True, help='Number of rows inserted at a time.')
+def import_(path, compress, batch_size):
+    """Imports versions exported with the export command.
+
+    Reads from PATH, or from stdin if PATH is - or not given. Versions
+    replace the existing version with the same id or, failing that, with
+    the same dataset, resource and name.
+    """
+    with transfer.open_ndjson(path, 'r', compress) as f:
+        count = transfer.import_versions(f, batch_size)
+    clear_version_cache()
+    click.secho('{} versions imported'.format(count), fg='green', err=True)
+
+
+@versions.command()
+@click.option('--output', default='-', type=click.File('w'),
+              help='File where broken versions are written as newline '
+                   'delimited JSON. Defaults to stdout.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+              show_default=True, help='Number of versions per batch.')
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              show_default=True, help='Number of worker processes.')
+@click.pass_context
+def verify(ctx, output, batch_size, workers):
+    """Checks that versions point to activities containing their resource.
+
+    Every broken version is reported as a JSON object on its own line, with
+    a problem field that is either activity_not_found or
+    resource_not_in_activity. Exits with status 1 if any version is broken.
+    """
+    checked = 0
+    broken = 0
+    start = time.time()
+    batches = verify_lib.iter_version_batches(batch_size)
+    for result in imap_batches(verify_lib.verify_versions, batches, workers):
+        checked += result['checked']
+        broken += len(result['broken'])
+        for row in result['broken']:
+            output.write(json.dumps(row) + '\n')
+
+    click.secho(
+        '{} versions checked in {:.1f}s, {} broken'.format(
+            checked, time.time() - start, broken),
+        fg='red' if broken else 'green', err=True)
+    ctx.exit(1 if broken else 0)
+
+
 def get_commands():
     return [versions]
@@ -0,0 +1,227 @@
+# encoding: utf-8
+
+'''
+Functions to create an initial version for resources of datasets that were
+created before the versions extension was enabled, and to compute the
+changes of versions created before the changelog was stored
+'''
+
+import json
+import logging
+import os
+from datetime import datetime
+
+from ckan import model
+from ckan.model.types import UuidType
+from sqlalchemy import and_, func, select
+
+from ckanext.versions.lib.changes import check_version_changes
+from ckanext.versions.lib.fingerprint import resource_fingerprint
+from ckanext.versions.model import Version, VersionChange
+
+log = logging.getLogger(__name__)
+
+
+def iter_package_id_batches(batch_size, after=None, owner_org=None):
+    '''
+    Yields lists of up to batch_size ids of active datasets, in id order,
+    starting after the dataset id given in after. If owner_org is given,
+    only the datasets of that organization are included.
+    '''
+    while True:
+        query = model.Session.query(model.Package.id).\
+            filter(model.Package.state == u'active')
+        if owner_org:
+            query = query.filter(model.Package.owner_org == owner_org)
+        if after:
+            query = query.filter(model.Package.id > after)
+        package_ids = [
+            row[0] for row in
+            query.order_by(model.Package.id).limit(batch_size)
+        ]
+        if not package_ids:
+            return
+        yield package_ids
+        after = package_ids[-1]
+
+
+def backfill_packages(package_ids, name, notes, creator_user_id):
+    '''
+    Creates a version named name for every active resource of the given
+    datasets that does not have any version yet.
+
+    As in resource_version_create, the version points to the latest activity
+    of the dataset, and resources missing from that activity are skipped.
+    Returns a dict with the number of resources checked and versions created.
+    '''
+    session = model.Session
+
+    latest = session.query(
+        model.Activity.object_id.label('object_id'),
+        func.max(model.Activity.timestamp).label('timestamp')
+    ).filter(model.Activity.object_id.in_(package_ids)).\
+        group_by(model.Activity.object_id).subquery()
+    activities = session.query(model.Activity).join(latest, and_(
+        model.Activity.object_id == latest.c.object_id,
+        model.Activity.timestamp == latest.c.timestamp
+    ))
+    resources_in_activity = {}
+    for activity in activities:
+        package = (activity.data or {}).get('package') or {}
+        resources_in_activity[activity.object_id] = (
+            activity.id,
+            {res['id']: resource_fingerprint(res)
+             for res in package.get('resources') or []}
+        )
+
+    resources = session.query(
+        model.Resource.id, model.Resource.package_id
+    ).filter(model.Resource.package_id.in_(package_ids)).\
+        filter(model.Resource.state == u'active').all()
+
+    versioned = {
+        row[0] for row in session.query(Version.resource_id).
+        filter(Version.resource_id.in_([res[0] for res in resources])).
+        distinct()
+    } if resources else set()
+
+    created = datetime.utcnow()
+    versions = []
+    for resource_id, package_id in resources:
+        if resource_id in versioned:
+            continue
+        activity_id, activity_resources = resources_in_activity.get(
+            package_id, (None, {}))
+        if resource_id not in activity_resources:
+            log.debug('Resource %s not found in the latest activity of '
+                      'dataset %s', resource_id, package_id)
+            continue
+        versions.append({
+            'id': UuidType.default(),
+            'package_id': package_id,
+            'resource_id': resource_id,
+            'activity_id': activity_id,
+            'name': name,
+            'notes': notes,
+            'creator_user_id': creator_user_id,
+            'created': created,
+            'fingerprint': activity_resources[resource_id],
+        })
+
+    if versions:
+        session.bulk_insert_mappings(Version, versions)
+        session.commit()
+    session.remove()
+
+    return {
+        'packages': len(package_ids),
+        'resources': len(resources),
+        'versions': len(versions),
+        'last_package_id': package_ids[-1],
+    }
+
+
+def backfill_changes(batch_size):
+    '''
+    Computes and stores the changes of every version that does not have them
+    yet, committing every batch_size versions. Returns a dict with the
+    number of versions checked and changes created.
+
+    Versions are read through a server-side cursor, resource by resource in
+    creation order, so the previous version of each one is the row read
+    just before it and each activity is loaded once for both versions that
+    compare against it.
+    '''
+    version = Version.__table__
+    version_change = VersionChange.__table__
+    query = select([
+        version.c.id, version.c.resource_id, version.c.activity_id,
+        version_change.c.version_id.label('change_id'),
+    ]).select_from(version.outerjoin(
+        version_change, version_change.c.version_id == version.c.id
+    )).order_by(version.c.resource_id, version.c.created, version.c.id)
+
+    checked = 0
+    created = 0
+    pending = []
+    previous = None
+    packages = {}
+    with model.meta.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                checked += 1
+                if previous is not None and \
+                        previous.resource_id != row.resource_id:
+                    previous = None
+                if row.change_id is None:
+                    change = _version_change(row, previous, packages)
+                    if change:
+                        pending.append(change)
+                # Only the package of this version is needed for the next one
+                packages = {
+                    key: value for key, value in packages.items()
+                    if key == row.activity_id}
+                previous = row
+            if pending:
+                model.Session.bulk_insert_mappings(VersionChange, pending)
+                model.Session.commit()
+                created += len(pending)
+                pending = []
+    model.Session.remove()
+
+    return {'versions': checked, 'changes': created}
+
+
+def _version_change(row, previous, packages):
+    changes = []
+    if previous is not None and previous.activity_id != row.activity_id:
+        old, new = [
+            _get_activity_package(activity_id, packages)
+            for activity_id in (previous.activity_id, row.activity_id)]
+        if not old or not new:
+            log.warning('Skipping version %s, its activity or the one of '
+                        'the previous version was not found', row.id)
+            return None
+        changes = check_version_changes(
+            old, new, previous.activity_id, row.resource_id)
+    return {
+        'version_id': row.id,
+        'previous_version_id': previous.id if previous is not None else None,
+        'changes': json.dumps(changes),
+        'created': datetime.utcnow(),
+    }
+
+
+def _get_activity_package(activity_id, packages):
+    if activity_id not in packages:
+        activity = model.Session.query(model.Activity).get(activity_id)
+        data = activity.data if activity else None
+        packages[activity_id] = (data or {}).get('package') or {}
+    return packages[activity_id]
+
+
+def read_checkpoint(path):
+    '''
+    Returns the progress saved by write_checkpoint, or an empty progress if
+    the checkpoint file does not exist.
+    '''
+    if not os.path.exists(path):
+        return {'last_package_id': None,
+                'packages': 0, 'resources': 0, 'versions': 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, progress):
+    '''
+    Saves progress to path, replacing the file atomically so an interrupted
+    write never leaves a truncated checkpoint behind.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.rename(tmp_path, path)
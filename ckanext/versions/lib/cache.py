@@ -0,0 +1,419 @@
+# encoding: utf-8
+
+'''
+Caches for results that are expensive to compute or that are read much more
+often than they change
+'''
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+# Misses remembered per thread while their value is loaded
+_MAX_PENDING = 1024
+
+
+class LRUCache(object):
+    '''
+    A thread safe mapping that keeps at most maxsize items, discarding the
+    least recently used one when full. If ttl is given, items expire after
+    that many seconds.
+
+    A value loaded after a miss is not stored if any item was deleted since
+    the miss, so a value read before an invalidation never replaces it.
+
+    Hits and misses are counted, see stats.
+    '''
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented by every delete, see set
+        self._generation = 0
+        self._pending = threading.local()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and \
+                    item[0] < time.monotonic():
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                _remember_miss(self._pending, key, self._generation)
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expected = _pending_generations(self._pending).pop(key, None)
+        expires = time.monotonic() + self.ttl if self.ttl is not None \
+            else None
+        with self._lock:
+            if expected is not None and expected != self._generation:
+                return
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(object):
+    '''
+    A cache shared by all CKAN processes, stored in the Redis instance
+    configured in ckan.redis.url. Values are strings, stored under prefix
+    and expiring after ttl seconds.
+
+    Deleting a key increments a generation counter of the key, and clear
+    one of the whole cache. A value loaded after a miss is only stored if
+    neither counter changed since the miss, so a value read before an
+    invalidation never replaces it.
+    '''
+
+    def __init__(self, prefix, ttl=3600, redis=None):
+        if redis is None:
+            from ckan.lib.redis import connect_to_redis
+            redis = connect_to_redis()
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._redis = redis
+        self._pending = threading.local()
+
+    def get(self, key, default=None):
+        value, generation, cleared = self._redis.mget(
+            self.prefix + key, *self._generation_keys(key))
+        if value is None:
+            _remember_miss(self._pending, key, (generation, cleared))
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        expected = _pending_generations(self._pending).pop(key, None)
+        if expected is None:
+            self._redis.setex(self.prefix + key, self.ttl, value)
+            return
+        generation_keys = self._generation_keys(key)
+
+        def fill(pipe):
+            if tuple(pipe.mget(*generation_keys)) != expected:
+                return
+            pipe.multi()
+            pipe.setex(self.prefix + key, self.ttl, value)
+        self._redis.transaction(fill, *generation_keys)
+
+    def delete(self, key):
+        generation_key = self._generation_keys(key)[0]
+        pipe = self._redis.pipeline()
+        pipe.delete(self.prefix + key)
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        cleared_key = self._generation_keys(u'')[1]
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            if key not in (cleared_key, cleared_key.encode('utf-8')):
+                self._redis.delete(key)
+        self._redis.incr(cleared_key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _generation_keys(self, key):
+        return (self.prefix + 'generation:' + key,
+                self.prefix + 'generation')
+
+
+class MmapCache(object):
+    '''
+    A cache shared by all processes on a host, stored in a memory mapped
+    file (by default in /dev/shm) holding a fixed number of slots.
+
+    The name of the file is path followed by the format and settings of the
+    cache, such as path.v2-16384x2048, so processes started with other
+    settings use another file. Files are created by the first process using
+    them and never truncated while other processes may have them mapped.
+
+    Each key maps to a single slot, which holds the latest key stored in it,
+    so a key can evict another one. Keys and values are strings, and values
+    that do not fit in a slot are not stored.
+
+    Every slot has a generation counter, incremented by writers before and
+    after they change the slot, so readers detect and ignore slots being
+    written. Deleting a key increments the generation of its slot, and a
+    value loaded after a miss is only stored if the generation of its slot
+    has not changed since then, so a value read before an invalidation
+    never replaces it. Writes are serialized between threads with a lock
+    and between processes with a lock on the file.
+
+    Slots record when they were written, and if ttl is given, values older
+    than ttl seconds are misses, so an invalidation that was lost, for
+    example one made while the file was unavailable, is not kept forever.
+    '''
+
+    _VERSION = 2
+    _MAGIC = b'CKVMMAP2'
+    _HEADER = struct.Struct('<8sQQ')
+    _HEADER_SIZE = 64
+    # generation, time written, checksum, key length, value length
+    _SLOT = struct.Struct('<QIIHI')
+
+    def __init__(self, path, slots=16384, slot_size=2048, ttl=None):
+        self.path = u'{}.v{}-{}x{}'.format(
+            path, self._VERSION, slots, slot_size)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._pending = threading.local()
+        self._thread_lock = threading.Lock()
+        size = self._HEADER_SIZE + slots * slot_size
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(fd, self._HEADER.size, 0)
+                if header.strip(b'\0'):
+                    if self._HEADER.unpack(header) != \
+                            (self._MAGIC, slots, slot_size):
+                        raise ValueError(
+                            u'{} is not a cache file with {} slots of {} '
+                            u'bytes'.format(self.path, slots, slot_size))
+                else:
+                    # New file, or one whose creator stopped before writing
+                    # the header
+                    if os.fstat(fd).st_size < size:
+                        os.ftruncate(fd, size)
+                    os.pwrite(fd, self._HEADER.pack(
+                        self._MAGIC, slots, slot_size), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def get(self, key, default=None):
+        offset, encoded_key = self._slot(key)
+        generation, value = self._read(offset, encoded_key)
+        if value is None:
+            _remember_miss(self._pending, key, generation)
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        offset, encoded_key = self._slot(key)
+        encoded_value = value.encode('utf-8')
+        if self._SLOT.size + len(encoded_key) + len(encoded_value) > \
+                self.slot_size:
+            return
+        expected = _pending_generations(self._pending).pop(key, None)
+        with self._lock():
+            generation = self._SLOT.unpack_from(self._map, offset)[0]
+            if expected is not None and generation != expected:
+                return
+            self._write(offset, generation, encoded_key, encoded_value)
+
+    def delete(self, key):
+        offset, _ = self._slot(key)
+        with self._lock():
+            generation = self._SLOT.unpack_from(self._map, offset)[0]
+            self._write(offset, generation, b'', b'')
+
+    def clear(self):
+        with self._lock():
+            for i in range(self.slots):
+                offset = self._HEADER_SIZE + i * self.slot_size
+                generation = self._SLOT.unpack_from(self._map, offset)[0]
+                self._write(offset, generation, b'', b'')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _slot(self, key):
+        encoded_key = key.encode('utf-8')
+        index = zlib.crc32(encoded_key) % self.slots
+        return self._HEADER_SIZE + index * self.slot_size, encoded_key
+
+    def _read(self, offset, encoded_key):
+        '''
+        Returns the generation of the slot at offset and the value stored
+        in it for encoded_key, or None if the slot holds another key or is
+        being written.
+        '''
+        generation, written, checksum, key_length, value_length = \
+            self._SLOT.unpack_from(self._map, offset)
+        if generation % 2 or key_length != len(encoded_key):
+            return generation, None
+        if self.ttl is not None and written + self.ttl < time.time():
+            return generation, None
+        start = offset + self._SLOT.size
+        end = start + key_length + value_length
+        if end > offset + self.slot_size:
+            return generation, None
+        data = self._map[start:end]
+        if self._SLOT.unpack_from(self._map, offset)[0] != generation or \
+                zlib.crc32(data) != checksum or \
+                data[:key_length] != encoded_key:
+            return generation, None
+        return generation, data[key_length:].decode('utf-8')
+
+    def _write(self, offset, generation, encoded_key, encoded_value):
+        # An odd generation tells readers the slot is being written
+        data = encoded_key + encoded_value
+        struct.pack_into('<Q', self._map, offset, generation + 1)
+        start = offset + self._SLOT.size
+        self._map[start:start + len(data)] = data
+        self._SLOT.pack_into(self._map, offset, generation + 1,
+                             int(time.time()), zlib.crc32(data),
+                             len(encoded_key), len(encoded_value))
+        struct.pack_into('<Q', self._map, offset, generation + 2)
+
+    def _lock(self):
+        # flock locks are shared by processes forked with the same open file,
+        # so each process locks a file descriptor of its own, and they do not
+        # exclude the threads using it, which take a lock of the process
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._thread_lock = threading.Lock()
+            self._pid = os.getpid()
+        return _FileLock(self._fd, self._thread_lock)
+
+
+def _remember_miss(pending, key, generation):
+    '''
+    Records, for the current thread, the generation of a cache when key was
+    missed, which set compares with the generation when the value loaded
+    after the miss is stored.
+    '''
+    generations = _pending_generations(pending)
+    if len(generations) >= _MAX_PENDING:
+        generations.clear()
+    generations[key] = generation
+
+
+def _pending_generations(pending):
+    if not hasattr(pending, 'generations'):
+        pending.generations = {}
+    return pending.generations
+
+
+class _FileLock(object):
+
+    def __init__(self, fd, thread_lock):
+        self._fd = fd
+        self._thread_lock = thread_lock
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, *args):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+
+class TwoTierCache(object):
+    '''
+    A cache of JSON serializable values, looked up first in an optional
+    local cache (usually an LRUCache with a short ttl) and then in an
+    optional shared cache (a RedisCache, an MmapCache, or an LRUCache
+    standing in for them in tests).
+
+    Values are stored as JSON strings in both tiers, so every get returns a
+    new copy that callers are free to modify. Invalidations only reach the
+    local tier of the current process and the shared tier; the local tiers
+    of other processes are refreshed when their items expire. Without a
+    local tier, every process sees invalidations at once.
+    '''
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = None
+        if self.local is not None:
+            value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None and self.local is not None:
+                self.local.set(key, value)
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        for tier in self._tiers():
+            tier.set(key, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            for tier in self._tiers():
+                tier.delete(key)
+
+    def clear(self):
+        for tier in self._tiers():
+            tier.clear()
+
+    def stats(self):
+        return {
+            'local': self.local.stats() if self.local is not None else None,
+            'shared': self.shared.stats() if self.shared is not None
+            else None,
+        }
+
+    def _tiers(self):
+        return [tier for tier in (self.local, self.shared)
+                if tier is not None]
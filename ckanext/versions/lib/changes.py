@@ -5,6 +5,7 @@ Functions for generating a list of differences between two versions of a
 dataset
 '''
 
+import json
 import logging
 
 log = logging.getLogger(__name__)
@@ -41,42 +42,45 @@ def _extras_to_dict(extras_list):
     return ret_dict
 
 
-def check_resource_changes(change_list, old, new, old_activity_id):
+# list of default fields in a resource's metadata dictionary - used
+# later to ensure that we don't count changes to default fields as changes
+# to extra fields
+_RESOURCE_DEFAULT_FIELDS = frozenset([
+    u'id', u'package_id', u'url', u'revision_id', u'description',
+    u'format', u'hash', u'name', u'resource_type',
+    u'mimetype', u'mimetype_inner', u'cache_url',
+    u'size', u'created', u'last_modified', u'metadata_modified',
+    u'cache_last_updated', u'upload', u'position',
+    # Compared on its own, see compare_schemas
+    u'schema'
+])
+
+
+def check_resource_changes(change_list, old, new, old_activity_id,
+                           resource_ids=None):
     '''
     Compares two versions of a dataset and records the changes between them
     (just the resources) in change_list. e.g. resources that are added, changed
     or deleted. For existing resources, checks whether their names, formats,
     and/or descriptions have changed, as well as whether the url changed (e.g.
     a new file has been uploaded for the resource).
-    '''
 
-    # list of default fields in a resource's metadata dictionary - used
-    # later to ensure that we don't count changes to default fields as changes
-    # to extra fields
-    fields = [
-        u'package_id', u'url', u'revision_id', u'description',
-        u'format', u'hash', u'name', u'resource_type',
-        u'mimetype', u'mimetype_inner', u'cache_url',
-        u'size', u'created', u'last_modified', u'metadata_modified',
-        u'cache_last_updated', u'upload', u'position'
-    ]
-    default_fields_set = set(fields)
-
-    # make a set of the resource IDs present in old and new
-    old_resource_set = set()
-    old_resource_dict = {}
-    new_resource_set = set()
-    new_resource_dict = {}
+    If resource_ids is given, only the resources with those ids are
+    compared, and the rest of the resources in the datasets are skipped.
+    '''
 
-    for resource in old['resources']:
-        old_resource_set.add(resource['id'])
-        old_resource_dict[resource['id']] = {
-            key: value for (key, value) in resource.items() if key != u'id'}
+    # index the resources present in old and new by their IDs
+    old_resource_dict = {
+        resource['id']: resource for resource in old['resources']}
+    new_resource_dict = {
+        resource['id']: resource for resource in new['resources']}
 
-    for resource in new['resources']:
-        new_resource_set.add(resource['id'])
-        new_resource_dict[resource['id']] = {
-            key: value for (key, value) in resource.items() if key != u'id'}
+    old_resource_set = set(old_resource_dict)
+    new_resource_set = set(new_resource_dict)
+    if resource_ids is not None:
+        resource_ids = set(resource_ids)
+        old_resource_set &= resource_ids
+        new_resource_set &= resource_ids
 
     # get the IDs of the resources that have been added between the versions
     new_resources = list(new_resource_set - old_resource_set)
@@ -103,272 +107,433 @@ def check_resource_changes(change_list, old, new, old_activity_id):
     # have been changed
     resources = new_resource_set.intersection(old_resource_set)
     for resource_id in resources:
-        old_metadata = old_resource_dict[resource_id]
-        new_metadata = new_resource_dict[resource_id]
+        _resource_changes(change_list, old, new, old_activity_id,
+                          resource_id, old_resource_dict[resource_id],
+                          new_resource_dict[resource_id])
 
-        if old_metadata['name'] != new_metadata['name']:
-            change_list.append({u'type': u'resource_name',
-                                u'title': new['title'],
-                                u'old_pkg_id': old['id'],
-                                u'new_pkg_id': new['id'],
-                                u'resource_id': resource_id,
-                                u'old_resource_name':
-                                old_resource_dict[resource_id]['name'],
-                                u'new_resource_name':
-                                new_resource_dict[resource_id]['name'],
-                                u'old_activity_id': old_activity_id})
-
-        # you can't remove a format, but if a resource's format isn't
-        # recognized, it won't have one set
-
-        # if a format was not originally set and the user set one
-        if not old_metadata['format'] and new_metadata['format']:
-            change_list.append({u'type': u'resource_format',
-                                u'method': u'add',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_resource_dict[resource_id]['name'],
-                                u'org_id': new['organization']['id']
-                                    if new['organization'] else u'',
-                                u'format': new_metadata['format']})
-
-        # if both versions have a format but the format changed
-        elif old_metadata['format'] != new_metadata['format']:
-            change_list.append({u'type': u'resource_format',
-                                u'method': u'change',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_resource_dict[resource_id]['name'],
-                                u'org_id': new['organization']['id']
-                                    if new['organization'] else u'',
-                                u'old_format': old_metadata['format'],
-                                u'new_format': new_metadata['format']})
-
-        # if the description changed
-        if not old_metadata['description'] and \
-                new_metadata['description']:
-            change_list.append({u'type': u'resource_desc',
-                                u'method': u'add',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_resource_dict[resource_id]['name'],
-                                u'new_desc': new_metadata['description']})
-
-        # if there was a description but the user removed it
-        elif old_metadata['description'] and \
-                not new_metadata['description']:
-            change_list.append({u'type': u'resource_desc',
-                                u'method': u'remove',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_resource_dict[resource_id]['name']})
 
-        # if both have descriptions but they are different
-        elif old_metadata['description'] != new_metadata['description']:
-            change_list.append({u'type': u'resource_desc',
-                                u'method': u'change',
+def _resource_changes(change_list, old, new, old_activity_id, resource_id,
+                      old_metadata, new_metadata):
+    '''
+    Appends a summary of the changes to a resource that exists in both
+    versions of a dataset (old and new) to change_list.
+    '''
+    if old_metadata['name'] != new_metadata['name']:
+        change_list.append({u'type': u'resource_name',
+                            u'title': new['title'],
+                            u'old_pkg_id': old['id'],
+                            u'new_pkg_id': new['id'],
+                            u'resource_id': resource_id,
+                            u'old_resource_name':
+                            old_metadata['name'],
+                            u'new_resource_name':
+                            new_metadata['name'],
+                            u'old_activity_id': old_activity_id})
+
+    # you can't remove a format, but if a resource's format isn't
+    # recognized, it won't have one set
+
+    # if a format was not originally set and the user set one
+    if not old_metadata['format'] and new_metadata['format']:
+        change_list.append({u'type': u'resource_format',
+                            u'method': u'add',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'org_id': new['organization']['id']
+                                if new['organization'] else u'',
+                            u'format': new_metadata['format']})
+
+    # if both versions have a format but the format changed
+    elif old_metadata['format'] != new_metadata['format']:
+        change_list.append({u'type': u'resource_format',
+                            u'method': u'change',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'org_id': new['organization']['id']
+                                if new['organization'] else u'',
+                            u'old_format': old_metadata['format'],
+                            u'new_format': new_metadata['format']})
+
+    # if the description changed
+    if not old_metadata['description'] and \
+            new_metadata['description']:
+        change_list.append({u'type': u'resource_desc',
+                            u'method': u'add',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'new_desc': new_metadata['description']})
+
+    # if there was a description but the user removed it
+    elif old_metadata['description'] and \
+            not new_metadata['description']:
+        change_list.append({u'type': u'resource_desc',
+                            u'method': u'remove',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name']})
+
+    # if both have descriptions but they are different
+    elif old_metadata['description'] != new_metadata['description']:
+        change_list.append({u'type': u'resource_desc',
+                            u'method': u'change',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'new_desc': new_metadata['description'],
+                            u'old_desc': old_metadata['description']})
+
+    # check if the url changes (e.g. user uploaded a new file)
+    # TODO: use regular expressions to determine the actual name of the
+    # new and old files
+    if old_metadata['url'] != new_metadata['url']:
+        change_list.append({u'type': u'new_file',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name']})
+
+    # check any extra fields in the resource
+    # remove default fields from these sets to make sure we only check
+    # for changes to extra fields
+    old_fields_set = set(old_metadata.keys())
+    old_fields_set = old_fields_set - _RESOURCE_DEFAULT_FIELDS
+    new_fields_set = set(new_metadata.keys())
+    new_fields_set = new_fields_set - _RESOURCE_DEFAULT_FIELDS
+
+    # determine if any new extra fields have been added
+    new_fields = list(new_fields_set - old_fields_set)
+    if len(new_fields) == 1:
+        if new_metadata[new_fields[0]]:
+            change_list.append({u'type': u'resource_extras',
+                                u'method': u'add_one_value',
                                 u'pkg_id': new['id'],
                                 u'title': new['title'],
                                 u'resource_id': resource_id,
                                 u'resource_name':
-                                new_resource_dict[resource_id]['name'],
-                                u'new_desc': new_metadata['description'],
-                                u'old_desc': old_metadata['description']})
-
-        # check if the url changes (e.g. user uploaded a new file)
-        # TODO: use regular expressions to determine the actual name of the
-        # new and old files
-        if old_metadata['url'] != new_metadata['url']:
-            change_list.append({u'type': u'new_file',
+                                new_metadata['name'],
+                                u'key': new_fields[0],
+                                u'value': new_metadata[new_fields[0]]})
+        else:
+            change_list.append({u'type': u'resource_extras',
+                                u'method': u'add_one_no_value',
                                 u'pkg_id': new['id'],
                                 u'title': new['title'],
                                 u'resource_id': resource_id,
                                 u'resource_name':
-                                new_metadata['name']})
-
-        # check any extra fields in the resource
-        # remove default fields from these sets to make sure we only check
-        # for changes to extra fields
-        old_fields_set = set(old_metadata.keys())
-        old_fields_set = old_fields_set - default_fields_set
-        new_fields_set = set(new_metadata.keys())
-        new_fields_set = new_fields_set - default_fields_set
-
-        # determine if any new extra fields have been added
-        new_fields = list(new_fields_set - old_fields_set)
-        if len(new_fields) == 1:
-            if new_metadata[new_fields[0]]:
+                                new_metadata['name'],
+                                u'key': new_fields[0]})
+    elif len(new_fields) > 1:
+        change_list.append({u'type': u'resource_extras',
+                            u'method': u'add_multiple',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'key_list': new_fields,
+                            u'value_list':
+                            [new_metadata[field] for field in new_fields]})
+
+    # determine if any extra fields have been removed
+    deleted_fields = list(old_fields_set - new_fields_set)
+    if len(deleted_fields) == 1:
+        change_list.append({u'type': u'resource_extras',
+                            u'method': u'remove_one',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'key': deleted_fields[0]})
+    elif len(deleted_fields) > 1:
+        change_list.append({u'type': u'resource_extras',
+                            u'method': u'remove_multiple',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'resource_id': resource_id,
+                            u'resource_name':
+                            new_metadata['name'],
+                            u'key_list': deleted_fields})
+
+    # determine if any extra fields have been changed
+    # changed_fields is only a set of POTENTIALLY changed fields - we
+    # still have to check if any of the values associated with the fields
+    # have actually changed
+    changed_fields = list(new_fields_set.intersection(old_fields_set))
+    for field in changed_fields:
+        if new_metadata[field] != old_metadata[field]:
+            if new_metadata[field] and old_metadata[field]:
                 change_list.append({u'type': u'resource_extras',
-                                    u'method': u'add_one_value',
+                                    u'method': u'change_value_with_old',
                                     u'pkg_id': new['id'],
                                     u'title': new['title'],
                                     u'resource_id': resource_id,
                                     u'resource_name':
                                     new_metadata['name'],
-                                    u'key': new_fields[0],
-                                    u'value': new_metadata[new_fields[0]]})
-            else:
+                                    u'key': field,
+                                    u'old_value': old_metadata[field],
+                                    u'new_value': new_metadata[field]})
+            elif not old_metadata[field]:
                 change_list.append({u'type': u'resource_extras',
-                                    u'method': u'add_one_no_value',
+                                    u'method': u'change_value_no_old',
                                     u'pkg_id': new['id'],
                                     u'title': new['title'],
                                     u'resource_id': resource_id,
                                     u'resource_name':
                                     new_metadata['name'],
-                                    u'key': new_fields[0]})
-        elif len(new_fields) > 1:
-            change_list.append({u'type': u'resource_extras',
-                                u'method': u'add_multiple',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_metadata['name'],
-                                u'key_list': new_fields,
-                                u'value_list':
-                                [new_metadata[field] for field in new_fields]})
+                                    u'key': field,
+                                    u'new_value': new_metadata[field]})
+            elif not new_metadata[field]:
+                change_list.append({u'type': u'resource_extras',
+                                    u'method': u'change_value_no_new',
+                                    u'pkg_id': new['id'],
+                                    u'title': new['title'],
+                                    u'resource_id': resource_id,
+                                    u'resource_name':
+                                    new_metadata['name'],
+                                    u'key': field})
+
+    # check whether the table schema (data dictionary) changed
+    if old_metadata.get(u'schema') != new_metadata.get(u'schema'):
+        _schema_change(change_list, new, resource_id, old_metadata,
+                       new_metadata)
+
+
+def compare_schemas(old_schema, new_schema):
+    '''
+    Compares two table schemas and returns a dict with the names of the
+    added and removed fields, the fields whose type changed, and whether the
+    fields present in both were reordered. Removing a field or changing its
+    type is a breaking change.
+
+    Schemas can be Table Schema dicts (with a list of fields), lists of
+    fields as returned by datastore_search, or JSON strings of either.
+    Returns None if either schema cannot be read.
+    '''
+    old_fields = _schema_fields(old_schema)
+    new_fields = _schema_fields(new_schema)
+    if old_fields is None or new_fields is None:
+        return None
+
+    old_types = dict(old_fields)
+    new_types = dict(new_fields)
+    removed = [name for name, _ in old_fields if name not in new_types]
+    added = [name for name, _ in new_fields if name not in old_types]
+    type_changes = [
+        {u'field': name, u'old_type': old_types[name],
+         u'new_type': new_types[name]}
+        for name, _ in new_fields
+        if name in old_types and old_types[name] != new_types[name]
+    ]
+    reordered = [name for name, _ in old_fields if name in new_types] != \
+        [name for name, _ in new_fields if name in old_types]
+    return {
+        u'added_fields': added,
+        u'removed_fields': removed,
+        u'type_changes': type_changes,
+        u'reordered': reordered,
+        u'breaking': bool(removed or type_changes),
+    }
 
-        # determine if any extra fields have been removed
-        deleted_fields = list(old_fields_set - new_fields_set)
-        if len(deleted_fields) == 1:
-            change_list.append({u'type': u'resource_extras',
-                                u'method': u'remove_one',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_metadata['name'],
-                                u'key': deleted_fields[0]})
-        elif len(deleted_fields) > 1:
-            change_list.append({u'type': u'resource_extras',
-                                u'method': u'remove_multiple',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'resource_id': resource_id,
-                                u'resource_name':
-                                new_metadata['name'],
-                                u'key_list': deleted_fields})
 
-        # determine if any extra fields have been changed
-        # changed_fields is only a set of POTENTIALLY changed fields - we
-        # still have to check if any of the values associated with the fields
-        # have actually changed
-        changed_fields = list(new_fields_set.intersection(old_fields_set))
-        for field in changed_fields:
-            if new_metadata[field] != old_metadata[field]:
-                if new_metadata[field] and old_metadata[field]:
-                    change_list.append({u'type': u'resource_extras',
-                                        u'method': u'change_value_with_old',
-                                        u'pkg_id': new['id'],
-                                        u'title': new['title'],
-                                        u'resource_id': resource_id,
-                                        u'resource_name':
-                                        new_metadata['name'],
-                                        u'key': field,
-                                        u'old_value': old_metadata[field],
-                                        u'new_value': new_metadata[field]})
-                elif not old_metadata[field]:
-                    change_list.append({u'type': u'resource_extras',
-                                        u'method': u'change_value_no_old',
-                                        u'pkg_id': new['id'],
-                                        u'title': new['title'],
-                                        u'resource_id': resource_id,
-                                        u'resource_name':
-                                        new_metadata['name'],
-                                        u'key': field,
-                                        u'new_value': new_metadata[field]})
-                elif not new_metadata[field]:
-                    change_list.append({u'type': u'resource_extras',
-                                        u'method': u'change_value_no_new',
-                                        u'pkg_id': new['id'],
-                                        u'title': new['title'],
-                                        u'resource_id': resource_id,
-                                        u'resource_name':
-                                        new_metadata['name'],
-                                        u'key': field})
+def _schema_fields(schema):
+    '''
+    Returns the (name, type) pairs of the fields of a schema, an empty list
+    if there is no schema, or None if it cannot be read.
+    '''
+    if not schema:
+        return []
+    if isinstance(schema, str):
+        try:
+            schema = json.loads(schema)
+        except ValueError:
+            return None
+    if isinstance(schema, dict):
+        schema = schema.get(u'fields')
+    if not isinstance(schema, list):
+        return None
+    fields = []
+    for field in schema:
+        if not isinstance(field, dict):
+            return None
+        name = field.get(u'name', field.get(u'id'))
+        if name is None:
+            return None
+        fields.append((name, field.get(u'type')))
+    return fields
+
+
+def _schema_change(change_list, new, resource_id, old_metadata,
+                   new_metadata):
+    '''
+    Appends a summary of the changes to the fields of a resource's table
+    schema to change_list, if its fields changed and both schemas can be
+    read.
+    '''
+    result = compare_schemas(old_metadata.get(u'schema'),
+                             new_metadata.get(u'schema'))
+    if not result or not (result[u'added_fields'] or
+                          result[u'removed_fields'] or
+                          result[u'type_changes'] or result[u'reordered']):
+        return
+    change = {u'type': u'resource_schema',
+              u'pkg_id': new['id'],
+              u'title': new['title'],
+              u'resource_id': resource_id,
+              u'resource_name': new_metadata['name']}
+    change.update(result)
+    change_list.append(change)
+
+
+def check_version_changes(old, new, old_activity_id, resource_id):
+    '''
+    Returns the list of changes introduced by a version of a resource, given
+    the dataset as it was in the previous version (old) and in this version
+    (new): changes to the dataset metadata and to the resource itself.
+    '''
+    change_list = []
+    check_metadata_changes(change_list, old, new)
+    check_resource_changes(change_list, old, new, old_activity_id,
+                           resource_ids=[resource_id])
+    return change_list
 
 
 def check_metadata_changes(change_list, old, new):
     '''
     Compares two versions of a dataset and records the changes between them
     (excluding resources) in change_list.
+
+    The comparator for the type of the new dataset is used, see
+    get_comparator.
     '''
-    # if the title has changed
-    if old['title'] != new['title']:
-        _title_change(change_list, old, new)
+    get_comparator(new.get(u'type') or u'dataset').compare(
+        change_list, old, new)
 
-    # if the owner organization changed
-    if old['owner_org'] != new['owner_org']:
-        _org_change(change_list, old, new)
 
-    # if the maintainer of the dataset changed
-    if old['maintainer'] != new['maintainer']:
-        _maintainer_change(change_list, old, new)
+class MetadataComparator(object):
+    '''
+    Compares the metadata (excluding resources) of two versions of a dataset
+    with a list of rules, one per field, compiled once from a field spec.
 
-    # if the maintainer email of the dataset changed
-    if old['maintainer_email'] != new['maintainer_email']:
-        _maintainer_email_change(change_list, old, new)
+    The default CKAN fields are always checked first, in the same order and
+    with the same change records as the activity stream. Then each field in
+    field_names that is not a default field is checked in order, followed by
+    any other field found in the dataset, and both are reported as
+    extension_fields changes. Extras are checked last.
+    '''
 
-    # if the author of the dataset changed
-    if old['author'] != new['author']:
-        _author_change(change_list, old, new)
+    def __init__(self, field_names=()):
+        # Each rule is a (field, change) pair. change is called when the
+        # field differs, or always if field is None. A None change stands
+        # for a generic extension_fields record.
+        rules = list(_DEFAULT_FIELD_RULES)
+        known = set(_DATASET_DEFAULT_FIELDS)
+        for field in field_names:
+            if field not in known:
+                known.add(field)
+                rules.append((field, None))
+        self._rules = tuple(rules)
+        self._known_fields = frozenset(known)
 
-    # if the author email of the dataset changed
-    if old['author_email'] != new['author_email']:
-        _author_email_change(change_list, old, new)
+    @classmethod
+    def from_scheming_schema(cls, schema):
+        '''
+        Returns a comparator for the dataset fields of a ckanext-scheming
+        schema, as returned by scheming_dataset_schema_show.
+        '''
+        return cls([field[u'field_name']
+                    for field in schema.get(u'dataset_fields') or []])
 
-    # if the visibility of the dataset changed
-    if old['private'] != new['private']:
-        change_list.append({u'type': u'private', u'pkg_id': new['id'],
-                            u'title': new['title'],
-                            u'new':
-                            u'Private' if bool(new['private'])
-                            else u'Public'})
+    def compare(self, change_list, old, new):
+        for field, change in self._rules:
+            if change is None:
+                _extension_field_change(change_list, old, new, field)
+            elif field is None or old[field] != new[field]:
+                change(change_list, old, new)
+
+        # fields that are neither default nor in the spec
+        for field in sorted(new.keys() - self._known_fields):
+            _extension_field_change(change_list, old, new, field)
 
-    # if the description of the dataset changed
-    if old['notes'] != new['notes']:
-        _notes_change(change_list, old, new)
+        _extra_fields(change_list, old, new)
+        return change_list
 
+
+_comparators = {}
+
+
+def get_comparator(dataset_type):
+    '''
+    Returns the comparator for datasets of the given type, built from its
+    ckanext-scheming schema if that extension is enabled, or from the
+    default CKAN fields otherwise. Comparators are built once per process.
+    '''
+    if dataset_type not in _comparators:
+        # ckanext-scheming is optional
+        from ckan.plugins import toolkit
+        try:
+            schema = toolkit.get_action(u'scheming_dataset_schema_show')(
+                {u'ignore_auth': True}, {u'type': dataset_type})
+        except (KeyError, toolkit.ObjectNotFound):
+            comparator = MetadataComparator()
+        else:
+            comparator = MetadataComparator.from_scheming_schema(schema)
+        _comparators[dataset_type] = comparator
+    return _comparators[dataset_type]
+
+
+def _private_change(change_list, old, new):
+    '''
+    Appends a summary of a change to a dataset's visibility between two
+    versions (old and new) to change_list.
+    '''
+    change_list.append({u'type': u'private', u'pkg_id': new['id'],
+                        u'title': new['title'],
+                        u'new':
+                        u'Private' if bool(new['private'])
+                        else u'Public'})
+
+
+def _tags_rule(change_list, old, new):
+    '''
+    Appends a summary of a change to a dataset's tags between two versions
+    (old and new) to change_list, if the tags have changed.
+    '''
     # make sets out of the tags for each dataset
     # Validating whether key exist, if not default as []
     old_tags = {tag['name'] for tag in old.get('tags', [])}
     new_tags = {tag['name'] for tag in new.get('tags', [])}
-    # if the tags have changed
     if old_tags != new_tags:
         _tag_change(change_list, new_tags, old_tags, new)
 
-    # if the license has changed
-    if old['license_title'] != new['license_title']:
-        _license_change(change_list, old, new)
-
-    # if the name of the dataset has changed
-    # this is only visible to the user via the dataset's URL,
-    # so display the change using that
-    if old['name'] != new['name']:
-        _name_change(change_list, old, new)
-
-    # if the source URL (metadata value, not the actual URL of the dataset)
-    # has changed
-    if old['url'] != new['url']:
-        _url_change(change_list, old, new)
-
-    # if the user-provided version has changed
-    if old['version'] != new['version']:
-        _version_change(change_list, old, new)
-
-    # check whether fields added by extensions or custom fields
-    # (in the "extras" field) have been changed
 
-    _extension_fields(change_list, old, new)
-    _extra_fields(change_list, old, new)
+def _extension_field_change(change_list, old, new, field):
+    '''
+    Appends a generic summary of a change to a field added by an extension
+    or a custom schema to change_list, if the field was added or changed.
+    Fields removed from the dataset are not reported, since these changes
+    are not triggered by the user in the web interface or API.
+    '''
+    if field in new and (field not in old or old[field] != new[field]):
+        change_list.append({u'type': u'extension_fields',
+                            u'pkg_id': new['id'],
+                            u'title': new['title'],
+                            u'key': field,
+                            u'value': _list_to_str(new[field])})
 
 
 def _title_change(change_list, old, new):
@@ -651,62 +816,6 @@ def _version_change(change_list, old, new):
                             u'new_version': new['version']})
 
 
-def _extension_fields(change_list, old, new):
-    '''
-    Checks whether any fields that have been added to the package
-    dictionaries by CKAN extensions have been changed between versions.
-    If there have been any changes between the two versions (old and
-    new), a general summary of the change is appended to change_list. This
-    function does not produce summaries for fields added or deleted by
-    extensions, since these changes are not triggered by the user in the web
-    interface or API.
-    '''
-    # list of the default metadata fields for a dataset
-    # any fields that are not part of this list are custom fields added by a
-    # user or extension
-    fields = [
-        u'owner_org', u'maintainer', u'maintainer_email',
-        u'relationships_as_object', u'private', u'num_tags',
-        u'id', u'metadata_created', u'metadata_modified',
-        u'author', u'author_email', u'state', u'version',
-        u'license_id', u'type', u'resources', u'num_resources',
-        u'tags', u'title', u'groups', u'creator_user_id',
-        u'relationships_as_subject', u'name', u'isopen', u'url',
-        u'notes', u'license_title', u'extras',
-        u'license_url', u'organization', u'revision_id'
-    ]
-    fields_set = set(fields)
-
-    # if there are any fields from extensions that are in the new dataset and
-    # have been updated, print a generic message stating that
-    old_set = set(old.keys())
-    new_set = set(new.keys())
-    # set of additional fields in the new dictionary
-    addl_fields_new = new_set - fields_set
-    # set of additional fields in the old dictionary
-    addl_fields_old = old_set - fields_set
-    # set of additional fields in both
-    addl_fields = addl_fields_new.intersection(addl_fields_old)
-
-    # Show added fields
-    for field in (addl_fields_new - addl_fields_old):
-        change_list.append({u'type': u'extension_fields',
-                            u'pkg_id': new['id'],
-                            u'title': new['title'],
-                            u'key': field,
-                            u'value': _list_to_str(new[field])})
-
-    # if additional fields have been changed
-    addl_fields_list = list(addl_fields)
-    for field in addl_fields_list:
-        if old[field] != new[field]:
-            change_list.append({u'type': u'extension_fields',
-                                u'pkg_id': new['id'],
-                                u'title': new['title'],
-                                u'key': field,
-                                u'value': _list_to_str(new[field])})
-
-
 def _extra_fields(change_list, old, new):
     '''
     Checks whether a user has added, removed, or changed any extra fields
@@ -838,3 +947,39 @@ def _list_to_str(value):
         return ', '.join(map(str, value))
     else:
         return str(value)
+
+
+# list of the default metadata fields for a dataset
+# any fields that are not part of this list are custom fields added by a
+# user or extension
+_DATASET_DEFAULT_FIELDS = frozenset([
+    u'owner_org', u'maintainer', u'maintainer_email',
+    u'relationships_as_object', u'private', u'num_tags',
+    u'id', u'metadata_created', u'metadata_modified',
+    u'author', u'author_email', u'state', u'version',
+    u'license_id', u'type', u'resources', u'num_resources',
+    u'tags', u'title', u'groups', u'creator_user_id',
+    u'relationships_as_subject', u'name', u'isopen', u'url',
+    u'notes', u'license_title', u'extras',
+    u'license_url', u'organization', u'revision_id'
+])
+
+# rules for the default fields, in the order they are checked
+_DEFAULT_FIELD_RULES = (
+    (u'title', _title_change),
+    (u'owner_org', _org_change),
+    (u'maintainer', _maintainer_change),
+    (u'maintainer_email', _maintainer_email_change),
+    (u'author', _author_change),
+    (u'author_email', _author_email_change),
+    (u'private', _private_change),
+    (u'notes', _notes_change),
+    (None, _tags_rule),
+    (u'license_title', _license_change),
+    # this is only visible to the user via the dataset's URL
+    (u'name', _name_change),
+    # the source URL (metadata value, not the actual URL of the dataset)
+    (u'url', _url_change),
+    # the user-provided version
+    (u'version', _version_change),
+)
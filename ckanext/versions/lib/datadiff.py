@@ -0,0 +1,278 @@
+# encoding: utf-8
+
+'''
+Row level comparison of two CSV or TSV files, streamed so that memory use
+does not grow with the size of the files
+'''
+
+import collections
+import csv
+import io
+import itertools
+import logging
+import operator
+import os
+import pickle
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Partitions of each spill, taken from the next _FANOUT_BITS bits of the
+# hash of the key of each row, and spills of the same rows before giving up
+_FANOUT_BITS = 4
+_FANOUT = 1 << _FANOUT_BITS
+_MAX_DEPTH = 4
+
+
+def diff_rows(old_file, new_file, key=None, limit=100,
+              memory=64 * 1024 * 1024, delimiter=u',', encoding=u'utf-8'):
+    '''
+    Compares the rows of two CSV files, given as binary file objects whose
+    first row is the header, and returns a dict with the added and removed
+    columns, the number of added, removed, changed and unchanged rows, and
+    up to limit examples of each kind of row change.
+
+    Rows are compared on the columns present in both files. If key is a
+    list of column names, rows with the same values in them are the same
+    row, and a row whose other values differ is reported as changed.
+    Without a key, whole rows are compared and are either added or removed.
+
+    The rows of the old file are indexed in memory while the new file is
+    streamed. Once the index takes more than about memory bytes, the rows
+    of both files are spilled to temporary files by the hash of their key,
+    and each pair of partitions is compared on its own, partitioned again if
+    needed. Raises ValueError if the rows of a single key do not fit.
+    '''
+    old_reader = _reader(old_file, delimiter, encoding)
+    new_reader = _reader(new_file, delimiter, encoding)
+    old_columns = next(old_reader, [])
+    new_columns = next(new_reader, [])
+
+    common = [column for column in old_columns if column in new_columns]
+    key = list(key or [])
+    missing = [column for column in key if column not in common]
+    if missing:
+        raise ValueError(u'Key columns not found in both files: {}'.format(
+            u', '.join(missing)))
+
+    result = {
+        u'columns': {
+            u'added': [c for c in new_columns if c not in old_columns],
+            u'removed': [c for c in old_columns if c not in new_columns],
+        },
+        u'key': key,
+        u'added': 0,
+        u'removed': 0,
+        u'changed': 0,
+        u'unchanged': 0,
+        u'rows': {u'added': [], u'removed': [], u'changed': []},
+    }
+
+    old_getters = _getters(old_columns, common, key)
+    new_getters = _getters(new_columns, common, key)
+    comparison = _Comparison(result, old_columns, new_columns, old_getters,
+                             new_getters, limit, memory)
+    try:
+        comparison.diff(
+            _key_rows(old_reader, len(old_columns), *old_getters),
+            _key_rows(new_reader, len(new_columns), *new_getters))
+    finally:
+        comparison.cleanup()
+    return result
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class _LimitedReader(io.RawIOBase):
+
+    def __init__(self, fileobj, max_bytes):
+        self._file = fileobj
+        self._left = max_bytes
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # One byte more than allowed is read, to tell a file of exactly
+        # max_bytes from a larger one
+        data = self._file.read(min(len(buffer), self._left + 1))
+        self._left -= len(data)
+        if self._left < 0:
+            raise FileTooLarge()
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        super(_LimitedReader, self).close()
+        self._file.close()
+
+
+def limit_size(fileobj, max_bytes):
+    '''
+    Returns a binary file object reading fileobj, which raises FileTooLarge
+    once more than max_bytes have been read, so oversized files are stopped
+    while they are streamed whatever their headers said.
+    '''
+    return io.BufferedReader(_LimitedReader(fileobj, max_bytes))
+
+
+def _reader(fileobj, delimiter, encoding):
+    return csv.reader(
+        io.TextIOWrapper(fileobj, encoding=encoding, newline=u''),
+        delimiter=delimiter)
+
+
+def _getters(columns, common, key):
+    '''
+    Returns functions that get the key of a row, made of the values of the
+    key columns or of all common columns if there is no key, and the values
+    of the common columns, which are the ones compared between both files.
+    '''
+    get_values = _getter([columns.index(column) for column in common])
+    if not key:
+        return get_values, get_values
+    return _getter([columns.index(column) for column in key]), get_values
+
+
+def _getter(indexes):
+    if not indexes:
+        return lambda row: ()
+    return operator.itemgetter(*indexes)
+
+
+def _key_rows(rows, width, get_key, get_values):
+    '''
+    Yields (key, values, row) tuples. Rows shorter than width are padded, so
+    missing values compare as empty strings.
+    '''
+    for row in rows:
+        if not row:
+            continue
+        if len(row) < width:
+            row = row + [u''] * (width - len(row))
+        yield get_key(row), get_values(row), row
+
+
+class _Comparison(object):
+
+    def __init__(self, result, old_columns, new_columns, old_getters,
+                 new_getters, limit, memory):
+        self.result = result
+        self.old_columns = old_columns
+        self.new_columns = new_columns
+        self.old_getters = old_getters
+        self.new_getters = new_getters
+        self.limit = limit
+        self.memory = memory
+        self._tmp_dir = None
+
+    def diff(self, old_rows, new_rows, depth=0):
+        # Rows sharing a key are matched in the order they are read
+        old_index = {}
+        size = 0
+        old_rows = iter(old_rows)
+        for key, values, row in old_rows:
+            if key in old_index:
+                old_index[key].append((values, row))
+            else:
+                old_index[key] = collections.deque([(values, row)])
+            size += _row_size(row)
+            if size > self.memory:
+                self._diff_spilled(old_index, old_rows, new_rows, depth)
+                return
+
+        examples = self.result[u'rows']
+        for key, values, row in new_rows:
+            matches = old_index.get(key)
+            if not matches:
+                self.result[u'added'] += 1
+                if len(examples[u'added']) < self.limit:
+                    examples[u'added'].append(
+                        dict(zip(self.new_columns, row)))
+                continue
+            old_values, old_row = matches.popleft()
+            if old_values == values:
+                self.result[u'unchanged'] += 1
+                continue
+            self.result[u'changed'] += 1
+            if len(examples[u'changed']) < self.limit:
+                examples[u'changed'].append({
+                    u'old': dict(zip(self.old_columns, old_row)),
+                    u'new': dict(zip(self.new_columns, row)),
+                })
+
+        for matches in old_index.values():
+            self.result[u'removed'] += len(matches)
+            for old_values, old_row in matches:
+                if len(examples[u'removed']) >= self.limit:
+                    break
+                examples[u'removed'].append(
+                    dict(zip(self.old_columns, old_row)))
+
+    def _diff_spilled(self, old_index, old_rows, new_rows, depth):
+        # Rows with the same key always end up in the same partition
+        if depth >= _MAX_DEPTH or len(old_index) < 2:
+            raise ValueError(
+                u'Too many rows share a key to compare them in {} bytes of '
+                u'memory'.format(self.memory))
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix=u'versions-datadiff-')
+        indexed = ((key, values, row) for key, matches in old_index.items()
+                   for values, row in matches)
+        old_parts = _spill(itertools.chain(indexed, old_rows), depth,
+                           self._tmp_dir, u'old')
+        old_index.clear()
+        new_parts = _spill(new_rows, depth, self._tmp_dir, u'new')
+        for old_part, new_part in zip(old_parts, new_parts):
+            self.diff(_key_rows(_read_spill(old_part), 0, *self.old_getters),
+                      _key_rows(_read_spill(new_part), 0, *self.new_getters),
+                      depth + 1)
+            os.remove(old_part)
+            os.remove(new_part)
+
+    def cleanup(self):
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def _row_size(row):
+    # Approximate size in memory of an indexed row: its list, its string
+    # values and the key and values tuples that point at them
+    return 200 + sum(60 + len(value) for value in row)
+
+
+def _spill(rows, depth, tmp_dir, prefix):
+    '''
+    Writes the rows to one temporary file per partition, chosen by bits of
+    the hash of their key that depend on depth, so rows that shared a
+    partition at one depth are split at the next one, and returns the paths
+    of the files. Python's
+    hash is only stable within a process, which is enough as both files are
+    partitioned and compared by the same call.
+    '''
+    fd, base = tempfile.mkstemp(prefix=prefix, dir=tmp_dir)
+    os.close(fd)
+    paths = [u'{}-{}'.format(base, i) for i in range(_FANOUT)]
+    files = [io.open(path, u'wb') for path in paths]
+    try:
+        for key, values, row in rows:
+            partition = (hash(key) >> (depth * _FANOUT_BITS)) % _FANOUT
+            pickle.dump(row, files[partition], _PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    os.remove(base)
+    return paths
+
+
+def _read_spill(path):
+    with io.open(path, u'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
@@ -0,0 +1,713 @@
+# encoding: utf-8
+
+'''
+Text diffs of two JSON documents, as rendered by
+json.dumps(obj, indent=2, sort_keys=True)
+
+Instead of rendering both documents and matching them line by line, the
+documents are walked side by side. Identical subtrees are detected with an
+equality check and kept as a single block of unchanged lines, and list items
+are matched by id, or by their serialized value, before looking for changes
+inside them. Unchanged subtrees are only rendered where their lines are
+shown as context, so the cost depends on the size of the changes rather
+than on the size of the documents.
+
+Every line is rendered exactly as json.dumps does, and hunks are formatted
+like difflib.unified_diff and difflib.context_diff. When the changes could
+be aligned in several equally valid ways, like an item removed between two
+similar ones, the rendered documents are matched with difflib instead, so
+that the hunks are the same, unless they have more than DIFFLIB_MAX_LINES
+lines in total. Larger documents keep the alignment found by walking them,
+which can place such changes a few lines away from where difflib would.
+
+json_patch returns the same comparison as a list of RFC 6902 operations,
+for clients that apply the changes instead of displaying them.
+'''
+
+import bisect
+import difflib
+import itertools
+import json
+
+# Above this number of lines in the two documents together, changes that
+# could be aligned in several ways are not matched with difflib, which can
+# take minutes on large documents with many changes
+DIFFLIB_MAX_LINES = 10000
+
+_INDENT = u'  '
+
+
+def unified_diff(obj1, obj2, n=3):
+    '''
+    Returns the lines of a unified diff between obj1 and obj2, like
+    difflib.unified_diff does for their JSON renderings.
+    '''
+    a, b, matcher = _match(obj1, obj2)
+    started = False
+    for group in matcher.get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield u'--- \n'
+            yield u'+++ \n'
+        first, last = group[0], group[-1]
+        yield u'@@ -{} +{} @@\n'.format(
+            _format_range_unified(first[1], last[2]),
+            _format_range_unified(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield u' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield u'-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield u'+' + line
+
+
+def context_diff(obj1, obj2, n=3):
+    '''
+    Returns the lines of a context diff between obj1 and obj2, like
+    difflib.context_diff does for their JSON renderings.
+    '''
+    prefix = {
+        'insert': u'+ ', 'delete': u'- ', 'replace': u'! ', 'equal': u'  '}
+    a, b, matcher = _match(obj1, obj2)
+    started = False
+    for group in matcher.get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield u'*** \n'
+            yield u'--- \n'
+        first, last = group[0], group[-1]
+        yield u'***************\n'
+        yield u'*** {} ****\n'.format(
+            _format_range_context(first[1], last[2]))
+        if any(tag in ('replace', 'delete') for tag, _, _, _, _ in group):
+            for tag, i1, i2, _, _ in group:
+                if tag != 'insert':
+                    for line in a[i1:i2]:
+                        yield prefix[tag] + line
+        yield u'--- {} ----\n'.format(
+            _format_range_context(first[3], last[4]))
+        if any(tag in ('replace', 'insert') for tag, _, _, _, _ in group):
+            for tag, _, _, j1, j2 in group:
+                if tag != 'delete':
+                    for line in b[j1:j2]:
+                        yield prefix[tag] + line
+
+
+def json_patch(obj1, obj2):
+    '''
+    Returns a list of RFC 6902 JSON Patch operations that turn obj1 into
+    obj2, to be applied in order.
+
+    Dicts are compared key by key and lists item by item, matching items by
+    id, so a changed resource results in operations on its changed fields
+    only. Only add, remove and replace operations are used.
+    '''
+    operations = []
+    _patch(operations, u'', obj1, obj2)
+    return operations
+
+
+def _patch(operations, path, old, new):
+    if old == new and _compact(old) == _compact(new):
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(old, key=str):
+            if key not in new:
+                operations.append(
+                    {u'op': u'remove', u'path': _pointer(path, key)})
+        for key in sorted(new, key=str):
+            if key in old:
+                _patch(operations, _pointer(path, key), old[key], new[key])
+            else:
+                operations.append({u'op': u'add',
+                                   u'path': _pointer(path, key),
+                                   u'value': new[key]})
+    elif isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        _patch_list(operations, path, old, new)
+    else:
+        operations.append({u'op': u'replace', u'path': path, u'value': new})
+
+
+def _patch_list(operations, path, old, new):
+    # Operations are applied in order, so once the items before j have been
+    # patched, the list being patched starts with new[:j] and the next old
+    # item is at position j
+    opcodes = _match_items([_item_key(item) for item in old],
+                           [_item_key(item) for item in new])
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' or (
+                tag == 'replace' and i2 - i1 == j2 - j1 and
+                all(isinstance(item, dict) for item in
+                    itertools.chain(old[i1:i2], new[j1:j2]))):
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                _patch(operations, _pointer(path, j), old[i], new[j])
+            continue
+        for _ in range(i1, i2):
+            operations.append(
+                {u'op': u'remove', u'path': _pointer(path, j1)})
+        for j in range(j1, j2):
+            operations.append(
+                {u'op': u'add', u'path': _pointer(path, j), u'value': new[j]})
+
+
+def _pointer(path, token):
+    # JSON Pointer (RFC 6901) escaping
+    token = str(token).replace(u'~', u'~0').replace(u'/', u'~1')
+    return path + u'/' + token
+
+
+def _match(obj1, obj2):
+    builder = _Builder()
+    builder.diff(obj1, obj2, 0, u'', u'', u'')
+    opcodes = builder.get_opcodes()
+    if len(builder.a) + len(builder.b) <= DIFFLIB_MAX_LINES and \
+            builder.ambiguous():
+        # Which alignment difflib chooses depends on the whole documents
+        a = _dumps(obj1).split(u'\n')
+        b = _dumps(obj2).split(u'\n')
+        return a, b, difflib.SequenceMatcher(None, a, b)
+    return builder.a, builder.b, _PresetMatcher(opcodes)
+
+
+class _PresetMatcher(difflib.SequenceMatcher):
+    '''
+    A SequenceMatcher that returns opcodes computed beforehand, so they can
+    be grouped exactly like difflib does.
+    '''
+
+    def __init__(self, opcodes):
+        self.opcodes = opcodes
+
+    def get_opcodes(self):
+        return self.opcodes
+
+
+class _Lines(object):
+    '''
+    The lines of a rendered document. Unchanged subtrees are only stored
+    with their line count, and rendered when some of their lines are read.
+    '''
+
+    def __init__(self):
+        self._starts = []
+        self._segments = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def extend(self, lines):
+        if lines:
+            self._append(list(lines), len(lines))
+
+    def extend_lazy(self, children, depth, count):
+        '''
+        Adds the lines of children, a list of (head, value, tail) tuples
+        rendered at the given depth, which take count lines in total.
+        '''
+        self._append((children, depth), count)
+
+    def _append(self, segment, count):
+        self._starts.append(self._length)
+        self._segments.append(segment)
+        self._length += count
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop, _ = index.indices(self._length)
+        lines = []
+        position = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while start < stop:
+            offset = self._starts[position]
+            segment = self._segments[position]
+            position += 1
+            end = self._starts[position] \
+                if position < len(self._starts) else self._length
+            if isinstance(segment, list):
+                lines.extend(segment[start - offset:stop - offset])
+            else:
+                lines.extend(_children_lines(
+                    segment[0], segment[1],
+                    start - offset, min(stop, end) - offset, end - offset))
+            start = end
+        return lines
+
+
+def _children_lines(children, depth, start, stop, total):
+    # Renders only lines start to stop of the concatenated children, which
+    # take total lines. Line counts are only computed for the children
+    # between the requested lines and the nearest end.
+    if start > total - stop:
+        chunks = []
+        end = total
+        for head, value, tail in reversed(children):
+            if end <= start:
+                break
+            count = _count_lines(value)
+            if end - count < stop:
+                chunks.append(_tree_lines(
+                    value, depth, head, tail,
+                    max(start - end + count, 0),
+                    min(stop - end + count, count)))
+            end -= count
+        return [line for chunk in reversed(chunks) for line in chunk]
+
+    lines = []
+    offset = 0
+    for head, value, tail in children:
+        if offset >= stop:
+            break
+        count = _count_lines(value)
+        if offset + count > start:
+            lines.extend(_tree_lines(
+                value, depth, head, tail,
+                max(start - offset, 0), min(stop - offset, count)))
+        offset += count
+    return lines
+
+
+def _tree_lines(value, depth, head, tail, start, stop):
+    count = _count_lines(value)
+    if start == 0 and stop == count or \
+            not (_is_dict(value) or _is_list(value)):
+        return _render(value, depth, head, tail)[start:stop]
+
+    pad = _INDENT * depth
+    if isinstance(value, dict):
+        keys = sorted(value)
+        children = [(json.dumps(key) + u': ', value[key],
+                     _comma(i != len(keys) - 1))
+                    for i, key in enumerate(keys)]
+        opening, closing = u'{', u'}'
+    else:
+        children = _list_children(value, 0, len(value))
+        opening, closing = u'[', u']'
+
+    lines = []
+    if start == 0:
+        lines.append(pad + head + opening)
+    lines.extend(_children_lines(
+        children, depth + 1, max(start - 1, 0), min(stop - 1, count - 2),
+        count - 2))
+    if stop == count:
+        lines.append(pad + closing + tail)
+    return lines
+
+
+def _list_children(items, start, stop):
+    last = len(items) - 1
+    return [(u'', items[i], _comma(i != last)) for i in range(start, stop)]
+
+
+class _Builder(object):
+    '''
+    Renders two documents into the line lists a and b while recording
+    which ranges of lines are equal and which ones changed.
+    '''
+
+    def __init__(self):
+        self.a = _Lines()
+        self.b = _Lines()
+        self._blocks = []
+        self._moved = False
+
+    def get_opcodes(self):
+        self._trim_changes()
+        self._slide_changes()
+        opcodes = []
+        for equal, i1, i2, j1, j2 in self._blocks:
+            if equal:
+                tag = 'equal'
+            elif i1 == i2:
+                tag = 'insert'
+            elif j1 == j2:
+                tag = 'delete'
+            else:
+                tag = 'replace'
+            opcodes.append((tag, i1, i2, j1, j2))
+        return opcodes
+
+    def ambiguous(self):
+        '''
+        Whether difflib could align the changes differently: a list item
+        moved to another position, changed lines that are also found
+        between the changes around them in the other document, like an item
+        added next to a similar one, or changes separated by fewer unchanged
+        lines than they span, which difflib can match across.
+        '''
+        if self._moved:
+            return True
+        blocks = self._blocks
+        last = len(blocks) - 1
+        for n, (equal, i1, i2, j1, j2) in enumerate(blocks):
+            if not equal:
+                before = blocks[n - 1] if n else blocks[n]
+                after = blocks[n + 1] if n < last else blocks[n]
+                if _shares_lines(self.a[i1:i2], self.b[before[3]:after[4]]) \
+                        or _shares_lines(self.b[j1:j2],
+                                         self.a[before[1]:after[2]]):
+                    return True
+            elif 0 < n < last and _block_size(blocks[n]) <= max(
+                    _block_size(blocks[n - 1]), _block_size(blocks[n + 1])):
+                return True
+        return False
+
+    def _trim_changes(self):
+        # Changes can start or end with the same lines on both sides, like
+        # the closing bracket of a list where an item was appended. Those
+        # lines are reported as unchanged, as difflib does
+        blocks = []
+        for equal, i1, i2, j1, j2 in self._blocks:
+            if equal:
+                self._append_block(blocks, True, i1, i2, j1, j2)
+                continue
+            suffix = 0
+            while i2 - suffix > i1 and j2 - suffix > j1 and \
+                    self.a[i2 - suffix - 1] == self.b[j2 - suffix - 1]:
+                suffix += 1
+            prefix = 0
+            while i1 + prefix < i2 - suffix and j1 + prefix < j2 - suffix \
+                    and self.a[i1 + prefix] == self.b[j1 + prefix]:
+                prefix += 1
+            self._append_block(
+                blocks, True, i1, i1 + prefix, j1, j1 + prefix)
+            self._append_block(blocks, False, i1 + prefix, i2 - suffix,
+                               j1 + prefix, j2 - suffix)
+            self._append_block(
+                blocks, True, i2 - suffix, i2, j2 - suffix, j2)
+        self._blocks = blocks
+
+    @staticmethod
+    def _append_block(blocks, equal, i1, i2, j1, j2):
+        if i1 == i2 and j1 == j2:
+            return
+        if blocks and blocks[-1][0] == equal:
+            i1, j1 = blocks.pop()[1::2]
+        blocks.append((equal, i1, i2, j1, j2))
+
+    def _slide_changes(self):
+        # A list item or key removed or added next to similar ones can be
+        # reported at several positions, like before or after the lines
+        # separating two items. difflib matches the longest unchanged run
+        # first, so the change is moved towards the shorter of the two
+        # unchanged blocks around it, as far as the lines allow
+        blocks = self._blocks
+        for n in range(1, len(blocks) - 1):
+            equal, i1, i2, j1, j2 = blocks[n]
+            before, after = blocks[n - 1], blocks[n + 1]
+            if equal or not before[0] or not after[0]:
+                continue
+            if i1 == i2:
+                lines, start, stop, lower, upper = \
+                    self.b, j1, j2, before[3], after[4]
+            elif j1 == j2:
+                lines, start, stop, lower, upper = \
+                    self.a, i1, i2, before[1], after[2]
+            else:
+                continue
+
+            shift = 0
+            if before[2] - before[1] >= after[2] - after[1]:
+                while stop + shift < upper and \
+                        lines[start + shift] == lines[stop + shift]:
+                    shift += 1
+            else:
+                while start + shift > lower and \
+                        lines[start + shift - 1] == lines[stop + shift - 1]:
+                    shift -= 1
+            if not shift:
+                continue
+            blocks[n - 1] = (True, before[1], before[2] + shift,
+                             before[3], before[4] + shift)
+            blocks[n] = (False, i1 + shift, i2 + shift,
+                         j1 + shift, j2 + shift)
+            blocks[n + 1] = (True, after[1] + shift, after[2],
+                             after[3] + shift, after[4])
+        self._blocks = [block for block in blocks
+                        if block[2] > block[1] or block[4] > block[3]]
+
+    def add(self, equal, old_lines, new_lines):
+        self._add_block(equal, len(old_lines), len(new_lines))
+        self.a.extend(old_lines)
+        self.b.extend(new_lines)
+
+    def add_unchanged(self, children, depth, count):
+        self._add_block(True, count, count)
+        self.a.extend_lazy(children, depth, count)
+        self.b.extend_lazy(children, depth, count)
+
+    def _add_block(self, equal, old_count, new_count):
+        # Adjacent blocks of the same kind are merged, so that consecutive
+        # changes are reported as one replace like difflib does
+        self._append_block(
+            self._blocks, equal, len(self.a), len(self.a) + old_count,
+            len(self.b), len(self.b) + new_count)
+
+    def diff(self, old, new, depth, head, old_tail, new_tail):
+        # Equal values can still render differently, like 1 and 1.0, so
+        # their compact serializations are compared as well
+        if old == new and _compact(old) == _compact(new):
+            if old_tail == new_tail:
+                self.add_unchanged([(head, old, old_tail)], depth,
+                                   _count_lines(old))
+            elif _is_dict(old) or _is_list(old):
+                # Only the trailing comma of the last line differs
+                self._diff_container(old, new, depth, head,
+                                     old_tail, new_tail)
+            else:
+                self.add(False, _render(old, depth, head, old_tail),
+                         _render(new, depth, head, new_tail))
+        elif _is_dict(old) and _is_dict(new):
+            self._diff_container(old, new, depth, head, old_tail, new_tail)
+        elif _is_list(old) and _is_list(new):
+            self._diff_container(old, new, depth, head, old_tail, new_tail)
+        else:
+            self.add(False, _render(old, depth, head, old_tail),
+                     _render(new, depth, head, new_tail))
+
+    def _diff_container(self, old, new, depth, head, old_tail, new_tail):
+        if isinstance(old, dict):
+            self._diff_dict(old, new, depth, head, old_tail, new_tail)
+        else:
+            self._diff_list(old, new, depth, head, old_tail, new_tail)
+
+    def _diff_dict(self, old, new, depth, head, old_tail, new_tail):
+        pad = _INDENT * depth
+        self.add(True, [pad + head + u'{'], [pad + head + u'{'])
+
+        old_keys = sorted(old)
+        new_keys = sorted(new)
+        old_last = old_keys[-1]
+        new_last = new_keys[-1]
+        for key in sorted(set(old_keys).union(new_keys)):
+            key_head = json.dumps(key) + u': '
+            if key not in new:
+                self.add(False, _render(old[key], depth + 1, key_head,
+                                        _comma(key != old_last)), [])
+            elif key not in old:
+                self.add(False, [], _render(new[key], depth + 1, key_head,
+                                            _comma(key != new_last)))
+            else:
+                self.diff(old[key], new[key], depth + 1, key_head,
+                          _comma(key != old_last), _comma(key != new_last))
+
+        self.add(old_tail == new_tail,
+                 [pad + u'}' + old_tail], [pad + u'}' + new_tail])
+
+    def _diff_list(self, old, new, depth, head, old_tail, new_tail):
+        pad = _INDENT * depth
+        self.add(True, [pad + head + u'['], [pad + head + u'['])
+
+        old_last = len(old) - 1
+        new_last = len(new) - 1
+        old_keys = [_item_key(item) for item in old]
+        new_keys = [_item_key(item) for item in new]
+        opcodes = _match_items(old_keys, new_keys)
+        removed = set()
+        added = set()
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != 'equal':
+                removed.update(old_keys[i1:i2])
+                added.update(new_keys[j1:j2])
+        if not removed.isdisjoint(added):
+            self._moved = True
+
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal' or (
+                    tag == 'replace' and i2 - i1 == j2 - j1 and
+                    all(_is_dict(item) for item in
+                        itertools.chain(old[i1:i2], new[j1:j2]))):
+                # Items with the same id, or dicts at the same position,
+                # are compared field by field
+                self._diff_items(old, new, i1, i2, j1, depth + 1)
+                continue
+            old_lines = []
+            for i in range(i1, i2):
+                old_lines.extend(
+                    _render(old[i], depth + 1, u'', _comma(i != old_last)))
+            new_lines = []
+            for j in range(j1, j2):
+                new_lines.extend(
+                    _render(new[j], depth + 1, u'', _comma(j != new_last)))
+            self.add(False, old_lines, new_lines)
+
+        self.add(old_tail == new_tail,
+                 [pad + u']' + old_tail], [pad + u']' + new_tail])
+
+    def _diff_items(self, old, new, i1, i2, j1, depth):
+        old_last = len(old) - 1
+        new_last = len(new) - 1
+        i, j = i1, j1
+        while i < i2:
+            # Runs of equal items are checked with a single serialization
+            run = 0
+            while i + run < i2 and old[i + run] == new[j + run]:
+                run += 1
+            if run and _same_rendering(old[i:i + run], new[j:j + run]):
+                if (i + run - 1 == old_last) != (j + run - 1 == new_last):
+                    # The trailing comma of the last item differs
+                    run -= 1
+                if run:
+                    self.add_unchanged(
+                        _list_children(old, i, i + run), depth,
+                        _count_lines(old[i:i + run]) - 2)
+                    i += run
+                    j += run
+                    continue
+            self.diff(old[i], new[j], depth, u'',
+                      _comma(i != old_last), _comma(j != new_last))
+            i += 1
+            j += 1
+
+
+def _block_size(block):
+    return max(block[2] - block[1], block[4] - block[3])
+
+
+def _shares_lines(changed, lines):
+    return not set(changed).isdisjoint(lines)
+
+
+def _match_items(old_keys, new_keys):
+    '''
+    Returns the opcodes that turn the list of item keys old_keys into
+    new_keys.
+
+    Keys are usually unique, like resource ids, and then the longest common
+    subsequence is found in O(n log n) as the longest increasing run of
+    positions. SequenceMatcher, which can take quadratic time, is only used
+    for lists with repeated keys.
+    '''
+    new_positions = {key: j for j, key in enumerate(new_keys)}
+    if len(new_positions) != len(new_keys) or \
+            len(set(old_keys)) != len(old_keys):
+        return difflib.SequenceMatcher(
+            None, old_keys, new_keys, autojunk=False).get_opcodes()
+
+    # Patience sorting: tails[k] is the index in pairs of the smallest
+    # position ending an increasing run of length k + 1
+    pairs = [(i, new_positions[key]) for i, key in enumerate(old_keys)
+             if key in new_positions]
+    tails = []
+    tail_positions = []
+    previous = [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        k = bisect.bisect_left(tail_positions, j)
+        if k:
+            previous[index] = tails[k - 1]
+        if k == len(tails):
+            tails.append(index)
+            tail_positions.append(j)
+        else:
+            tails[k] = index
+            tail_positions[k] = j
+    matches = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        matches.append(pairs[index])
+        index = previous[index]
+    matches.reverse()
+
+    opcodes = []
+    i = j = 0
+    for match_i, match_j in matches + [(len(old_keys), len(new_keys))]:
+        if i < match_i or j < match_j:
+            tag = 'replace' if i < match_i and j < match_j else \
+                'delete' if i < match_i else 'insert'
+            opcodes.append((tag, i, match_i, j, match_j))
+        if match_i < len(old_keys):
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], match_i + 1,
+                               opcodes[-1][3], match_j + 1)
+            else:
+                opcodes.append(('equal', match_i, match_i + 1,
+                                match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return opcodes
+
+
+def _count_lines(value):
+    if isinstance(value, dict):
+        children = value.values()
+    elif isinstance(value, (list, tuple)):
+        children = value
+    else:
+        return 1
+    if not children:
+        return 1
+    count = 2 + len(children)
+    for child in children:
+        if child and isinstance(child, (dict, list, tuple)):
+            count += _count_lines(child) - 1
+    return count
+
+
+def _same_rendering(old_items, new_items, chunk=256):
+    # In chunks, so that long lists are not serialized at once
+    return all(
+        _compact(old_items[k:k + chunk]) == _compact(new_items[k:k + chunk])
+        for k in range(0, len(old_items), chunk))
+
+
+def _dumps(value):
+    return json.dumps(value, indent=2, sort_keys=True)
+
+
+def _compact(value):
+    # Without indent json.dumps uses its much faster C encoder
+    return json.dumps(value, sort_keys=True)
+
+
+def _render(value, depth, head, tail):
+    lines = _dumps(value).split(u'\n')
+    pad = _INDENT * depth
+    lines = [pad + head + lines[0]] + [pad + line for line in lines[1:]]
+    lines[-1] += tail
+    return lines
+
+
+def _is_dict(value):
+    # Empty containers are rendered on a single line, and keys must be
+    # strings to be sorted the same way as json.dumps does
+    return isinstance(value, dict) and bool(value) and \
+        all(isinstance(key, str) for key in value)
+
+
+def _is_list(value):
+    return isinstance(value, (list, tuple)) and bool(value)
+
+
+def _item_key(item):
+    if isinstance(item, dict) and isinstance(item.get(u'id'), str):
+        return (u'id', item[u'id'])
+    return _compact(item)
+
+
+def _comma(needed):
+    return u',' if needed else u''
+
+
+def _format_range_unified(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return u'{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return u'{},{}'.format(beginning, length)
+
+
+def _format_range_context(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if not length:
+        beginning -= 1
+    if length <= 1:
+        return u'{}'.format(beginning)
+    return u'{},{}'.format(beginning, beginning + length - 1)
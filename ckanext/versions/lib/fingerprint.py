@@ -0,0 +1,35 @@
+# encoding: utf-8
+
+'''
+Fingerprints of resource snapshots, used to tell whether a new version of a
+resource would be identical to its newest version
+'''
+
+import hashlib
+import json
+
+# Fields that CKAN updates without any change to the resource itself
+_VOLATILE_FIELDS = frozenset([
+    u'metadata_modified', u'position', u'revision_id', u'tracking_summary',
+    u'cache_last_updated', u'datastore_active',
+])
+
+
+def resource_fingerprint(resource):
+    '''
+    Returns a SHA-256 hex digest of a resource dict, as stored in the
+    activity of its dataset.
+
+    The dict is serialized canonically, with sorted keys and without the
+    fields in _VOLATILE_FIELDS, so two snapshots have the same fingerprint
+    when their metadata is the same. The file itself is covered by the hash,
+    url and size fields of the resource.
+    '''
+    snapshot = {
+        key: value for key, value in resource.items()
+        if key not in _VOLATILE_FIELDS
+    }
+    return hashlib.sha256(json.dumps(
+        snapshot, sort_keys=True, separators=(u',', u':'),
+        ensure_ascii=False, default=str
+    ).encode(u'utf-8')).hexdigest()
@@ -0,0 +1,343 @@
+# encoding: utf-8
+
+'''
+A compact in-memory index of the version table, answering the current
+version of a resource, whether it has versions, its version with a given
+name and its version at a given time without querying the database
+'''
+
+import logging
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from ckan import model
+from sqlalchemy import select
+
+from ckanext.versions.model import Version
+
+log = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+# Versions are stamped before their transaction commits, so each refresh
+# also looks at versions modified a little before the previous one
+_REFRESH_OVERLAP = timedelta(seconds=60)
+# Stands for a null time, which sorts before any other
+_NULL_TIME = -2 ** 63
+_NO_FINGERPRINT = bytes(32)
+
+
+class VersionIndex(object):
+    '''
+    The versions of every resource, ordered by creation time.
+
+    rows are (resource_id, package_id, version_id, activity_id, name,
+    created, notes, creator_user_id, modified, fingerprint) tuples, sorted
+    by resource, then by created and then by version id. They are stored in
+    columns shared by all resources: times as 64-bit microseconds, ids as
+    16 bytes each, fingerprints as 32 bytes, interned names and notes as
+    they are, so an index takes about 115 bytes per version and 120 bytes
+    per resource with versions, plus the size of distinct names and of
+    notes (see stats).
+
+    Resources passed to invalidate are reloaded with loader(resource_id),
+    which returns rows for that resource only, the next time they are
+    looked up. Lookups return the same dicts as Version.as_dict, without
+    querying the database, and are safe while other threads invalidate
+    resources.
+    '''
+
+    def __init__(self, rows=(), loader=None):
+        self._loader = loader
+        self._resources = {}
+        self._packages = []
+        self._starts = array('I')
+        self._counts = array('I')
+        self._columns = _Columns()
+        self._overlay = {}
+        self._lock = threading.Lock()
+
+        for row in rows:
+            resource_id, package_id = row[:2]
+            key = _key(resource_id)
+            number = self._resources.get(key)
+            if number is None:
+                number = len(self._packages)
+                self._resources[key] = number
+                self._packages.append(sys.intern(package_id))
+                self._starts.append(len(self._columns))
+                self._counts.append(0)
+            elif number != len(self._packages) - 1:
+                raise ValueError(u'Rows are not sorted by resource')
+            self._counts[number] += 1
+            self._columns.append(*row[2:])
+        self._bytes = self._memory_usage()
+
+    def package_id(self, resource_id):
+        '''
+        Returns the dataset id of a resource with versions, or None.
+        '''
+        return self._locate(resource_id)[3]
+
+    def has_versions(self, resource_id):
+        columns, start, end, _ = self._locate(resource_id)
+        return end > start
+
+    def current(self, resource_id):
+        columns, start, end, package_id = self._locate(resource_id)
+        if end == start:
+            return None
+        return columns.row(end - 1, resource_id, package_id)
+
+    def by_name(self, resource_id, name):
+        columns, start, end, package_id = self._locate(resource_id)
+        for i in range(end - 1, start - 1, -1):
+            if columns.names[i] == name:
+                return columns.row(i, resource_id, package_id)
+        return None
+
+    def at(self, resource_id, timestamp):
+        '''
+        Returns the newest version created at or before timestamp, a naive
+        UTC datetime, or None if the resource had no versions then.
+        '''
+        columns, start, end, package_id = self._locate(resource_id)
+        i = bisect_right(columns.created, _micros(timestamp), start, end)
+        if i == start:
+            return None
+        return columns.row(i - 1, resource_id, package_id)
+
+    def invalidate(self, *resource_ids):
+        with self._lock:
+            for resource_id in resource_ids:
+                self._overlay[_key(resource_id)] = _Stale()
+
+    def stats(self):
+        return {
+            u'resources': len(self._resources),
+            u'versions': len(self._columns),
+            u'reloaded_resources': len(self._overlay),
+            u'bytes': self._bytes,
+        }
+
+    def _locate(self, resource_id):
+        '''
+        Returns the columns holding the versions of a resource, the range of
+        its versions in them and its dataset id.
+        '''
+        key = _key(resource_id)
+        entry = self._overlay.get(key)
+        if entry is not None:
+            if isinstance(entry, _Stale):
+                entry = self._reload(key, resource_id, entry)
+            columns, package_id = entry
+            return columns, 0, len(columns), package_id
+
+        number = self._resources.get(key)
+        if number is None:
+            return self._columns, 0, 0, None
+        start = self._starts[number]
+        return (self._columns, start, start + self._counts[number],
+                self._packages[number])
+
+    def _reload(self, key, resource_id, token):
+        columns = _Columns()
+        package_id = None
+        for row in self._loader(resource_id):
+            package_id = row[1]
+            columns.append(*row[2:])
+        entry = (columns, package_id)
+        with self._lock:
+            # Unless invalidated again while loading
+            if self._overlay.get(key) is token:
+                self._overlay[key] = entry
+        return entry
+
+    def _memory_usage(self):
+        columns = self._columns
+        names = {id(name): name for name in columns.names}
+        packages = {id(package): package for package in self._packages}
+        return sum([
+            sys.getsizeof(columns.created), sys.getsizeof(columns.modified),
+            sys.getsizeof(columns.ids), sys.getsizeof(columns.activity_ids),
+            sys.getsizeof(columns.creator_ids), sys.getsizeof(columns.names),
+            sum(sys.getsizeof(name) for name in names.values()),
+            sys.getsizeof(columns.notes),
+            sum(sys.getsizeof(notes) for notes in columns.notes
+                if notes is not None),
+            sys.getsizeof(columns.fingerprints),
+            sys.getsizeof(self._resources),
+            sum(sys.getsizeof(key) for key in self._resources),
+            sys.getsizeof(self._packages),
+            sum(sys.getsizeof(package) for package in packages.values()),
+            sys.getsizeof(self._starts), sys.getsizeof(self._counts),
+        ])
+
+    def __len__(self):
+        return len(self._columns)
+
+
+class _Columns(object):
+
+    __slots__ = ('created', 'modified', 'ids', 'activity_ids', 'creator_ids',
+                 'names', 'notes', 'fingerprints')
+
+    def __init__(self):
+        self.created = array('q')
+        self.modified = array('q')
+        self.ids = bytearray()
+        self.activity_ids = bytearray()
+        self.creator_ids = bytearray()
+        self.names = []
+        self.notes = []
+        self.fingerprints = bytearray()
+
+    def append(self, version_id, activity_id, name, created, notes,
+               creator_user_id, modified, fingerprint):
+        self.created.append(_micros(created))
+        self.modified.append(_micros(modified))
+        self.ids += _uuid_bytes(version_id)
+        self.activity_ids += _uuid_bytes(activity_id)
+        self.creator_ids += _uuid_bytes(creator_user_id)
+        self.names.append(sys.intern(name))
+        self.notes.append(notes)
+        # SHA-256 digests (see ckanext.versions.lib.fingerprint), stored
+        # as 32 bytes, all zero for versions without one
+        self.fingerprints += bytes.fromhex(fingerprint) if fingerprint \
+            else _NO_FINGERPRINT
+
+    def row(self, i, resource_id, package_id):
+        # In the order of Version.as_dict
+        return OrderedDict([
+            (u'id', _uuid_str(self.ids, i)),
+            (u'package_id', package_id),
+            (u'resource_id', resource_id),
+            (u'activity_id', _uuid_str(self.activity_ids, i)),
+            (u'name', self.names[i]),
+            (u'notes', self.notes[i]),
+            (u'creator_user_id', _uuid_str(self.creator_ids, i)),
+            (u'created', _isoformat(self.created[i])),
+            (u'modified', _isoformat(self.modified[i])),
+            (u'fingerprint', _fingerprint_str(self.fingerprints, i)),
+        ])
+
+    def __len__(self):
+        return len(self.created)
+
+
+class _Stale(object):
+    '''Marks a resource to reload, see VersionIndex.invalidate'''
+
+    __slots__ = ()
+
+
+def _key(resource_id):
+    try:
+        return _uuid_bytes(resource_id)
+    except ValueError:
+        return resource_id.encode(u'utf-8')
+
+
+def _uuid_bytes(value):
+    # Much faster than uuid.UUID for the usual hyphenated form
+    if len(value) == 36:
+        packed = bytes.fromhex(value.replace(u'-', u''))
+        if len(packed) == 16:
+            return packed
+    return uuid.UUID(value).bytes
+
+
+def _uuid_str(column, i):
+    h = column[i * 16:i * 16 + 16].hex()
+    return u'{}-{}-{}-{}-{}'.format(
+        h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _fingerprint_str(column, i):
+    packed = column[i * 32:i * 32 + 32]
+    return packed.hex() if packed != _NO_FINGERPRINT else None
+
+
+def _micros(value):
+    if value is None:
+        return _NULL_TIME
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def _isoformat(micros):
+    if micros == _NULL_TIME:
+        return None
+    return (_EPOCH + micros * _MICROSECOND).isoformat()
+
+
+_COLUMNS = [
+    Version.resource_id, Version.package_id, Version.id,
+    Version.activity_id, Version.name, Version.created, Version.notes,
+    Version.creator_user_id, Version.modified, Version.fingerprint,
+]
+
+
+def load_version_index(batch_size=10000):
+    '''
+    Builds a VersionIndex of all versions, read through a server-side
+    cursor, which reloads invalidated resources with
+    load_resource_versions.
+
+    The index records when it was built, in its built, refreshed and
+    refreshed_since attributes, which are used by refresh_version_index.
+    '''
+    started = datetime.utcnow()
+    query = select(_COLUMNS).\
+        where(Version.resource_id.isnot(None)).\
+        order_by(Version.resource_id, Version.created, Version.id)
+
+    def rows():
+        with model.meta.engine.connect() as conn:
+            result = conn.execution_options(
+                stream_results=True).execute(query)
+            while True:
+                batch = result.fetchmany(batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    yield tuple(row)
+
+    index = VersionIndex(rows(), loader=load_resource_versions)
+    index.built = index.refreshed = time.monotonic()
+    index.refreshed_since = started - _REFRESH_OVERLAP
+    log.info(u'Indexed %s versions of %s resources in %s bytes',
+             *[index.stats()[field]
+               for field in (u'versions', u'resources', u'bytes')])
+    return index
+
+
+def load_resource_versions(resource_id):
+    return [
+        tuple(row) for row in model.Session.query(*_COLUMNS).
+        filter(Version.resource_id == resource_id).
+        order_by(Version.created, Version.id)
+    ]
+
+
+def refresh_version_index(index):
+    '''
+    Invalidates the resources of the versions created or edited since the
+    index was built or last refreshed, by any process. Versions deleted by
+    other processes are only dropped when the index is built again.
+    '''
+    started = datetime.utcnow()
+    resource_ids = [
+        row[0] for row in model.Session.query(Version.resource_id).
+        filter(Version.modified >= index.refreshed_since).
+        filter(Version.resource_id.isnot(None)).
+        distinct()
+    ]
+    index.invalidate(*resource_ids)
+    index.refreshed = time.monotonic()
+    index.refreshed_since = started - _REFRESH_OVERLAP
@@ -0,0 +1,269 @@
+# encoding: utf-8
+
+'''
+Call counts, errors, SQL query counts and latency histograms of the actions,
+views and template helpers of the extension, rendered in the Prometheus text
+format
+'''
+
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from ckan.plugins import toolkit
+
+from ckanext.versions.lib import queries
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = u'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = None
+
+
+class Metrics(object):
+    '''
+    The metrics of one process, by kind ('action', 'view' or 'helper') and
+    name of the instrumented function.
+
+    If directory is given, a snapshot of the metrics is written there at
+    most once per dump_interval seconds, and collect merges the snapshots
+    of all processes sharing the directory. The snapshots of processes that
+    stopped are still added up, so that counters never go down, and the
+    directory must be emptied when CKAN restarts. A snapshot left by an
+    earlier process with the same pid is removed when the metrics are
+    created.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, directory=None,
+                 dump_interval=1.0):
+        self.buckets = tuple(buckets)
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self._calls = {}
+        self._queries = {}
+        self._errors = {}
+        self._durations = {}
+        self._lock = threading.Lock()
+        self._dumped = 0
+        if directory:
+            try:
+                os.remove(self._path())
+            except OSError:
+                pass
+
+    def observe(self, kind, name, seconds, queries=0, error=None):
+        key = (kind, name)
+        with self._lock:
+            self._calls[key] = self._calls.get(key, 0) + 1
+            self._queries[key] = self._queries.get(key, 0) + queries
+            if error is not None:
+                error_key = (kind, name, error)
+                self._errors[error_key] = self._errors.get(error_key, 0) + 1
+
+            # A count per bucket, a count above the last one and the sum
+            histogram = self._durations.get(key)
+            if histogram is None:
+                histogram = self._durations[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+        if self.directory and \
+                time.monotonic() - self._dumped >= self.dump_interval:
+            self.dump()
+
+    def snapshot(self):
+        '''
+        Returns the metrics as a dict that can be serialized to JSON and
+        passed to merge and render.
+        '''
+        with self._lock:
+            return {
+                u'buckets': list(self.buckets),
+                u'calls': [list(k) + [v] for k, v in self._calls.items()],
+                u'queries': [list(k) + [v] for k, v in self._queries.items()],
+                u'errors': [list(k) + [v] for k, v in self._errors.items()],
+                u'durations': [
+                    list(k) + [list(v)] for k, v in self._durations.items()],
+            }
+
+    def dump(self):
+        self._dumped = time.monotonic()
+        path = self._path()
+        try:
+            with open(path + u'.tmp', u'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(path + u'.tmp', path)
+        except (IOError, OSError) as e:
+            log.warning(u'Could not write metrics to %s: %s', path, e)
+
+    def collect(self):
+        '''
+        Returns the snapshot of this process, merged with the snapshots of
+        other processes if a directory is set.
+        '''
+        snapshot = self.snapshot()
+        if not self.directory:
+            return snapshot
+        own = self._path()
+        snapshots = [snapshot]
+        for path in glob.glob(os.path.join(self.directory, u'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                # Removed or being replaced by its process
+                continue
+        return merge(snapshots)
+
+    def _path(self):
+        return os.path.join(
+            self.directory, u'metrics-{}.json'.format(os.getpid()))
+
+
+def merge(snapshots):
+    '''
+    Adds up snapshots taken with the same buckets.
+    '''
+    merged = {}
+    for field in (u'calls', u'queries', u'errors', u'durations'):
+        totals = {}
+        for snapshot in snapshots:
+            for entry in snapshot[field]:
+                key, value = tuple(entry[:-1]), entry[-1]
+                if field == u'durations':
+                    total = totals.get(key)
+                    value = [a + b for a, b in zip(total, value)] \
+                        if total else list(value)
+                else:
+                    value = totals.get(key, 0) + value
+                totals[key] = value
+        merged[field] = [list(k) + [v] for k, v in sorted(totals.items())]
+    merged[u'buckets'] = snapshots[0][u'buckets'] if snapshots else \
+        list(DEFAULT_BUCKETS)
+    return merged
+
+
+def render(snapshot):
+    '''
+    Returns a snapshot in the Prometheus text exposition format.
+    '''
+    lines = []
+
+    def family(name, metric_type, help_text):
+        lines.append(u'# HELP {} {}'.format(name, help_text))
+        lines.append(u'# TYPE {} {}'.format(name, metric_type))
+
+    family(u'versions_calls_total', u'counter',
+           u'Calls of versions actions, views and helpers.')
+    for kind, name, value in sorted(snapshot[u'calls']):
+        lines.append(u'versions_calls_total{} {}'.format(
+            _labels(kind=kind, name=name), value))
+
+    family(u'versions_errors_total', u'counter',
+           u'Calls that raised an exception, by exception class.')
+    for kind, name, error, value in sorted(snapshot[u'errors']):
+        lines.append(u'versions_errors_total{} {}'.format(
+            _labels(kind=kind, name=name, error=error), value))
+
+    family(u'versions_queries_total', u'counter',
+           u'SQL statements run by calls.')
+    for kind, name, value in sorted(snapshot[u'queries']):
+        lines.append(u'versions_queries_total{} {}'.format(
+            _labels(kind=kind, name=name), value))
+
+    family(u'versions_duration_seconds', u'histogram',
+           u'Duration of calls.')
+    buckets = snapshot[u'buckets']
+    for kind, name, histogram in sorted(snapshot[u'durations']):
+        cumulative = 0
+        for bound, count in zip(buckets, histogram):
+            cumulative += count
+            lines.append(u'versions_duration_seconds_bucket{} {}'.format(
+                _labels(kind=kind, name=name, le=repr(float(bound))),
+                cumulative))
+        cumulative += histogram[len(buckets)]
+        lines.append(u'versions_duration_seconds_bucket{} {}'.format(
+            _labels(kind=kind, name=name, le=u'+Inf'), cumulative))
+        lines.append(u'versions_duration_seconds_sum{} {}'.format(
+            _labels(kind=kind, name=name), repr(float(histogram[-1]))))
+        lines.append(u'versions_duration_seconds_count{} {}'.format(
+            _labels(kind=kind, name=name), cumulative))
+
+    return u'\n'.join(lines) + u'\n'
+
+
+def _labels(**labels):
+    return u'{' + u','.join(
+        u'{}="{}"'.format(key, value.replace(u'\\', u'\\\\').replace(
+            u'"', u'\\"').replace(u'\n', u'\\n'))
+        for key, value in labels.items()) + u'}'
+
+
+def enabled():
+    return toolkit.asbool(
+        toolkit.config.get(u'ckanext.versions.metrics.enabled', False))
+
+
+def get_metrics():
+    '''
+    Returns the metrics of this process, shared through
+    ckanext.versions.metrics.multiprocess_dir if it is set.
+    '''
+    global _metrics
+    if _metrics is None:
+        directory = toolkit.config.get(
+            u'ckanext.versions.metrics.multiprocess_dir')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _metrics = Metrics(directory=directory)
+    return _metrics
+
+
+def instrument(kind, name, func):
+    '''
+    Wraps an action, view or helper so its calls are recorded while
+    ckanext.versions.metrics.enabled is set, and its SQL statements are
+    counted towards the current request while ckanext.versions.queries.debug
+    is set (see ckanext.versions.lib.queries). Attributes of func, such as
+    side_effect_free, are kept.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if queries.in_request():
+            with queries.tracking(name):
+                return _call(kind, name, func, args, kwargs)
+        return _call(kind, name, func, args, kwargs)
+    return wrapper
+
+
+def _call(kind, name, func, args, kwargs):
+    if not enabled():
+        return func(*args, **kwargs)
+    queries.install()
+    start_queries = queries.query_count()
+    start = time.perf_counter()
+    error = None
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        get_metrics().observe(
+            kind, name, time.perf_counter() - start,
+            queries.query_count() - start_queries, error)
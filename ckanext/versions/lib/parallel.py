@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+'''
+Helpers to spread batch jobs of the versions commands across a pool of
+worker processes
+'''
+
+import collections
+import logging
+import multiprocessing
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+
+def imap_batches(func, batches, workers=1):
+    '''
+    Calls func with each of the batches and yields the results in the same
+    order as the batches.
+
+    With more than one worker the calls are spread across a pool of forked
+    processes. At most two batches per worker are in flight at any time, so
+    batches can be produced lazily from a database query without loading
+    all of them up front. func and its results must be picklable.
+    '''
+    if workers <= 1:
+        for batch in batches:
+            yield func(batch)
+        return
+
+    # Forked workers must not share the parent's database connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    pool = multiprocessing.get_context('fork').Pool(
+        workers, initializer=_init_worker)
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(func, (batch,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _init_worker():
+    model.Session.remove()
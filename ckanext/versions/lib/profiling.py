@@ -0,0 +1,191 @@
+# encoding: utf-8
+
+'''
+Opt-in cProfile profiling of the actions and resource view hooks of the
+extension, for a fraction of calls or for requests sending a debug header,
+accumulated per function and written as pstats files
+'''
+
+import cProfile
+import functools
+import glob
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+from ckan.plugins import toolkit
+from flask import has_request_context, request
+
+log = logging.getLogger(__name__)
+
+HEADER = u'X-Versions-Profile'
+SORT_KEYS = (u'cumulative', u'tottime', u'calls')
+
+_profiler = None
+_local = threading.local()
+
+
+class Profiler(object):
+    '''
+    The profiles of one process, accumulated by name of the profiled
+    function.
+
+    If directory is given, the stats of a function are written there as
+    <name>.<pid>.prof at most once per dump_interval seconds, and report
+    adds up the files of all processes sharing the directory.
+    '''
+
+    def __init__(self, directory=None, dump_interval=10.0):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self._stats = {}
+        self._dumped = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, profile):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+        if self.directory and time.monotonic() - \
+                self._dumped.get(name, 0) >= self.dump_interval:
+            self.dump(name)
+
+    def names(self):
+        names = set(self._stats)
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, u'*.prof')):
+                names.add(os.path.basename(path).split(u'.')[0])
+        return sorted(names)
+
+    def dump(self, name):
+        self._dumped[name] = time.monotonic()
+        path = os.path.join(
+            self.directory, u'{}.{}.prof'.format(name, os.getpid()))
+        try:
+            with self._lock:
+                self._stats[name].dump_stats(path + u'.tmp')
+            os.rename(path + u'.tmp', path)
+        except (IOError, OSError) as e:
+            log.warning(u'Could not write profile to %s: %s', path, e)
+
+    def stats(self, name):
+        '''
+        Returns the pstats.Stats of name in this process, added to those
+        of other processes if a directory is set, or None.
+        '''
+        merged = pstats.Stats(stream=io.StringIO())
+        found = False
+        with self._lock:
+            if name in self._stats:
+                merged.add(self._stats[name])
+                found = True
+        if self.directory:
+            own = u'{}.{}.prof'.format(name, os.getpid())
+            pattern = os.path.join(self.directory, u'{}.*.prof'.format(name))
+            for path in glob.glob(pattern):
+                if os.path.basename(path) == own:
+                    continue
+                try:
+                    merged.add(path)
+                    found = True
+                except (IOError, OSError, EOFError, ValueError):
+                    # Removed or being replaced by its process
+                    continue
+        return merged if found else None
+
+    def report(self, names=None, sort=u'cumulative', limit=20):
+        '''
+        Returns the limit slowest functions of each profiled function, by
+        sort, as text.
+        '''
+        sections = []
+        for name in names or self.names():
+            stats = self.stats(name)
+            if stats is None:
+                continue
+            stats.stream.write(u'=== {} ===\n'.format(name))
+            stats.strip_dirs().sort_stats(sort).print_stats(limit)
+            sections.append(stats.stream.getvalue())
+        return u'\n'.join(sections)
+
+
+def enabled():
+    return toolkit.asbool(
+        toolkit.config.get(u'ckanext.versions.profiling.enabled', False))
+
+
+def get_profiler():
+    '''
+    Returns the profiler of this process, writing its stats to
+    ckanext.versions.profiling.directory if it is set.
+    '''
+    global _profiler
+    if _profiler is None:
+        directory = toolkit.config.get(u'ckanext.versions.profiling.directory')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _profiler = Profiler(directory=directory)
+    return _profiler
+
+
+def requested():
+    '''
+    Whether the current request sends the X-Versions-Profile header with the
+    token set in ckanext.versions.profiling.token.
+    '''
+    token = toolkit.config.get(u'ckanext.versions.profiling.token')
+    if not token or not has_request_context():
+        return False
+    return hmac.compare_digest(request.headers.get(HEADER, u''), token)
+
+
+def _sampled():
+    rate = float(toolkit.config.get(u'ckanext.versions.profiling.rate', 0))
+    return rate > 0 and random.random() < rate
+
+
+def profile(name, func):
+    '''
+    Wraps an action or plugin hook so that, while
+    ckanext.versions.profiling.enabled is set, a fraction of its calls
+    (ckanext.versions.profiling.rate) and its calls in requests asking for
+    it (see requested) are profiled. Calls made from a profiled call are
+    part of its profile and are not profiled on their own. Attributes of
+    func, such as side_effect_free, are kept.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, u'active', False) or not enabled() or \
+                not (requested() or _sampled()):
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is running, in this or another thread
+            return func(*args, **kwargs)
+        _local.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _local.active = False
+            get_profiler().record(name, profiler)
+    return wrapper
+
+
+def profiled(name):
+    '''
+    Decorator version of profile, for methods.
+    '''
+    return functools.partial(profile, name)
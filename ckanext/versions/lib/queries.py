@@ -0,0 +1,181 @@
+# encoding: utf-8
+
+'''
+Counting of the SQL statements run by each thread, through SQLAlchemy
+engine events, used by the metrics of the extension, to warn about requests
+that run too many statements and by the query budgets of the tests
+'''
+
+import contextlib
+import logging
+import re
+import threading
+from collections import Counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+_installed = False
+
+
+def install():
+    '''
+    Starts counting the statements run by every engine. Calling it again
+    has no effect.
+    '''
+    global _installed
+    with _lock:
+        if not _installed:
+            event.listen(Engine, u'before_cursor_execute', _count)
+            _installed = True
+
+
+def query_count():
+    '''
+    Returns the number of statements run by the current thread since
+    install was called. Callers take the difference between two counts.
+    '''
+    return getattr(_local, u'count', 0)
+
+
+class QueryScope(object):
+    '''
+    The SQL statements run by a thread while the scope is active, see
+    scope. Statements are recorded without their parameters, so the same
+    query run for different rows is recorded as the same statement.
+    '''
+
+    def __init__(self):
+        self.statements = []
+        # Statements by function, for requests (see tracking)
+        self.counts = {}
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def touching(self, table):
+        '''
+        Returns the number of statements that mention table.
+        '''
+        pattern = re.compile(r'\b{}\b'.format(re.escape(table)))
+        return sum(1 for statement in self.statements
+                   if pattern.search(statement))
+
+    def repeated(self, times):
+        '''
+        Returns (statement, count) pairs of the statements run at least
+        times times, most repeated first.
+        '''
+        return [(statement, count) for statement, count in
+                Counter(self.statements).most_common() if count >= times]
+
+    def report(self, limit=5):
+        lines = [u'{} SQL statements'.format(self.count)]
+        for statement, count in self.repeated(2)[:limit]:
+            lines.append(u'  {} x {}'.format(count, _shorten(statement)))
+        return u'\n'.join(lines)
+
+
+@contextlib.contextmanager
+def scope(query_scope=None):
+    '''
+    Records the statements run by the current thread inside the block in
+    a QueryScope, which is returned. Scopes can be nested.
+    '''
+    install()
+    if query_scope is None:
+        query_scope = QueryScope()
+    scopes = _scopes()
+    scopes.append(query_scope)
+    try:
+        yield query_scope
+    finally:
+        scopes.remove(query_scope)
+
+
+def start_request():
+    '''
+    Starts counting the statements run by the tracked functions of the
+    current request, see tracking and finish_request.
+    '''
+    install()
+    _local.request = QueryScope()
+    _local.tracking = False
+
+
+def in_request():
+    return getattr(_local, u'request', None) is not None
+
+
+@contextlib.contextmanager
+def tracking(name):
+    '''
+    Counts the statements run inside the block, usually a call of the
+    action or helper called name, towards the current request if one was
+    started. Nested blocks count towards the outermost one.
+    '''
+    request = getattr(_local, u'request', None)
+    if request is None or _local.tracking:
+        yield
+        return
+    _local.tracking = True
+    start = request.count
+    try:
+        with scope(request):
+            yield
+    finally:
+        _local.tracking = False
+        request.counts[name] = \
+            request.counts.get(name, 0) + request.count - start
+
+
+def finish_request(label, threshold, repeat_threshold):
+    '''
+    Ends the current request, logging a warning if the tracked functions
+    ran more than threshold statements, and another one for every
+    statement they ran repeat_threshold times or more, which usually means
+    a query is run once per item of a list (an N+1 pattern).
+
+    Returns the QueryScope of the request.
+    '''
+    request = getattr(_local, u'request', None)
+    _local.request = None
+    if request is None:
+        return None
+
+    if request.count > threshold:
+        log.warning(
+            u'%s ran %s SQL statements in versions actions and helpers '
+            u'(threshold %s): %s', label, request.count, threshold,
+            u', '.join(u'{} {}'.format(name, count) for name, count in
+                       sorted(request.counts.items(),
+                              key=lambda item: -item[1])))
+    for statement, count in request.repeated(repeat_threshold):
+        log.warning(
+            u'%s ran the same SQL statement %s times, a possible N+1 '
+            u'pattern: %s', label, count, _shorten(statement))
+    return request
+
+
+def _scopes():
+    if not hasattr(_local, u'scopes'):
+        _local.scopes = []
+    return _local.scopes
+
+
+def _shorten(statement, length=200):
+    statement = u' '.join(statement.split())
+    if len(statement) > length:
+        statement = statement[:length] + u'...'
+    return statement
+
+
+def _count(conn, cursor, statement, parameters, context, executemany):
+    _local.count = getattr(_local, u'count', 0) + 1
+    for query_scope in getattr(_local, u'scopes', ()):
+        query_scope.statements.append(statement)
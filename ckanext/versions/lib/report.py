@@ -0,0 +1,146 @@
+# encoding: utf-8
+
+'''
+Functions to summarize the changes of many datasets at once, either between
+the last two versions of each dataset or between two dates
+'''
+
+import json
+import logging
+
+from ckan import model
+from sqlalchemy import func
+
+from ckanext.versions.lib.changes import (
+    check_metadata_changes, check_resource_changes)
+from ckanext.versions.model import Version
+
+log = logging.getLogger(__name__)
+
+CSV_FIELDS = (
+    u'package_id', u'package_name', u'old_activity_id', u'new_activity_id',
+    u'old_timestamp', u'new_timestamp', u'type', u'change')
+
+
+def report_packages(package_ids, since=None, until=None):
+    '''
+    Returns the changes of a batch of datasets as a list of dicts, one per
+    dataset that changed, each one with the ids and timestamps of the two
+    activities compared and the list of changes between them.
+
+    By default each dataset is compared between the activities of its last
+    two versions. If since is given, it is compared between the latest
+    activities at since and at until (or now), and datasets created after
+    since are left out. The activities of the whole batch are loaded with a
+    single query.
+    '''
+    if since is None:
+        pairs = _last_two_versions(package_ids)
+    else:
+        old = _latest_activities(package_ids, since)
+        new = _latest_activities(package_ids, until)
+        pairs = {
+            package_id: (old[package_id], new[package_id])
+            for package_id in package_ids
+            if package_id in old and package_id in new
+        }
+    pairs = {
+        package_id: pair for package_id, pair in pairs.items()
+        if pair[0] != pair[1]
+    }
+
+    activity_ids = {
+        activity_id for pair in pairs.values() for activity_id in pair}
+    activities = {}
+    if activity_ids:
+        for activity_id, timestamp, data in model.Session.query(
+                model.Activity.id, model.Activity.timestamp,
+                model.Activity.data
+        ).filter(model.Activity.id.in_(activity_ids)):
+            activities[activity_id] = (
+                timestamp, (data or {}).get('package') or {})
+    model.Session.remove()
+
+    reports = []
+    for package_id in package_ids:
+        if package_id not in pairs:
+            continue
+        old_activity_id, new_activity_id = pairs[package_id]
+        if old_activity_id not in activities or \
+                new_activity_id not in activities:
+            log.warning('Skipping dataset %s, the activities to compare '
+                        'were not found', package_id)
+            continue
+        old_timestamp, old = activities[old_activity_id]
+        new_timestamp, new = activities[new_activity_id]
+
+        change_list = []
+        check_metadata_changes(change_list, old, new)
+        check_resource_changes(change_list, old, new, old_activity_id)
+        if not change_list:
+            continue
+        reports.append({
+            u'package_id': package_id,
+            u'package_name': new.get(u'name'),
+            u'old_activity_id': old_activity_id,
+            u'new_activity_id': new_activity_id,
+            u'old_timestamp': old_timestamp.isoformat(),
+            u'new_timestamp': new_timestamp.isoformat(),
+            u'changes': change_list,
+        })
+    return reports
+
+
+def csv_rows(report):
+    '''
+    Yields the rows of a dataset report from report_packages, one per
+    change, with the values of CSV_FIELDS. The change itself is written as
+    JSON.
+    '''
+    for change in report[u'changes']:
+        yield [report[field] for field in CSV_FIELDS[:-2]] + \
+            [change[u'type'], json.dumps(change)]
+
+
+def _last_two_versions(package_ids):
+    # Versions are per resource, so several of them may share an activity
+    latest = model.Session.query(
+        Version.package_id.label('package_id'),
+        Version.activity_id.label('activity_id'),
+        func.max(Version.created).label('created')
+    ).filter(Version.package_id.in_(package_ids)).\
+        group_by(Version.package_id, Version.activity_id).subquery()
+    ranked = model.Session.query(
+        latest.c.package_id, latest.c.activity_id,
+        func.row_number().over(
+            partition_by=latest.c.package_id,
+            order_by=latest.c.created.desc()
+        ).label('rank')
+    ).subquery()
+
+    pairs = {}
+    for package_id, activity_id, rank in model.Session.query(
+            ranked.c.package_id, ranked.c.activity_id, ranked.c.rank
+    ).filter(ranked.c.rank <= 2):
+        pairs.setdefault(package_id, [None, None])[2 - rank] = activity_id
+    return {
+        package_id: tuple(pair) for package_id, pair in pairs.items()
+        if pair[0] is not None
+    }
+
+
+def _latest_activities(package_ids, before=None):
+    query = model.Session.query(
+        model.Activity.object_id.label('object_id'),
+        model.Activity.id.label('id'),
+        func.row_number().over(
+            partition_by=model.Activity.object_id,
+            order_by=model.Activity.timestamp.desc()
+        ).label('rank')
+    ).filter(model.Activity.object_id.in_(package_ids))
+    if before is not None:
+        query = query.filter(model.Activity.timestamp <= before)
+    ranked = query.subquery()
+
+    return dict(model.Session.query(ranked.c.object_id, ranked.c.id).
+                filter(ranked.c.rank == 1))
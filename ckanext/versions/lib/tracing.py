@@ -0,0 +1,280 @@
+# encoding: utf-8
+
+'''
+Tracing spans around the nested calls of the version actions, through a
+small subset of the OpenTelemetry tracing API, exported to a JSON lines file
+or kept in memory, or handed to OpenTelemetry when it is installed
+'''
+
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+EXPORTERS = (u'file', u'memory', u'opentelemetry')
+# Keys of the data dicts of traced actions recorded as span attributes
+DATA_ATTRIBUTES = (u'resource_id', u'activity_id', u'version_id')
+
+_DEFAULT_FILE = u'ckanext-versions-spans.jsonl'
+
+_tracers = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span(object):
+    '''
+    A timed operation, with the methods of OpenTelemetry spans used by the
+    extension. Times are nanoseconds since the epoch.
+    '''
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = u'{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = u'OK'
+        self.start_time = _now()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def is_recording(self):
+        return self.end_time is None
+
+    def record_exception(self, exception):
+        self.status = u'ERROR'
+        self.attributes[u'exception.type'] = type(exception).__name__
+        self.attributes[u'exception.message'] = str(exception)
+
+    def end(self):
+        self.end_time = _now()
+
+    def as_dict(self):
+        return {
+            u'name': self.name,
+            u'trace_id': self.trace_id,
+            u'span_id': self.span_id,
+            u'parent_id': self.parent_id,
+            u'start_time': self.start_time,
+            u'end_time': self.end_time,
+            u'duration_ms': (self.end_time - self.start_time) / 1e6,
+            u'status': self.status,
+            u'attributes': self.attributes,
+        }
+
+
+class _NonRecordingSpan(object):
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def is_recording(self):
+        return False
+
+    def record_exception(self, exception):
+        pass
+
+
+_NON_RECORDING_SPAN = _NonRecordingSpan()
+
+
+class Tracer(object):
+    '''
+    Creates spans nested in the current span of the thread, and passes them
+    to exporter when they end.
+    '''
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        stack = _span_stack()
+        parent = stack[-1] if stack else None
+        span = Span(
+            name,
+            parent.trace_id if parent else
+            u'{:032x}'.format(random.getrandbits(128)),
+            parent.span_id if parent else None,
+            attributes)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.record_exception(e)
+            raise
+        finally:
+            stack.pop()
+            span.end()
+            try:
+                self.exporter.export(span)
+            except Exception:
+                log.warning(u'Could not export span %s', name, exc_info=True)
+
+
+class _NonRecordingTracer(object):
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        yield _NON_RECORDING_SPAN
+
+
+_NON_RECORDING_TRACER = _NonRecordingTracer()
+
+
+class InMemorySpanExporter(object):
+    '''
+    Keeps the last max_spans spans, for tests and debugging.
+    '''
+
+    def __init__(self, max_spans=10000):
+        self._spans = collections.deque(maxlen=max_spans)
+
+    def export(self, span):
+        self._spans.append(span)
+
+    def get_finished_spans(self):
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+
+class FileSpanExporter(object):
+    '''
+    Appends spans to a file, one JSON object per line. Processes can share
+    the file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str) + u'\n'
+        with self._lock:
+            with open(self.path, u'a') as f:
+                f.write(line)
+
+
+def enabled():
+    return toolkit.asbool(
+        toolkit.config.get(u'ckanext.versions.tracing.enabled', False))
+
+
+def get_tracer():
+    '''
+    Returns the tracer set with ckanext.versions.tracing.exporter, or a
+    tracer that records nothing when tracing is not enabled.
+    '''
+    if not enabled():
+        return _NON_RECORDING_TRACER
+    exporter = toolkit.config.get(
+        u'ckanext.versions.tracing.exporter', u'file')
+    tracer = _tracers.get(exporter)
+    if tracer is None:
+        with _lock:
+            tracer = _tracers.get(exporter)
+            if tracer is None:
+                tracer = _tracers[exporter] = _create_tracer(exporter)
+    return tracer
+
+
+def _create_tracer(exporter):
+    if exporter == u'opentelemetry':
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            log.error(u'ckanext.versions.tracing.exporter is opentelemetry '
+                      u'but the opentelemetry-api package is not installed')
+            return _NON_RECORDING_TRACER
+        return trace.get_tracer(u'ckanext.versions')
+    if exporter == u'memory':
+        return Tracer(InMemorySpanExporter())
+    if exporter == u'file':
+        path = toolkit.config.get(u'ckanext.versions.tracing.file') or \
+            os.path.join(tempfile.gettempdir(), _DEFAULT_FILE)
+        return Tracer(FileSpanExporter(path))
+    raise ValueError(
+        u'ckanext.versions.tracing.exporter must be one of {}'.format(
+            u', '.join(EXPORTERS)))
+
+
+def span(name, **attributes):
+    '''
+    Starts a span as a context manager, with attributes prefixed with
+    "versions.".
+    '''
+    return get_tracer().start_as_current_span(
+        name, attributes={u'versions.' + key: value
+                          for key, value in attributes.items()})
+
+
+def current_span():
+    '''
+    Returns the innermost span of the thread, which records nothing if
+    there is none.
+    '''
+    if enabled() and toolkit.config.get(
+            u'ckanext.versions.tracing.exporter') == u'opentelemetry':
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            return _NON_RECORDING_SPAN
+        return trace.get_current_span()
+    stack = _span_stack()
+    return stack[-1] if stack else _NON_RECORDING_SPAN
+
+
+def payload_size(value):
+    '''
+    Returns the size of value serialized to JSON, as a span attribute.
+    '''
+    return len(json.dumps(value, default=str))
+
+
+def traced(name):
+    '''
+    Decorator running an action, called with (context, data_dict), in a
+    span with the ids in its data dict (see DATA_ATTRIBUTES) as attributes.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(context, data_dict, *args, **kwargs):
+            attributes = {
+                key: data_dict[key] for key in DATA_ATTRIBUTES
+                if isinstance(data_dict, dict) and data_dict.get(key)
+            }
+            with span(name, **attributes):
+                return func(context, data_dict, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _now():
+    return int(time.time() * 1e9)
+
+
+def _span_stack():
+    if not hasattr(_local, u'spans'):
+        _local.spans = []
+    return _local.spans
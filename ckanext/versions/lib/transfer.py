@@ -0,0 +1,181 @@
+# encoding: utf-8
+
+'''
+Functions to export the version table to newline delimited JSON (NDJSON)
+and to import it back, keeping memory use constant regardless of the size
+of the table
+'''
+
+import gzip
+import io
+import json
+import logging
+import sys
+from datetime import datetime
+
+from ckan import model
+from dateutil.parser import parse as parse_date
+from sqlalchemy import DateTime, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from ckanext.versions.model import Version
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Rows are upserted on the unique (package_id, resource_id, name) constraint
+_CONFLICT_COLUMNS = ('package_id', 'resource_id', 'name')
+
+
+class _UnclosedTextIOWrapper(io.TextIOWrapper):
+    '''
+    A text wrapper of stdin or stdout that leaves them open when it is
+    closed.
+    '''
+    _detached = False
+
+    def close(self):
+        if not self._detached:
+            self._detached = True
+            self.flush()
+            self.detach()
+
+
+def open_ndjson(path, mode, compress=None):
+    '''
+    Opens path for reading (mode 'r') or writing (mode 'w') as text. A path
+    of '-' stands for stdin or stdout. Files are gzip compressed if compress
+    is True, or if it is None and the path ends with '.gz'.
+    '''
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path == '-':
+        stream = sys.stdin.buffer if mode == 'r' else sys.stdout.buffer
+        if compress:
+            return gzip.open(stream, mode + 't', encoding='utf-8')
+        return _UnclosedTextIOWrapper(stream, encoding='utf-8')
+    if compress:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+def export_versions(f, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Writes every row of the version table to the file object f, one JSON
+    object per line, and returns the number of rows written.
+
+    Rows are read through a server-side cursor, batch_size rows at a time.
+    '''
+    table = Version.__table__
+    count = 0
+    with model.meta.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            select([table]).order_by(table.c.id))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                f.write(json.dumps(_row_to_dict(row)))
+                f.write(u'\n')
+            count += len(rows)
+    return count
+
+
+def import_versions(f, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Reads versions written by export_versions from the file object f and
+    upserts them with multi-row INSERTs, batch_size rows at a time, and
+    returns the number of rows read.
+
+    A row updates the existing version with the same id if there is one,
+    and otherwise the existing version with the same package, resource and
+    name. Versions without a resource, from older releases, are only
+    matched by id, as the unique constraint does not apply to them. Raises
+    ValueError if a row would give a version the package, resource and name
+    of another one.
+
+    Each batch is committed on its own. Importing the same file again is
+    harmless, so an interrupted import can simply be restarted.
+    '''
+    table = Version.__table__
+    columns = {col.name for col in table.c}
+    date_columns = {
+        col.name for col in table.c if isinstance(col.type, DateTime)}
+
+    count = 0
+    batch = []
+    with model.meta.engine.connect() as conn:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError(
+                    'Invalid JSON on line {}'.format(line_number))
+            row = {k: v for k, v in row.items() if k in columns}
+            for name in date_columns:
+                if row.get(name):
+                    row[name] = parse_date(row[name])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                count += _upsert_batch(conn, table, batch)
+                batch = []
+        if batch:
+            count += _upsert_batch(conn, table, batch)
+    return count
+
+
+def _upsert_batch(conn, table, batch):
+    ids = [row['id'] for row in batch if row.get('id')]
+    existing = set()
+    if ids:
+        existing = {row[0] for row in conn.execute(
+            select([table.c.id]).where(table.c.id.in_(ids)))}
+
+    # A statement cannot update the same row twice, so the last of the
+    # rows with the same key wins
+    by_id = {}
+    by_name = {}
+    for row in batch:
+        if row.get('id') in existing or row.get('resource_id') is None:
+            by_id[row.get('id') or object()] = row
+        else:
+            by_name[tuple(row.get(name) for name in _CONFLICT_COLUMNS)] = row
+
+    try:
+        with conn.begin():
+            if by_id:
+                _upsert(conn, table, list(by_id.values()), ('id',))
+            if by_name:
+                _upsert(conn, table, list(by_name.values()),
+                        _CONFLICT_COLUMNS)
+    except IntegrityError as e:
+        raise ValueError(
+            'Versions conflict with another version of the same dataset, '
+            'resource and name: {}'.format(e.orig))
+    return len(batch)
+
+
+def _upsert(conn, table, rows, conflict_columns):
+    stmt = insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(conflict_columns),
+        set_={
+            name: stmt.excluded[name] for name in rows[0]
+            if name not in conflict_columns and name != 'id'
+        }
+    )
+    conn.execute(stmt)
+
+
+def _row_to_dict(row):
+    _dict = {}
+    for key, value in row.items():
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        _dict[key] = value
+    return _dict
@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+'''
+Functions to check that every version still points to an activity that
+contains its resource
+'''
+
+import logging
+
+from ckan import model
+from sqlalchemy import select
+
+from ckanext.versions.model import Version
+
+log = logging.getLogger(__name__)
+
+ACTIVITY_NOT_FOUND = u'activity_not_found'
+RESOURCE_NOT_IN_ACTIVITY = u'resource_not_in_activity'
+
+
+def iter_version_batches(batch_size):
+    '''
+    Yields lists of versions, as (id, package_id, resource_id, activity_id)
+    tuples, read through a server-side cursor in activity order.
+
+    Versions of the same activity are never split across batches, so each
+    batch can be checked loading every activity only once. A batch may hold
+    more than batch_size versions if many of them share an activity.
+    '''
+    table = Version.__table__
+    query = select([
+        table.c.id, table.c.package_id,
+        table.c.resource_id, table.c.activity_id
+    ]).order_by(table.c.activity_id, table.c.id)
+
+    with model.meta.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        batch = []
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if len(batch) >= batch_size and \
+                        batch[-1][3] != row.activity_id:
+                    yield batch
+                    batch = []
+                batch.append(tuple(row))
+        if batch:
+            yield batch
+
+
+def verify_versions(versions):
+    '''
+    Checks a batch of versions from iter_version_batches against their
+    activities, which are loaded with a single query.
+
+    Returns a dict with the number of versions checked and the list of
+    broken versions, each one with a problem field that is either
+    activity_not_found or resource_not_in_activity.
+
+    Versions without a resource, created by older releases, are only
+    checked for a missing activity.
+    '''
+    activity_ids = {version[3] for version in versions}
+    activities = model.Session.query(
+        model.Activity.id, model.Activity.data
+    ).filter(model.Activity.id.in_(activity_ids))
+
+    resources_in_activity = {}
+    for activity_id, data in activities:
+        package = (data or {}).get('package') or {}
+        resources_in_activity[activity_id] = {
+            res['id'] for res in package.get('resources') or []
+        }
+    model.Session.remove()
+
+    broken = []
+    for version_id, package_id, resource_id, activity_id in versions:
+        if activity_id not in resources_in_activity:
+            problem = ACTIVITY_NOT_FOUND
+        elif resource_id is not None and \
+                resource_id not in resources_in_activity[activity_id]:
+            problem = RESOURCE_NOT_IN_ACTIVITY
+        else:
+            continue
+        broken.append({
+            u'version_id': version_id,
+            u'package_id': package_id,
+            u'resource_id': resource_id,
+            u'activity_id': activity_id,
+            u'problem': problem,
+        })
+
+    return {'checked': len(versions), 'broken': broken}
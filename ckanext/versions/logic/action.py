@@ -1,19 +1,65 @@
 # encoding: utf-8
+import copy
+import csv
 import difflib
+import ipaddress
 import json
 import logging
+import os
 import re
-from datetime import datetime
-
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urljoin, urlparse
+
+import requests
+from ckan import authz
 from ckan import model as core_model
+from ckan.lib import uploader
 from ckan.logic.action.get import resource_show as core_resource_show
 from ckan.plugins import toolkit
+from dateutil import tz
+from dateutil.parser import parse as parse_date
+from sqlalchemy import func, tuple_
 from sqlalchemy.exc import IntegrityError
 
-from ckanext.versions.model import Version
+from ckanext.versions.lib import datadiff
+from ckanext.versions.lib import diff as json_diff
+from ckanext.versions.lib import tracing
+from ckanext.versions.lib.cache import (
+    LRUCache, MmapCache, RedisCache, TwoTierCache)
+from ckanext.versions.lib.changes import (
+    check_metadata_changes, check_resource_changes, check_version_changes)
+from ckanext.versions.lib.fingerprint import resource_fingerprint
+from ckanext.versions.lib.index import (
+    load_version_index, refresh_version_index)
+from ckanext.versions.model import Version, VersionChange
 
 log = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 1000
+# Activities read at a time by resource_history
+HISTORY_BATCH_SIZE = 100
+DEFAULT_FEED_LIMIT = 100
+MAX_FEED_LIMIT = 1000
+MAX_DATA_REDIRECTS = 5
+# Fields of an upload that change with its file, see _open_upload
+_UPLOAD_FILE_FIELDS = ('url', 'size', 'hash', 'last_modified')
+DIFF_TYPES = ('unified', 'context', 'html', 'json_patch')
+IF_UNCHANGED_OPTIONS = ('create', 'skip', 'error')
+# Defaults for the parts missing from timestamps, see _parse_timestamp
+_PERIOD_START = datetime(1, 1, 1)
+_PERIOD_END = datetime(9999, 12, 31, 23, 59, 59, 999999)
+_TIMESTAMP_PARTS = (
+    'year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond')
+
+_compare_cache = None
+_version_cache = None
+_version_index = None
+_version_index_lock = threading.Lock()
+
 
 def _get_creator_user_id(data_dict, model, context):
     """ Returns the id of the user that creates the version.
@@ -89,6 +135,7 @@ def resource_version_patch(context, data_dict):
         )
 
     log.info('Version "%s" with id %s patched correctly', version.name, version_id)
+    _invalidate_versions(version.resource_id, version.id)
 
     return version.as_dict()
 
@@ -150,10 +197,12 @@ def resource_version_update(context, data_dict):
         )
 
     log.info('Version "%s" with id %s updated correctly', version.name, version_id)
+    _invalidate_versions(version.resource_id, version.id)
 
     return version.as_dict()
 
 
+@tracing.traced('resource_version_create')
 def resource_version_create(context, data_dict):
     """Create a new version from the current dataset's activity_id
 
@@ -169,6 +218,11 @@ def resource_version_create(context, data_dict):
     :type notes: string
     :param creator_user_id optional: the id of the creator
     :type creator_user_id: string
+    :param if_unchanged optional: what to do when the resource is identical
+        to its newest version, as told by their fingerprints: 'create' a new
+        version anyway, 'skip' it and return the newest version, or raise an
+        'error' (default: 'create')
+    :type if_unchanged: string
     :returns: the newly created version
     :rtype: dictionary
     """
@@ -176,6 +230,10 @@ def resource_version_create(context, data_dict):
 
     resource_id, name = toolkit.get_or_bust(
         data_dict, ['resource_id', 'name'])
+    if_unchanged = data_dict.get('if_unchanged') or 'create'
+    if if_unchanged not in IF_UNCHANGED_OPTIONS:
+        raise toolkit.ValidationError({'if_unchanged': [
+            'Must be one of {}'.format(', '.join(IF_UNCHANGED_OPTIONS))]})
 
     resource = model.Resource.get(resource_id)
     if not resource:
@@ -186,16 +244,42 @@ def resource_version_create(context, data_dict):
 
     creator_user_id = _get_creator_user_id(data_dict, model, context)
 
-    activity = model.Session.query(model.Activity). \
-        filter_by(object_id=resource.package_id). \
-        order_by(model.Activity.timestamp.desc()). \
-        first()
+    with tracing.span('latest_activity',
+                      package_id=resource.package_id) as span:
+        activity = model.Session.query(model.Activity). \
+            filter_by(object_id=resource.package_id). \
+            order_by(model.Activity.timestamp.desc()). \
+            first()
+
+        if not activity:
+            raise toolkit.ObjectNotFound('Activity not found')
+
+        package = (activity.data or {}).get('package') or {}
+        if span.is_recording():
+            span.set_attributes({
+                'versions.activity_id': activity.id,
+                'versions.payload_bytes': tracing.payload_size(package),
+            })
+    resource_dict = next((res for res in package.get('resources') or []
+                          if res['id'] == resource_id), None)
+    if resource_dict is None:
+        raise toolkit.ObjectNotFound('Resource not found in the activity.')
+    fingerprint = resource_fingerprint(resource_dict)
 
-    if not activity:
-        raise toolkit.ObjectNotFound('Activity not found')
+    previous_version = model.Session.query(Version).\
+        filter(Version.resource_id == resource_id).\
+        order_by(Version.created.desc()).\
+        first()
 
-    if not resource_in_activity(context, {'activity_id': activity.id, 'resource_id': resource_id}):
-        raise toolkit.ObjectNotFound('Resource not found in the activity.')
+    if previous_version and previous_version.fingerprint == fingerprint \
+            and if_unchanged != 'create':
+        if if_unchanged == 'skip':
+            log.info('Resource %s unchanged since version "%s", skipping',
+                     resource_id, previous_version.name)
+            return previous_version.as_dict()
+        raise toolkit.ValidationError({'resource_id': [
+            'The resource has not changed since version "{}"'.format(
+                previous_version.name)]})
 
     version = Version(
         package_id=resource.package_id,
@@ -204,7 +288,8 @@ def resource_version_create(context, data_dict):
         name=name,
         notes=data_dict.get('notes', None),
         created=datetime.utcnow(),
-        creator_user_id=creator_user_id)
+        creator_user_id=creator_user_id,
+        fingerprint=fingerprint)
 
     model.Session.add(version)
 
@@ -223,11 +308,47 @@ def resource_version_create(context, data_dict):
         data_dict['name'],
         data_dict['resource_id']
         )
+    _invalidate_versions(resource_id)
 
-    return version.as_dict()
+    version_dict = version.as_dict()
+    try:
+        _record_version_change(model, version, previous_version)
+    except Exception:
+        # The version itself is already saved, the change list can be
+        # computed later with `ckan versions backfill-changes`
+        model.Session.rollback()
+        log.warning('Could not compute the changes of version %s',
+                    version_dict['id'], exc_info=True)
+
+    return version_dict
+
+
+def _record_version_change(model, version, previous_version):
+    """Save the changes introduced by `version` since `previous_version`.
+    """
+    with tracing.span('record_version_change', version_id=version.id):
+        _save_version_change(model, version, previous_version)
+
+
+def _save_version_change(model, version, previous_version):
+    changes = []
+    if previous_version and \
+            previous_version.activity_id != version.activity_id:
+        old_package, new_package = _get_activity_packages(
+            previous_version.activity_id, version.activity_id)
+        changes = check_version_changes(
+            old_package, new_package, previous_version.activity_id,
+            version.resource_id)
+
+    model.Session.add(VersionChange(
+        version_id=version.id,
+        previous_version_id=previous_version.id if previous_version else None,
+        changes=json.dumps(changes)))
+    model.Session.commit()
 
 
 @toolkit.side_effect_free
+@tracing.traced('resource_version_list')
 def resource_version_list(context, data_dict):
     """List versions of a given resource
 
@@ -238,28 +359,57 @@ def resource_version_list(context, data_dict):
     """
     model = context.get('model', core_model)
     resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
-    resource = model.Resource.get(resource_id)
-    if not resource:
-        raise toolkit.ObjectNotFound('Resource not found')
+    package_id, versions = _get_resource_versions(model, resource_id, 'list')
 
     toolkit.check_access('version_list', context,
-                         {"package_id": resource.package_id})
+                         {"package_id": package_id})
 
-    versions = model.Session.query(Version).\
-        filter(Version.resource_id == resource.id).\
-        order_by(Version.created.desc())
+    tracing.current_span().set_attribute('versions.count', len(versions))
+    return versions
 
-    if not versions:
-        raise toolkit.ObjectNotFound('Versions not found for this resource')
 
-    return [v.as_dict() for v in versions]
+def _get_resource_versions(model, resource_id, kind):
+    """Returns the dataset id of a resource and either the list of its
+    versions, newest first, or its current version, depending on `kind`
+    ('list' or 'current'). Both are cached, see `_get_version_cache`.
+    """
+    cache = _get_version_cache()
+    key = '{}:{}'.format(kind, resource_id)
+    cached = cache.get(key) if cache is not None else None
+    if cached is None:
+        resource = model.Resource.get(resource_id)
+        if not resource:
+            raise toolkit.ObjectNotFound('Resource not found')
+
+        # Versions created at the same time are ordered by id, like in the
+        # version index
+        versions = model.Session.query(Version).\
+            filter(Version.resource_id == resource.id).\
+            order_by(Version.created.desc(), Version.id.desc())
+        if kind == 'current':
+            version = versions.first()
+            value = version.as_dict() if version else None
+        else:
+            value = [v.as_dict() for v in versions]
+
+        cached = {'package_id': resource.package_id, 'value': value}
+        if cache is not None:
+            cache.set(key, cached)
+    return cached['package_id'], cached['value']
 
 
 def resource_version_clear(context, data_dict):
     """Delete all versions for a given resource
 
+    Versions are deleted in batches of `batch_size`, each one committed on
+    its own, so clearing a long history does not hold locks on the whole
+    set in a single transaction.
+
     :param resource_id: the id the resource
     :type resource_id: string
+    :param batch_size optional: number of versions deleted per transaction
+        (default: 1000)
+    :type batch_size: int
     """
     model = context.get('model', core_model)
     resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
@@ -270,14 +420,252 @@ def resource_version_clear(context, data_dict):
     toolkit.check_access('resource_version_clear', context,
                          {"package_id": resource.package_id})
 
-    versions = model.Session.query(Version).\
-        filter(Version.resource_id == resource.id).\
-        delete()
+    batch_size = _get_int(data_dict, 'batch_size', DEFAULT_BATCH_SIZE)
+    query = model.Session.query(Version).\
+        filter(Version.resource_id == resource.id)
+
+    deleted = 0
+    cursor = None
+    while True:
+        batch_deleted, cursor = _delete_batch(
+            model.Session, query, batch_size, cursor)
+        deleted += batch_deleted
+        if cursor is None:
+            break
 
-    if not versions:
+    if not deleted:
         raise toolkit.ObjectNotFound('Versions not found for this resource')
 
-    model.Session.commit()
+    log.info('%d versions deleted for resource %s', deleted, resource.id)
+
+
+def version_prune(context, data_dict):
+    """Delete old versions following a retention policy
+
+    Versions are walked in `(resource_id, created)` order and deleted in
+    batches of `batch_size`, each one committed on its own. Deleted versions
+    never match the policy again, so an interrupted prune is resumed by
+    running it again; passing back the returned `cursor` skips the part of
+    the table that was already walked.
+
+    At least one of `keep_last` or `older_than` must be provided. When both
+    are given, only versions matching both conditions are deleted.
+
+    Pruning the whole site requires a sysadmin. Pruning a single resource
+    is allowed to users who can delete its versions.
+
+    :param resource_id optional: only prune versions of this resource
+    :type resource_id: string
+    :param keep_last optional: number of most recent versions to keep for
+        each resource
+    :type keep_last: int
+    :param older_than optional: only delete versions created before this
+        ISO-8601 timestamp
+    :type older_than: string
+    :param batch_size optional: number of versions deleted per transaction
+        (default: 1000)
+    :type batch_size: int
+    :param max_batches optional: stop after this many batches, returning
+        the cursor to continue from (default: no limit)
+    :type max_batches: int
+    :param cursor optional: the cursor returned by a previous call
+    :type cursor: dict
+    :returns: the number of deleted versions and the cursor to continue
+        from, which is ``None`` once all versions have been walked
+    :rtype: dictionary
+    """
+    model = context.get('model', core_model)
+
+    package_id = None
+    resource_id = data_dict.get('resource_id')
+    if resource_id:
+        resource = model.Resource.get(resource_id)
+        if not resource:
+            raise toolkit.ObjectNotFound('Resource not found')
+        resource_id = resource.id
+        package_id = resource.package_id
+
+    toolkit.check_access('version_prune', context,
+                         {"package_id": package_id})
+
+    keep_last = _get_int(data_dict, 'keep_last', None, minimum=0)
+    older_than = data_dict.get('older_than')
+    if older_than:
+        older_than = _parse_timestamp(older_than, 'older_than')
+    if keep_last is None and not older_than:
+        raise toolkit.ValidationError(
+            {'keep_last': ['Provide keep_last, older_than or both']})
+
+    batch_size = _get_int(data_dict, 'batch_size', DEFAULT_BATCH_SIZE)
+    max_batches = _get_int(data_dict, 'max_batches', None)
+    cursor = _parse_prune_cursor(data_dict.get('cursor'))
+
+    query = model.Session.query(Version)
+    if resource_id:
+        query = query.filter(Version.resource_id == resource_id)
+
+    deleted = 0
+    batches = 0
+    while True:
+        last_key = None
+        if keep_last is None:
+            batch_query, columns = query, Version
+        else:
+            batch_query, columns, last_key = _keep_last_batch(
+                model.Session, query, keep_last, batch_size, cursor)
+            if batch_query is None:
+                cursor = None
+                break
+        if older_than:
+            batch_query = batch_query.filter(columns.created < older_than)
+        batch_deleted, cursor = _delete_batch(
+            model.Session, batch_query, batch_size, cursor, columns)
+        # Resources left to rank after those of this batch
+        cursor = cursor or last_key
+        deleted += batch_deleted
+        batches += 1
+        if cursor is None or (max_batches and batches >= max_batches):
+            break
+
+    log.info('%d versions pruned in %d batches', deleted, batches)
+
+    return {
+        'deleted': deleted,
+        'cursor': _format_prune_cursor(cursor),
+    }
+
+
+def _keep_last_batch(session, query, keep_last, batch_size, cursor):
+    """Returns a query of the versions of the next `batch_size` resources
+    after `cursor` that are not among the `keep_last` most recent ones of
+    their resource, its columns, and the key of the last version of these
+    resources if there may be more resources after them.
+
+    Only the versions of these resources are ranked, so that the cost of a
+    batch does not grow with the size of the table. Returns ``None`` for the
+    query once there are no resources left.
+    """
+    key = (Version.resource_id, Version.created, Version.id)
+    remaining = query
+    if cursor:
+        remaining = remaining.filter(tuple_(*key) > tuple_(*cursor))
+    resource_ids = [
+        row[0] for row in remaining.with_entities(Version.resource_id).
+        distinct().order_by(Version.resource_id).limit(batch_size)]
+    if not resource_ids:
+        return None, None, None
+
+    ranked = query.filter(Version.resource_id.in_(resource_ids)).\
+        with_entities(
+            Version.id.label('id'),
+            Version.resource_id.label('resource_id'),
+            Version.created.label('created'),
+            func.row_number().over(
+                partition_by=Version.resource_id,
+                order_by=(Version.created.desc(), Version.id.desc())
+            ).label('rank')
+        ).subquery()
+
+    last_key = None
+    if len(resource_ids) == batch_size:
+        last_key = tuple(query.with_entities(*key).
+                         filter(Version.resource_id == resource_ids[-1]).
+                         order_by(*(column.desc() for column in key)).
+                         first())
+    return (session.query(ranked).filter(ranked.c.rank > keep_last),
+            ranked.c, last_key)
+
+
+def _delete_batch(session, query, batch_size, cursor, columns=Version):
+    """Delete the next batch of versions matched by `query`.
+
+    `query` is walked in `(resource_id, created, id)` order starting after
+    `cursor`. Returns the number of deleted rows and the cursor of the last
+    row, or ``None`` when there is nothing left to delete.
+    """
+    key = (columns.resource_id, columns.created, columns.id)
+    if cursor:
+        query = query.filter(tuple_(*key) > tuple_(*cursor))
+    rows = query.with_entities(*key).order_by(*key).limit(batch_size).all()
+    if not rows:
+        return 0, None
+
+    session.query(Version).\
+        filter(Version.id.in_([row[2] for row in rows])).\
+        delete(synchronize_session=False)
+    session.commit()
+    for resource_id, _, version_id in rows:
+        _invalidate_versions(resource_id, version_id)
+
+    next_cursor = tuple(rows[-1]) if len(rows) == batch_size else None
+    return len(rows), next_cursor
+
+
+def _parse_prune_cursor(cursor):
+    if not cursor:
+        return None
+    if isinstance(cursor, str):
+        try:
+            cursor = json.loads(cursor)
+        except ValueError:
+            raise toolkit.ValidationError({'cursor': ['Invalid cursor']})
+    try:
+        return (
+            cursor['resource_id'],
+            _parse_timestamp(cursor['created'], 'cursor'),
+            cursor['id'],
+        )
+    except (KeyError, TypeError):
+        raise toolkit.ValidationError({'cursor': ['Invalid cursor']})
+
+
+def _format_prune_cursor(cursor):
+    if not cursor:
+        return None
+    resource_id, created, version_id = cursor
+    return {
+        'resource_id': resource_id,
+        'created': created.isoformat(),
+        'id': version_id,
+    }
+
+
+def _parse_timestamp(value, field, end_of_period=False):
+    """Parse an ISO-8601 timestamp. Timestamps missing their last parts,
+    like '2021-05' or '2021-05-15T10', stand for the start of that period,
+    or for its end if `end_of_period` is set, instead of taking the missing
+    parts from the current date. Timestamps without a year are refused.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        start = parse_date(value, default=_PERIOD_START)
+        end = parse_date(value, default=_PERIOD_END)
+    except (ValueError, OverflowError, TypeError):
+        raise toolkit.ValidationError(
+            {field: ['Invalid timestamp: {}'.format(value)]})
+    missing = [part for part in _TIMESTAMP_PARTS
+               if getattr(start, part) != getattr(end, part)]
+    if 'year' in missing or \
+            missing != list(_TIMESTAMP_PARTS[len(_TIMESTAMP_PARTS) -
+                                             len(missing):]):
+        raise toolkit.ValidationError(
+            {field: ['Incomplete timestamp: {}'.format(value)]})
+    return end if end_of_period else start
+
+
+def _get_int(data_dict, field, default, minimum=1):
+    value = data_dict.get(field)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({field: ['Must be an integer']})
+    if value < minimum:
+        raise toolkit.ValidationError(
+            {field: ['Must be at least {}'.format(minimum)]})
+    return value
 
 
 def version_delete(context, data_dict):
@@ -297,6 +685,7 @@ def version_delete(context, data_dict):
 
     model.Session.delete(version)
     model.repo.commit()
+    _invalidate_versions(version.resource_id, version.id)
 
     log.info('Version %s was deleted', version_id)
 
@@ -312,14 +701,133 @@ def version_show(context, data_dict):
     """
     model = context.get('model', core_model)
     version_id = toolkit.get_or_bust(data_dict, ['version_id'])
-    version = model.Session.query(Version).get(version_id)
-    if not version:
+    version = _get_version(model, version_id)
+    if version is None:
         raise toolkit.ObjectNotFound('Version not found')
 
     toolkit.check_access('version_show', context,
-                         {"package_id": version.package_id})
+                         {"package_id": version['package_id']})
 
-    return version.as_dict()
+    return version
+
+
+def _get_version(model, version_id):
+    """Returns the dict of a version, from the version cache if possible,
+    or None if it does not exist.
+    """
+    cache = _get_version_cache()
+    if cache is None:
+        version = model.Session.query(Version).get(version_id)
+        return version.as_dict() if version else None
+
+    version = cache.get('version:{}'.format(version_id))
+    if version is None:
+        version = model.Session.query(Version).get(version_id)
+        if not version:
+            return None
+        version = version.as_dict()
+        cache.set('version:{}'.format(version_id), version)
+    return version
+
+
+@toolkit.side_effect_free
+def version_feed(context, data_dict):
+    """List versions created or edited across the site since a cursor
+
+    Versions are returned in the order they were last modified. Pass the
+    returned `cursor` to the next call to get only the versions created or
+    edited since then. The cursor is returned unchanged when there are no
+    new versions, so it can be used to poll the feed.
+
+    The modification time of a version is set before its transaction
+    commits, so a version could become visible after the cursor has moved
+    past it. To leave time for these commits, versions modified in the last
+    `ckanext.versions.feed_delay` seconds (default: 10) are only listed by
+    later calls. Versions whose transaction takes longer than that can
+    still be missed.
+
+    Only versions of active datasets are listed, and versions of private
+    datasets are only listed to sysadmins. Deleted versions are not
+    reported: versions are deleted from the table, so clients that mirror
+    the feed need to compare their list of versions with
+    `resource_version_list` from time to time.
+
+    :param cursor optional: the cursor returned by a previous call
+    :type cursor: string
+    :param since optional: only list versions modified after this ISO-8601
+        timestamp. Ignored if `cursor` is provided.
+    :type since: string
+    :param organization optional: only list versions of datasets of this
+        organization (id or name)
+    :type organization: string
+    :param package_id optional: only list versions of this dataset (id or
+        name)
+    :type package_id: string
+    :param limit optional: maximum number of versions to return (default:
+        100, maximum: 1000)
+    :type limit: int
+    :returns: the list of versions and the cursor for the next call
+    :rtype: dictionary
+    """
+    model = context.get('model', core_model)
+
+    toolkit.check_access('version_feed', context, data_dict)
+
+    limit = min(_get_int(data_dict, 'limit', DEFAULT_FEED_LIMIT),
+                MAX_FEED_LIMIT)
+
+    query = model.Session.query(Version).\
+        join(model.Package, model.Package.id == Version.package_id).\
+        filter(model.Package.state == 'active')
+    if not authz.is_sysadmin(context.get('user')):
+        query = query.filter(model.Package.private.is_(False))
+
+    organization = data_dict.get('organization')
+    if organization:
+        group = model.Group.get(organization)
+        if not group:
+            raise toolkit.ObjectNotFound('Organization not found')
+        query = query.filter(model.Package.owner_org == group.id)
+
+    package_id = data_dict.get('package_id')
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise toolkit.ObjectNotFound('Dataset not found')
+        query = query.filter(Version.package_id == package.id)
+
+    delay = toolkit.asint(
+        toolkit.config.get('ckanext.versions.feed_delay', 10))
+    if delay > 0:
+        query = query.filter(
+            Version.modified <= datetime.utcnow() - timedelta(seconds=delay))
+
+    cursor = data_dict.get('cursor')
+    if cursor:
+        modified, version_id = _parse_feed_cursor(cursor)
+        query = query.filter(tuple_(Version.modified, Version.id) >
+                             tuple_(modified, version_id))
+    elif data_dict.get('since'):
+        query = query.filter(
+            Version.modified > _parse_timestamp(data_dict['since'], 'since'))
+
+    versions = query.order_by(Version.modified, Version.id).limit(limit).all()
+    if versions:
+        cursor = '{},{}'.format(
+            versions[-1].modified.isoformat(), versions[-1].id)
+
+    return {
+        'versions': [v.as_dict() for v in versions],
+        'cursor': cursor,
+    }
+
+
+def _parse_feed_cursor(cursor):
+    try:
+        modified, version_id = cursor.split(',', 1)
+    except (AttributeError, ValueError):
+        raise toolkit.ValidationError({'cursor': ['Invalid cursor']})
+    return _parse_timestamp(modified, 'cursor'), version_id
 
 
 @toolkit.side_effect_free
@@ -331,11 +839,68 @@ def resource_version_current(context, data_dict):
     :returns the version dictionary
     :rtype dict
     '''
-    version_list = resource_version_list(context, data_dict)
-    return version_list[0] if version_list else None
+    model = context.get('model', core_model)
+    resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
+    index = _get_version_index()
+    if index is None:
+        package_id, version = _get_resource_versions(
+            model, resource_id, 'current')
+    else:
+        package_id = _get_indexed_package_id(model, index, resource_id)
+        version = index.current(resource_id)
+
+    toolkit.check_access('version_list', context,
+                         {"package_id": package_id})
+
+    return version
+
+
+@toolkit.side_effect_free
+def resource_version_at(context, data_dict):
+    """Show the version of a resource that was current at a given time,
+    that is the newest version created at or before it
+
+    :param resource_id: the id of the resource
+    :type resource_id: string
+    :param timestamp: an ISO-8601 timestamp, in UTC unless it has an offset.
+        Partial timestamps stand for the end of their period, so '2021-05'
+        gives the version that was current at the end of May 2021.
+    :type timestamp: string
+    :returns: the version dictionary, or None if the resource had no
+        versions at that time
+    :rtype: dict
+    """
+    model = context.get('model', core_model)
+    resource_id, timestamp = toolkit.get_or_bust(
+        data_dict, ['resource_id', 'timestamp'])
+    timestamp = _parse_timestamp(timestamp, 'timestamp', end_of_period=True)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(tz.tzutc()).replace(tzinfo=None)
+
+    index = _get_version_index()
+    if index is None:
+        resource = model.Resource.get(resource_id)
+        if not resource:
+            raise toolkit.ObjectNotFound('Resource not found')
+        package_id = resource.package_id
+        # A single probe of idx_version_resource_id_created
+        version = model.Session.query(Version).\
+            filter(Version.resource_id == resource.id).\
+            filter(Version.created <= timestamp).\
+            order_by(Version.created.desc(), Version.id.desc()).first()
+        version = version.as_dict() if version else None
+    else:
+        package_id = _get_indexed_package_id(model, index, resource_id)
+        version = index.at(resource_id, timestamp)
+
+    toolkit.check_access('version_list', context,
+                         {"package_id": package_id})
+
+    return version
 
 
 @toolkit.side_effect_free
+@tracing.traced('resource_history')
 def resource_history(context, data_dict):
     ''' Get an array with all the versions of the resource.
 
@@ -354,23 +919,46 @@ def resource_history(context, data_dict):
         {'model': core_model, 'user': context['user']},
         {'resource_id': resource_id}
         )
+    if not versions_list:
+        return []
+
+    # Ensure we are not leaking info to unauthorized users
+    toolkit.check_access('resource_show', {'user': context['user']},
+                         {'id': resource_id})
+
+    # All activities are loaded with one query instead of once per version,
+    # streamed in batches, and only the resource is kept from each dataset
+    activity_ids = {version['activity_id'] for version in versions_list}
+    with tracing.span('load_activities', count=len(activity_ids)) as span:
+        activities = core_model.Session.query(
+            core_model.Activity.id, core_model.Activity.data
+        ).filter(core_model.Activity.id.in_(activity_ids)).\
+            yield_per(HISTORY_BATCH_SIZE)
+        resources = {}
+        payload_bytes = 0
+        for activity_id, data in activities:
+            package = (data or {}).get('package')
+            if span.is_recording():
+                payload_bytes += tracing.payload_size(package)
+            resources[activity_id] = _find_activity_resource(
+                package, resource_id)
+        span.set_attribute('versions.payload_bytes', payload_bytes)
 
     result = []
     for version in versions_list:
-            resource = activity_resource_show(
-                {'user': context['user']},
-                {
-                    'activity_id': version['activity_id'],
-                    'resource_id': version['resource_id']
-                }
-                )
-            resource['version'] = version
-            result.append(resource)
-
+        if version['activity_id'] not in resources:
+            raise toolkit.ObjectNotFound('Activity not found')
+        # Copied, as versions can share an activity
+        resource = dict(resources[version['activity_id']])
+        resource['version'] = version
+        result.append(resource)
+
+    tracing.current_span().set_attribute('versions.count', len(result))
     return result
 
 
 @toolkit.side_effect_free
+@tracing.traced('activity_resource_show')
 def activity_resource_show(context, data_dict):
     ''' Returns a resource from the activity object.
 
@@ -389,12 +977,29 @@ def activity_resource_show(context, data_dict):
     # Ensure we are not leaking info to unauthorized users
     toolkit.check_access('resource_show', context, {'id': resource_id})
 
-    package = toolkit.get_action('activity_data_show')(
+    package = _activity_data_show(
         {'user': toolkit.get_action('get_site_user')({'ignore_auth': True})['name']},
-        {'id': activity_id, 'object_type': 'package'}
+        activity_id
     )
 
-    resources = package.get('resources')
+    return _find_activity_resource(package, resource_id)
+
+
+def _activity_data_show(context, activity_id):
+    """Returns the dataset dict of an activity, with the `activity_data_show`
+    action of CKAN, in a span recording its size.
+    """
+    with tracing.span('activity_data_show', activity_id=activity_id) as span:
+        package = toolkit.get_action('activity_data_show')(
+            context, {'id': activity_id, 'object_type': 'package'})
+        if span.is_recording():
+            span.set_attribute(
+                'versions.payload_bytes', tracing.payload_size(package))
+        return package
+
+
+def _find_activity_resource(package, resource_id):
+    resources = (package or {}).get('resources')
     if not resources:
         raise toolkit.ObjectNotFound('Resource not found in the activity object.')
 
@@ -411,6 +1016,7 @@ def activity_resource_show(context, data_dict):
 
 
 @toolkit.side_effect_free
+@tracing.traced('resource_in_activity')
 def resource_in_activity(context, data_dict):
     ''' Check if the resource exists in the activity object.
 
@@ -481,18 +1087,17 @@ def _fix_resource_data(resource_dict, revision_id):
 
 def _generate_diff(obj1, obj2, diff_type):
 
-    def _dump_obj(obj):
-        return json.dumps(obj, indent=2, sort_keys=True).split('\n')
-
-    obj_lines = [_dump_obj(obj) for obj in [obj1, obj2]]
-
     if diff_type == 'unified':
-        diff_generator = difflib.unified_diff(*obj_lines)
-        diff = '\n'.join(line for line in diff_generator)
+        diff = '\n'.join(json_diff.unified_diff(obj1, obj2))
     elif diff_type == 'context':
-        diff_generator = difflib.context_diff(*obj_lines)
-        diff = '\n'.join(line for line in diff_generator)
+        diff = '\n'.join(json_diff.context_diff(obj1, obj2))
+    elif diff_type == 'json_patch':
+        diff = json_diff.json_patch(obj1, obj2)
     elif diff_type == 'html':
+        obj_lines = [
+            json.dumps(obj, indent=2, sort_keys=True).split('\n')
+            for obj in [obj1, obj2]
+        ]
         # word-wrap lines. Otherwise you get scroll bars for most datasets.
         for obj_index in (0, 1):
             wrapped_obj_lines = []
@@ -506,6 +1111,537 @@ def _generate_diff(obj1, obj2, diff_type):
     return diff
 
 
+@toolkit.side_effect_free
+def version_compare(context, data_dict):
+    """Compare the dataset metadata of two versions
+
+    Returns the list of changes between the dataset as it was when each
+    version was created, in the same format used by CKAN's activity stream.
+    A text or HTML diff of the two dataset dicts can be requested as well,
+    or a JSON Patch (RFC 6902) that turns the old dataset dict into the new
+    one.
+
+    Activities never change, so results are cached by the pair of
+    activities and the diff type.
+
+    :param old_version_id: the id of the older version
+    :type old_version_id: string
+    :param new_version_id: the id of the newer version
+    :type new_version_id: string
+    :param diff_type optional: also return a diff of the dataset dicts, one
+        of 'unified', 'context', 'html' or 'json_patch'. The JSON Patch is
+        returned as a list of operations
+    :type diff_type: string
+    :param resource_only optional: only compare the resources of the two
+        versions, leaving out dataset metadata and other resources. The diff
+        is then computed between the resource dicts (default: False)
+    :type resource_only: bool
+    :returns: both versions, the list of changes and, if requested, the diff
+    :rtype: dictionary
+    """
+    model = context.get('model', core_model)
+    old_version_id, new_version_id = toolkit.get_or_bust(
+        data_dict, ['old_version_id', 'new_version_id'])
+    diff_type = data_dict.get('diff_type') or None
+    if diff_type and diff_type not in DIFF_TYPES:
+        raise toolkit.ValidationError(
+            {'diff_type': ['Must be one of {}'.format(', '.join(DIFF_TYPES))]})
+
+    versions = []
+    for version_id in (old_version_id, new_version_id):
+        version = model.Session.query(Version).get(version_id)
+        if not version:
+            raise toolkit.ObjectNotFound('Version not found')
+        toolkit.check_access('version_show', context,
+                             {"package_id": version.package_id})
+        versions.append(version)
+    old_version, new_version = versions
+
+    resource_ids = None
+    if toolkit.asbool(data_dict.get('resource_only', False)):
+        resource_ids = tuple(sorted(
+            {old_version.resource_id, new_version.resource_id}))
+
+    cache = _get_compare_cache()
+    cache_key = (old_version.activity_id, new_version.activity_id, diff_type,
+                 resource_ids)
+    result = cache.get(cache_key)
+    if result is None:
+        result = _compare_activities(
+            old_version.activity_id, new_version.activity_id, diff_type,
+            resource_ids)
+        cache.set(cache_key, result)
+
+    result = copy.deepcopy(result)
+    result['old_version'] = old_version.as_dict()
+    result['new_version'] = new_version.as_dict()
+    return result
+
+
+def _compare_activities(old_activity_id, new_activity_id, diff_type,
+                        resource_ids=None):
+    packages = _get_activity_packages(old_activity_id, new_activity_id)
+
+    change_list = []
+    if resource_ids is None:
+        check_metadata_changes(change_list, *packages)
+    check_resource_changes(change_list, packages[0], packages[1],
+                           old_activity_id, resource_ids)
+
+    result = {'changes': change_list}
+    if diff_type:
+        if resource_ids is None:
+            objects = packages
+        else:
+            objects = [
+                [res for res in package['resources']
+                 if res['id'] in resource_ids]
+                for package in packages
+            ]
+        result['diff'] = _generate_diff(objects[0], objects[1], diff_type)
+    return result
+
+
+def _get_activity_packages(*activity_ids):
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return [
+        _activity_data_show({'user': site_user['name']}, activity_id)
+        for activity_id in activity_ids
+    ]
+
+
+def _get_compare_cache():
+    global _compare_cache
+    if _compare_cache is None:
+        _compare_cache = LRUCache(toolkit.asint(
+            toolkit.config.get('ckanext.versions.compare_cache_size', 128)))
+    return _compare_cache
+
+
+def _get_version_cache():
+    """Returns the cache of versions read by `version_show`,
+    `resource_version_list` and `resource_version_current`, or None unless
+    `ckanext.versions.cache.enabled` is set.
+
+    The local tier is an LRU cache in each process. The shared tier is set
+    with `ckanext.versions.cache.shared`: `redis` to use CKAN's Redis
+    instance, `mmap` to use a memory mapped file shared by the processes of
+    this host, or `memory` for an in-process stand-in used in tests.
+
+    The cache is off by default, as the local tiers of other processes
+    only see an invalidation when their entries expire. The mmap tier sees
+    every invalidation as soon as it is made, so it is used without a local
+    tier.
+    """
+    global _version_cache
+    config = toolkit.config
+    if not toolkit.asbool(config.get('ckanext.versions.cache.enabled',
+                                     False)):
+        return None
+
+    if _version_cache is None:
+        local = LRUCache(
+            toolkit.asint(config.get('ckanext.versions.cache.size', 10000)),
+            ttl=toolkit.asint(config.get('ckanext.versions.cache.ttl', 60)))
+
+        shared = None
+        shared_type = config.get('ckanext.versions.cache.shared')
+        shared_ttl = toolkit.asint(
+            config.get('ckanext.versions.cache.shared_ttl', 3600))
+        if shared_type == 'redis':
+            shared = RedisCache('ckanext-versions:{}:'.format(
+                config.get('ckan.site_id')), ttl=shared_ttl)
+        elif shared_type == 'mmap':
+            local = None
+            shared = MmapCache(
+                config.get('ckanext.versions.cache.mmap_path') or
+                _default_mmap_path(config.get('ckan.site_id')),
+                slots=toolkit.asint(
+                    config.get('ckanext.versions.cache.mmap_slots', 16384)),
+                slot_size=toolkit.asint(config.get(
+                    'ckanext.versions.cache.mmap_slot_size', 2048)),
+                ttl=shared_ttl)
+        elif shared_type == 'memory':
+            shared = LRUCache(toolkit.asint(
+                config.get('ckanext.versions.cache.size', 10000)),
+                ttl=shared_ttl)
+        elif shared_type:
+            raise ValueError(
+                'Unknown ckanext.versions.cache.shared: {}'.format(
+                    shared_type))
+        _version_cache = TwoTierCache(local, shared)
+    return _version_cache
+
+
+def _default_mmap_path(site_id):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+    return os.path.join(
+        directory, 'ckanext-versions-{}.cache'.format(site_id or 'default'))
+
+
+def clear_version_cache():
+    """Remove all cached versions, after versions were written without
+    using the actions, for example by the backfill and import commands.
+    The version index, if enabled, is built again on next use.
+    """
+    global _version_index
+    cache = _get_version_cache()
+    if cache is not None:
+        cache.clear()
+    _version_index = None
+
+
+def _invalidate_versions(resource_id, *version_ids):
+    """Remove the cached versions of a resource after any of them changed.
+    """
+    cache = _get_version_cache()
+    if cache is not None:
+        cache.delete(
+            'list:{}'.format(resource_id), 'current:{}'.format(resource_id),
+            *['version:{}'.format(version_id) for version_id in version_ids])
+    if _version_index is not None:
+        _version_index.invalidate(resource_id)
+
+
+def _get_version_index():
+    """Returns the in-memory index of versions of this process (see
+    `ckanext.versions.lib.index`), or None unless
+    `ckanext.versions.index.enabled` is set.
+
+    The index is built on first use. Every
+    `ckanext.versions.index.refresh` seconds it reloads the resources of
+    versions created or edited by other processes, and it is built again
+    every `ckanext.versions.index.rebuild` seconds, which is when versions
+    deleted by other processes leave it. Other requests keep using the
+    previous index while it is rebuilt.
+    """
+    global _version_index
+    config = toolkit.config
+    if not toolkit.asbool(config.get('ckanext.versions.index.enabled',
+                                     False)):
+        return None
+
+    index = _version_index
+    now = time.monotonic()
+    if index is None or now - index.built > toolkit.asint(
+            config.get('ckanext.versions.index.rebuild', 3600)):
+        if _version_index_lock.acquire(index is None):
+            try:
+                if _version_index is index:
+                    _version_index = load_version_index()
+            finally:
+                _version_index_lock.release()
+        index = _version_index or index
+    elif now - index.refreshed > toolkit.asint(
+            config.get('ckanext.versions.index.refresh', 30)):
+        refresh_version_index(index)
+    return index
+
+
+def _get_indexed_package_id(model, index, resource_id):
+    package_id = index.package_id(resource_id)
+    if package_id is None:
+        resource = model.Resource.get(resource_id)
+        if not resource:
+            raise toolkit.ObjectNotFound('Resource not found')
+        package_id = resource.package_id
+    return package_id
+
+
+@toolkit.side_effect_free
+def version_cache_stats(context, data_dict):
+    """Show the hits and misses of the version caches of this process
+
+    Counters are kept per process since it started. The shared tier of the
+    version cache, if configured, also counts the lookups of this process
+    only.
+
+    :returns: the stats of the `versions` cache, with `local` and `shared`
+        tiers, if it is enabled, of the `compare` cache used by
+        `version_compare` and of the version `index`, if it was built
+    :rtype: dictionary
+    """
+    toolkit.check_access('version_cache_stats', context, data_dict)
+
+    cache = _get_version_cache()
+    return {
+        'versions': cache.stats() if cache is not None else None,
+        'compare': _get_compare_cache().stats(),
+        'index': _version_index.stats() if _version_index is not None
+        else None,
+    }
+
+
+@toolkit.side_effect_free
+def version_change_show(context, data_dict):
+    """Show the changes introduced by a version
+
+    Changes are computed against the previous version of the same resource
+    when the version is created, in the same format used by
+    `version_compare`. The first version of a resource has no changes.
+
+    :param version_id: the id of the version
+    :type version_id: string
+    :returns: the id of the previous version and the list of changes
+    :rtype: dictionary
+    """
+    model = context.get('model', core_model)
+    version_id = toolkit.get_or_bust(data_dict, ['version_id'])
+    version = model.Session.query(Version).get(version_id)
+    if not version:
+        raise toolkit.ObjectNotFound('Version not found')
+
+    toolkit.check_access('version_show', context,
+                         {"package_id": version.package_id})
+
+    version_change = model.Session.query(VersionChange).get(version_id)
+    if not version_change:
+        raise toolkit.ObjectNotFound('Changes not found for this version')
+
+    return version_change.as_dict()
+
+
+@toolkit.side_effect_free
+def resource_version_changelog(context, data_dict):
+    """List the versions of a resource along with the changes of each one
+
+    Versions and their changes are read with a single query, newest first.
+    Versions whose changes have not been computed yet have `changes` set
+    to ``None``.
+
+    :param resource_id: the id of the resource
+    :type resource_id: string
+    :returns: list of versions, each one with `previous_version_id` and
+        `changes` fields
+    :rtype: list
+    """
+    model = context.get('model', core_model)
+    resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
+    resource = model.Resource.get(resource_id)
+    if not resource:
+        raise toolkit.ObjectNotFound('Resource not found')
+
+    toolkit.check_access('version_list', context,
+                         {"package_id": resource.package_id})
+
+    rows = model.Session.query(Version, VersionChange).\
+        outerjoin(VersionChange, VersionChange.version_id == Version.id).\
+        filter(Version.resource_id == resource.id).\
+        order_by(Version.created.desc())
+
+    result = []
+    for version, version_change in rows:
+        version_dict = version.as_dict()
+        if version_change:
+            change_dict = version_change.as_dict()
+            version_dict['previous_version_id'] = \
+                change_dict['previous_version_id']
+            version_dict['changes'] = change_dict['changes']
+        else:
+            version_dict['previous_version_id'] = None
+            version_dict['changes'] = None
+        result.append(version_dict)
+
+    return result
+
+
+def version_data_compare(context, data_dict):
+    """Compare the rows of the CSV or TSV files of two versions
+
+    Both files are streamed and compared row by row. Once the rows read
+    from the old file take about `ckanext.versions.data_diff_memory` bytes
+    in memory, the rows of both files are split into partitions by the hash
+    of their key, which are spilled to temporary files and compared one at
+    a time, so memory use stays bounded. Reading stops with
+    an error once a file goes over `ckanext.versions.data_diff_max_size`
+    bytes.
+
+    Users must be allowed to edit both datasets, as the files are
+    downloaded and compared while the request waits.
+
+    :param old_version_id: the id of the older version
+    :type old_version_id: string
+    :param new_version_id: the id of the newer version
+    :type new_version_id: string
+    :param key optional: the columns that identify a row, as a list or a
+        comma separated string. Rows with the same key and different values
+        are reported as changed. Without a key, rows are either added or
+        removed
+    :type key: list
+    :param limit optional: the maximum number of rows of each kind returned
+        (default: 100)
+    :type limit: int
+    :returns: both versions, the added and removed columns, the number of
+        added, removed, changed and unchanged rows, and examples of them
+    :rtype: dictionary
+    """
+    model = context.get('model', core_model)
+    old_version_id, new_version_id = toolkit.get_or_bust(
+        data_dict, ['old_version_id', 'new_version_id'])
+    key = data_dict.get('key') or []
+    if isinstance(key, str):
+        key = [column.strip() for column in key.split(',') if column.strip()]
+    limit = _get_int(data_dict, 'limit', 100, minimum=0)
+
+    versions = []
+    for version_id in (old_version_id, new_version_id):
+        version = model.Session.query(Version).get(version_id)
+        if not version:
+            raise toolkit.ObjectNotFound('Version not found')
+        toolkit.check_access('version_data_compare', context,
+                             {"package_id": version.package_id})
+        versions.append(version)
+
+    resources = []
+    for version, package in zip(versions, _get_activity_packages(
+            *[version.activity_id for version in versions])):
+        resource = next((res for res in package.get('resources') or []
+                         if res['id'] == version.resource_id), None)
+        if resource is None:
+            raise toolkit.ObjectNotFound(
+                'Resource not found in the activity object.')
+        resources.append(resource)
+
+    delimiters = {_data_delimiter(resource) for resource in resources}
+    if len(delimiters) != 1 or None in delimiters:
+        raise toolkit.ValidationError(
+            {'format': ['Both versions must be CSV or TSV files']})
+
+    max_size = toolkit.asint(toolkit.config.get(
+        'ckanext.versions.data_diff_max_size', 100 * 1024 * 1024))
+    files = []
+    try:
+        for version, resource in zip(versions, resources):
+            files.append(datadiff.limit_size(
+                _open_version_data(version, resource), max_size))
+        memory = toolkit.asint(toolkit.config.get(
+            'ckanext.versions.data_diff_memory', 64 * 1024 * 1024))
+        try:
+            result = datadiff.diff_rows(
+                files[0], files[1], key=key, limit=limit, memory=memory,
+                delimiter=delimiters.pop())
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise toolkit.ValidationError(
+                {'data': ['Could not read the files: {}'.format(e)]})
+        except datadiff.FileTooLarge:
+            raise toolkit.ValidationError({'data': [
+                'Files larger than {} bytes cannot be compared'.format(
+                    max_size)]})
+        except ValueError as e:
+            raise toolkit.ValidationError({'key': [str(e)]})
+    finally:
+        for f in files:
+            f.close()
+
+    result['old_version'] = versions[0].as_dict()
+    result['new_version'] = versions[1].as_dict()
+    return result
+
+
+def _data_delimiter(resource):
+    data_format = (resource.get('format') or '').lower()
+    if not data_format:
+        data_format = resource.get('url', '').rsplit('.', 1)[-1].lower()
+    return {'csv': ',', 'tsv': '\t'}.get(data_format)
+
+
+def _open_version_data(version, resource):
+    """Returns a binary file object with the file of a version
+
+    Uploaded files are read through the uploader of the storage layer,
+    which only keeps the current file of each resource, so they can only be
+    read while the version is the current state of the resource. Other
+    resources are downloaded from their URL in that activity, without
+    credentials, and only from the hosts allowed by `_check_data_url`.
+    """
+    if resource.get('url_type') == 'upload':
+        return _open_upload(version, resource)
+    return _open_url(version, resource['url'])
+
+
+def _open_upload(version, resource):
+    current = toolkit.get_action('resource_show')(
+        {'ignore_auth': True}, {'id': version.resource_id})
+    # Only the file fields are compared, as the live dict has fields that
+    # plugins add or compute which the activity snapshot may lack
+    if any(current.get(field) != resource.get(field)
+           for field in _UPLOAD_FILE_FIELDS):
+        raise toolkit.ValidationError({'url': [
+            'The file of version {} is no longer stored, only the current '
+            'file of an upload can be compared'.format(version.id)]})
+
+    upload = uploader.get_resource_uploader(current)
+    if not hasattr(upload, 'get_path'):
+        raise toolkit.ValidationError({'url': [
+            'The storage of uploads does not give access to their files']})
+    try:
+        return open(upload.get_path(version.resource_id), 'rb')
+    except (IOError, OSError) as e:
+        raise toolkit.ValidationError(
+            {'url': ['Could not read the file of version {}: {}'.format(
+                version.id, e)]})
+
+
+def _open_url(version, url):
+    timeout = toolkit.asint(toolkit.config.get(
+        'ckanext.versions.data_diff_timeout', 60))
+    # Redirects are followed one by one, so each target is checked
+    for _ in range(MAX_DATA_REDIRECTS + 1):
+        _check_data_url(url)
+        try:
+            response = requests.get(
+                url, stream=True, timeout=timeout, allow_redirects=False)
+            if response.is_redirect:
+                response.close()
+                url = urljoin(url, response.headers['Location'])
+                continue
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise toolkit.ValidationError(
+                {'url': ['Could not download the file of version {}: '
+                         '{}'.format(version.id, e)]})
+        response.raw.decode_content = True
+        return response.raw
+    raise toolkit.ValidationError(
+        {'url': ['Too many redirects for the file of version {}'.format(
+            version.id)]})
+
+
+def _check_data_url(url):
+    """Raises a ValidationError unless url can be downloaded to compare its
+    data: an http or https URL of a host listed in
+    `ckanext.versions.data_diff_allowed_hosts` or, if none are listed, of a
+    host whose addresses are all public, so the server cannot be made to
+    fetch internal services.
+    """
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise toolkit.ValidationError(
+            {'url': ['Only http and https URLs can be compared']})
+
+    allowed_hosts = toolkit.aslist(toolkit.config.get(
+        'ckanext.versions.data_diff_allowed_hosts', ''))
+    if allowed_hosts:
+        if parts.hostname not in allowed_hosts:
+            raise toolkit.ValidationError({'url': [
+                'Files from {} cannot be compared'.format(parts.hostname)]})
+        return
+
+    try:
+        addresses = socket.getaddrinfo(
+            parts.hostname, parts.port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise toolkit.ValidationError(
+            {'url': ['Could not resolve {}: {}'.format(parts.hostname, e)]})
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0])
+        if not ip.is_global:
+            raise toolkit.ValidationError({'url': [
+                'Files from {} cannot be compared, it is not a public '
+                'address'.format(parts.hostname)]})
+
+
 @toolkit.side_effect_free
 @toolkit.chained_action
 def resource_view_list(up_func, context, data_dict):
@@ -539,6 +1675,17 @@ def get_activity_id_from_resource_version_name(context, data_dict):
 
     '''
     version_name = data_dict.get('version_name')
+    index = _get_version_index()
+    if index is not None:
+        model = context.get('model', core_model)
+        resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
+        toolkit.check_access('version_list', context, {
+            "package_id": _get_indexed_package_id(model, index, resource_id)})
+        version = index.by_name(resource_id, version_name)
+        if version:
+            return version['activity_id']
+        raise toolkit.ObjectNotFound('Version not found in the resource.')
+
     version_list = resource_version_list(context, data_dict)
 
     for version in version_list:
@@ -557,7 +1704,12 @@ def resource_has_versions(context, data_dict):
     :returns: True if the resource has at least 1 version
     :rtype: boolean
     """
-    version_list = resource_version_list(context, data_dict)
-    if not version_list:
-        return False
-    return True
+    index = _get_version_index()
+    if index is not None:
+        model = context.get('model', core_model)
+        resource_id = toolkit.get_or_bust(data_dict, ['resource_id'])
+        toolkit.check_access('version_list', context, {
+            "package_id": _get_indexed_package_id(model, index, resource_id)})
+        return index.has_versions(resource_id)
+
+    return resource_version_current(context, data_dict) is not None
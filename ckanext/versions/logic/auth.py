@@ -21,6 +21,16 @@ def version_delete(context, data_dict):
                          {"id": data_dict['package_id']})
 
 
+def version_data_compare(context, data_dict):
+    """Check if a user is allowed to compare the data files of versions
+
+    This is permitted only to users who are allowed to modify the dataset,
+    as the server downloads and compares both files
+    """
+    return is_authorized('package_update', context,
+                         {"id": data_dict['package_id']})
+
+
 def resource_version_clear(context, data_dict):
     """Check if a user is allowed to delete a version
 
@@ -29,6 +39,46 @@ def resource_version_clear(context, data_dict):
     return version_delete(context, data_dict)
 
 
+def version_prune(context, data_dict):
+    """Check if a user is allowed to prune versions
+
+    Pruning the versions of a single dataset is permitted to users who are
+    allowed to modify it. Pruning the whole site is permitted only to
+    sysadmins.
+    """
+    if data_dict.get('package_id'):
+        return version_delete(context, data_dict)
+    return {'success': False,
+            'msg': toolkit._('Only sysadmins can prune all versions')}
+
+
+def version_cache_stats(context, data_dict):
+    """Check if a user is allowed to see the stats of the version caches
+
+    This is permitted only to sysadmins
+    """
+    return {'success': False,
+            'msg': toolkit._('Only sysadmins can see the cache stats')}
+
+
+def version_metrics(context, data_dict):
+    """Check if a user is allowed to see the metrics of the extension
+
+    This is permitted only to sysadmins
+    """
+    return {'success': False,
+            'msg': toolkit._('Only sysadmins can see the metrics')}
+
+
+def version_profile(context, data_dict):
+    """Check if a user is allowed to see the profiles of the extension
+
+    This is permitted only to sysadmins
+    """
+    return {'success': False,
+            'msg': toolkit._('Only sysadmins can see the profiles')}
+
+
 @toolkit.auth_allow_anonymous_access
 def version_list(context, data_dict):
     """Check if a user is allowed to list dataset versions
@@ -45,3 +95,13 @@ def version_show(context, data_dict):
     This is permitted only to users who can view the dataset
     """
     return is_authorized('package_show', context, {"id": data_dict['package_id']})
+
+
+@toolkit.auth_allow_anonymous_access
+def version_feed(context, data_dict):
+    """Check if a user is allowed to list the versions feed
+
+    This is permitted to everyone. The action itself leaves out versions of
+    datasets the user cannot see.
+    """
+    return {'success': True}
@@ -1,13 +1,14 @@
 # encoding: utf-8
 
 import datetime
+import json
 import logging
 from collections import OrderedDict
 
 from ckan.model.meta import metadata
 from ckan.model.types import UuidType
-from sqlalchemy import (Column, DateTime, Unicode,
-                        UniqueConstraint, orm)
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Unicode,
+                        UnicodeText, UniqueConstraint, inspect, orm)
 from sqlalchemy.ext.declarative import declarative_base
 
 log = logging.getLogger(__name__)
@@ -15,10 +16,19 @@ log = logging.getLogger(__name__)
 Base = declarative_base(metadata=metadata)
 
 
+def _default_modified(context):
+    return context.get_current_parameters().get('created') or \
+        datetime.datetime.utcnow()
+
+
 class Version(Base):
     __tablename__ = u'version'
     __table_args__ = (
         UniqueConstraint('package_id', 'resource_id', 'name'),
+        # Keyset order used to walk (and prune) the versions of a resource
+        Index('idx_version_resource_id_created', 'resource_id', 'created'),
+        # Keyset order of the site-wide feed of new and edited versions
+        Index('idx_version_modified_id', 'modified', 'id'),
     )
 
     id = Column(UuidType, primary_key=True, default=UuidType.default)
@@ -29,23 +39,97 @@ class Version(Base):
     notes = Column(Unicode, nullable=True)
     creator_user_id = Column(UuidType, nullable=False)
     created = Column(DateTime, default=datetime.datetime.utcnow)
+    modified = Column(DateTime, default=_default_modified,
+                      onupdate=datetime.datetime.utcnow)
+    # See ckanext.versions.lib.fingerprint, null for versions created by
+    # older releases
+    fingerprint = Column(Unicode(64), nullable=True)
 
     def as_dict(self):
         _dict = OrderedDict()
         table = orm.class_mapper(self.__class__).mapped_table
         for col in table.c:
             val = getattr(self, col.name)
-            if isinstance(val, datetime.date):
-                val = str(val)
             if isinstance(val, datetime.datetime):
                 val = val.isoformat()
+            elif isinstance(val, datetime.date):
+                val = str(val)
             _dict[col.name] = val
         return _dict
 
 
+class VersionChange(Base):
+    """The changes introduced by a version, compared to the previous version
+    of the same resource.
+
+    `changes` holds a JSON list of change records, as produced by
+    `ckanext.versions.lib.changes`. It is empty for the first version of a
+    resource.
+    """
+    __tablename__ = u'version_change'
+
+    version_id = Column(UuidType,
+                        ForeignKey('version.id', ondelete='CASCADE'),
+                        primary_key=True)
+    previous_version_id = Column(UuidType, nullable=True)
+    changes = Column(UnicodeText, nullable=False, default=u'[]')
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def as_dict(self):
+        return OrderedDict([
+            ('version_id', self.version_id),
+            ('previous_version_id', self.previous_version_id),
+            ('changes', json.loads(self.changes)),
+            ('created', self.created.isoformat() if self.created else None),
+        ])
+
+
 def create_tables():
     Version.__table__.create()
+    VersionChange.__table__.create()
 
 
 def tables_exist():
     return Version.__table__.exists()
+
+
+def update_tables():
+    """Adds any table, column or index missing from tables created by an
+    older release.
+
+    Returns the names of the tables, columns and indexes that were created.
+    """
+    inspector = inspect(metadata.bind)
+    created = []
+
+    for table in (Version.__table__, VersionChange.__table__):
+        if not table.exists():
+            table.create()
+            created.append(table.name)
+            continue
+
+        existing = {
+            column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.c:
+            if column.name not in existing:
+                _add_column(table, column)
+                created.append(column.name)
+
+        existing = {
+            index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create()
+                created.append(index.name)
+    return created
+
+
+def _add_column(table, column):
+    engine = metadata.bind
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+            table.name, column.name, column_type))
+        if column.name == 'modified':
+            conn.execute('UPDATE "{}" SET modified = created'.format(
+                table.name))
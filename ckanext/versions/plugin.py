@@ -6,6 +6,7 @@ import ckan.plugins.toolkit as toolkit
 
 from ckanext.versions import cli, helpers
 from ckanext.versions.blueprints import blueprint
+from ckanext.versions.lib import metrics, profiling
 from ckanext.versions.logic import action, auth
 from ckanext.versions.model import tables_exist
 
@@ -45,17 +46,30 @@ class VersionsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     # IActions
 
     def get_actions(self):
-        return {
+        actions = {
             'resource_version_create': action.resource_version_create,
             'resource_version_list': action.resource_version_list,
             'resource_version_current': action.resource_version_current,
+            'resource_version_at': action.resource_version_at,
             'resource_version_clear': action.resource_version_clear,
+            'version_prune': action.version_prune,
             'resource_version_update': action.resource_version_update,
             'resource_version_patch': action.resource_version_patch,
             'version_show': action.version_show,
+            'version_feed': action.version_feed,
+            'version_compare': action.version_compare,
+            'version_data_compare': action.version_data_compare,
+            'version_change_show': action.version_change_show,
+            'resource_version_changelog': action.resource_version_changelog,
             'version_delete': action.version_delete,
+            'version_cache_stats': action.version_cache_stats,
             'resource_view_list': action.resource_view_list,
         }
+        return {
+            name: metrics.instrument(
+                'action', name, profiling.profile(name, func))
+            for name, func in actions.items()
+        }
 
     # IAuthFunctions
 
@@ -63,9 +77,15 @@ class VersionsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         return {
             'version_create': auth.version_create,
             'version_delete': auth.version_delete,
+            'version_data_compare': auth.version_data_compare,
             'version_list': auth.version_list,
             'version_show': auth.version_show,
-            'resource_version_clear': action.resource_version_clear,
+            'version_prune': auth.version_prune,
+            'version_feed': auth.version_feed,
+            'version_cache_stats': auth.version_cache_stats,
+            'version_metrics': auth.version_metrics,
+            'version_profile': auth.version_profile,
+            'resource_version_clear': auth.resource_version_clear,
         }
 
     # ITemplateHelpers
@@ -78,7 +98,10 @@ class VersionsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             'versions_resource_version_current': helpers.resource_version_current,
             'versions_download_url': helpers.download_url,
         }
-        return helper_functions
+        return {
+            name: metrics.instrument('helper', name, func)
+            for name, func in helper_functions.items()
+        }
 
     # IBlueprints
     def get_blueprint(self):
@@ -93,6 +116,7 @@ class VersionsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                 'default_title': plugins.toolkit._('Version history'),
                 'iframed': False}
 
+    @profiling.profiled('can_view')
     def can_view(self, data_dict):
         context = {'ignore_auth': True}
         resource = data_dict['resource']
@@ -100,6 +124,7 @@ class VersionsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
 
         return action.resource_has_versions(context, {'resource_id': resource_id})
 
+    @profiling.profiled('setup_template_variables')
     def setup_template_variables(self, context, data_dict):
         context = {'user': toolkit.c.user}
         resource = data_dict['resource']
@@ -0,0 +1,159 @@
+'''
+Synthetic portals for the benchmarks: datasets with resources, one activity
+per update of each dataset and one version of every resource per activity,
+inserted straight into the database so large portals are built in seconds.
+Datasets are not indexed in Solr.
+'''
+import copy
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from ckan import model
+
+from ckanext.versions.lib.fingerprint import resource_fingerprint
+from ckanext.versions.model import Version
+
+# Datasets, resources per dataset and versions per resource
+SIZES = {
+    'small': (100, 3, 5),
+    'medium': (1000, 5, 10),
+    'large': (10000, 5, 20),
+}
+DEFAULT_SIZES = 'small,medium'
+
+
+def benchmark_sizes():
+    '''
+    Returns the portal sizes to benchmark, set with the
+    VERSIONS_BENCHMARK_SIZES environment variable.
+    '''
+    return os.environ.get(
+        'VERSIONS_BENCHMARK_SIZES', DEFAULT_SIZES).split(',')
+
+
+def package_dict(package_id, name, num_resources):
+    return {
+        'id': package_id,
+        'name': name,
+        'title': 'Dataset {}'.format(name),
+        'notes': 'Lorem ipsum ' * 20,
+        'state': 'active',
+        'type': 'dataset',
+        'private': False,
+        'extras': [],
+        'tags': [],
+        'resources': [{
+            'id': str(uuid.uuid4()),
+            'package_id': package_id,
+            'name': 'Resource {}'.format(i),
+            'description': 'Description ' * 10,
+            'url': 'http://example.com/{}/{}.csv'.format(name, i),
+            'format': 'CSV',
+            'position': i,
+            'size': 1024 * i,
+            'state': 'active',
+        } for i in range(num_resources)],
+    }
+
+
+def edited_package(package, changed_resources=1):
+    '''
+    Returns a copy of a dataset dict with a new title, a new file for the
+    first changed_resources resources and one more resource.
+    '''
+    new = copy.deepcopy(package)
+    new['title'] = 'New title'
+    for resource in new['resources'][:changed_resources]:
+        resource['url'] += '?new'
+    new['resources'].append(dict(
+        new['resources'][0], id=str(uuid.uuid4()),
+        position=len(new['resources'])))
+    return new
+
+
+def create_portal(user_id, packages, resources, versions, batch=500):
+    '''
+    Inserts the datasets, resources, activities and versions of a portal,
+    committing every batch datasets. Returns a dict with the ids of the
+    datasets and resources and the number of versions.
+    '''
+    start = datetime(2020, 1, 1)
+    rows = _Rows()
+    portal = {'package_ids': [], 'resource_ids': [], 'versions': 0}
+
+    for p in range(packages):
+        package_id = str(uuid.uuid4())
+        package = package_dict(package_id, 'portal-{:06d}'.format(p),
+                               resources)
+        portal['package_ids'].append(package_id)
+        portal['resource_ids'].extend(r['id'] for r in package['resources'])
+
+        for v in range(versions):
+            timestamp = start + timedelta(minutes=p * versions + v)
+            for resource in package['resources']:
+                resource['url'] = resource['url'].split('?')[0] + \
+                    '?v={}'.format(v)
+            activity_id = str(uuid.uuid4())
+            rows.activities.append({
+                'id': activity_id,
+                'timestamp': timestamp,
+                'user_id': user_id,
+                'object_id': package_id,
+                'activity_type': 'changed package',
+                'data': {'package': copy.deepcopy(package)},
+            })
+            for resource in package['resources']:
+                rows.versions.append({
+                    'id': str(uuid.uuid4()),
+                    'package_id': package_id,
+                    'resource_id': resource['id'],
+                    'activity_id': activity_id,
+                    'name': 'v{}'.format(v),
+                    'creator_user_id': user_id,
+                    'created': timestamp,
+                    'modified': timestamp,
+                    'fingerprint': resource_fingerprint(resource),
+                })
+                portal['versions'] += 1
+
+        rows.packages.append({
+            'id': package_id,
+            'name': package['name'],
+            'title': package['title'],
+            'notes': package['notes'],
+            'state': 'active',
+            'type': 'dataset',
+            'private': False,
+            'creator_user_id': user_id,
+            'metadata_created': start,
+            'metadata_modified': start,
+        })
+        rows.resources.extend({
+            key: resource[key] for key in (
+                'id', 'package_id', 'name', 'description', 'url', 'format',
+                'position', 'size', 'state')
+        } for resource in package['resources'])
+
+        if len(rows.packages) >= batch:
+            rows.insert()
+    rows.insert()
+    return portal
+
+
+class _Rows(object):
+
+    def __init__(self):
+        self.packages = []
+        self.resources = []
+        self.activities = []
+        self.versions = []
+
+    def insert(self):
+        session = model.Session
+        session.bulk_insert_mappings(model.Package, self.packages)
+        session.bulk_insert_mappings(model.Resource, self.resources)
+        session.bulk_insert_mappings(model.Activity, self.activities)
+        session.bulk_insert_mappings(Version, self.versions)
+        session.commit()
+        self.__init__()
@@ -0,0 +1,110 @@
+'''
+Benchmarks of the JSON diff engine on synthetic datasets of about 5 MB,
+compared with diffing the rendered documents with difflib.
+
+Run them with:
+
+    pytest --benchmark-only ckanext/versions/tests/benchmarks
+'''
+import copy
+import difflib
+import json
+
+import pytest
+
+from ckanext.versions.lib.diff import unified_diff
+
+NUM_RESOURCES = 10000
+
+
+def _large_dataset():
+    return {
+        'id': 'dataset-id',
+        'name': 'large-dataset',
+        'title': 'Large dataset',
+        'notes': 'Lorem ipsum ' * 100,
+        'extras': [
+            {'key': 'extra-{}'.format(i), 'value': 'value ' * 10}
+            for i in range(200)
+        ],
+        'resources': [{
+            'id': 'resource-{:05d}'.format(i),
+            'name': 'Resource {}'.format(i),
+            'description': 'Description ' * 25,
+            'url': 'http://example.com/data/{}.csv'.format(i),
+            'format': 'CSV',
+            'position': i,
+            'size': i * 1024,
+        } for i in range(NUM_RESOURCES)],
+    }
+
+
+def _edit_few(dataset):
+    dataset['title'] = 'New title'
+    dataset['extras'][3]['value'] = 'new value'
+    dataset['resources'][NUM_RESOURCES // 2]['name'] = 'New name'
+
+
+def _remove_one_resource(dataset):
+    del dataset['resources'][NUM_RESOURCES * 3 // 4]
+
+
+def _edit_all_resources(dataset):
+    for resource in dataset['resources']:
+        resource['description'] = 'New description'
+
+
+def _remove_half_of_resources(dataset):
+    dataset['resources'] = dataset['resources'][::2]
+
+
+EDITS = {
+    'few': _edit_few,
+    'one_resource_removed': _remove_one_resource,
+    'all_resources': _edit_all_resources,
+    'half_of_resources_removed': _remove_half_of_resources,
+}
+
+
+@pytest.fixture(scope='module')
+def large_dataset():
+    dataset = _large_dataset()
+    assert len(json.dumps(dataset, indent=2)) > 5 * 1000 * 1000
+    return dataset
+
+
+def _edited(dataset, edit):
+    new = copy.deepcopy(dataset)
+    EDITS[edit](new)
+    return new
+
+
+def _difflib_unified_diff(obj1, obj2):
+    lines = [json.dumps(obj, indent=2, sort_keys=True).split('\n')
+             for obj in (obj1, obj2)]
+    return '\n'.join(difflib.unified_diff(*lines))
+
+
+@pytest.mark.parametrize('edit', sorted(EDITS))
+def test_unified_diff(benchmark, large_dataset, edit):
+    benchmark.group = 'unified diff: {}'.format(edit)
+    new = _edited(large_dataset, edit)
+
+    diff = benchmark.pedantic(
+        lambda: '\n'.join(unified_diff(large_dataset, new)),
+        rounds=3, iterations=1)
+
+    assert diff
+
+
+def test_difflib_unified_diff(benchmark, large_dataset):
+    # difflib takes minutes when many resources change, so it is only used
+    # as a baseline for a few changes
+    benchmark.group = 'unified diff: few'
+    new = _edited(large_dataset, 'few')
+
+    diff = benchmark.pedantic(
+        _difflib_unified_diff, args=(large_dataset, new),
+        rounds=3, iterations=1)
+
+    assert diff == '\n'.join(unified_diff(large_dataset, new))
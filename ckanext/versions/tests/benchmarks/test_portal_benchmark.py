@@ -0,0 +1,139 @@
+'''
+Benchmarks of the version actions and views on synthetic portals of several
+sizes (see portal.py), and of the diff and change detection functions on
+datasets with more and more resources.
+
+Run them with:
+
+    make benchmark
+
+which saves the results in .benchmarks, and compare a new run with the
+latest saved one with:
+
+    make benchmark-compare
+
+Set VERSIONS_BENCHMARK_SIZES to a comma separated list of small, medium and
+large to choose the portals (default: small,medium).
+'''
+import itertools
+
+import pytest
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.versions.lib.changes import check_resource_changes
+from ckanext.versions.logic import action
+from ckanext.versions.model import create_tables
+from ckanext.versions.tests import get_context
+from ckanext.versions.tests.benchmarks.portal import (
+    SIZES, benchmark_sizes, create_portal, edited_package, package_dict)
+
+RESOURCE_COUNTS = [10, 100, 1000, 10000]
+ROUNDS = 20
+
+
+@pytest.fixture(scope='module', params=benchmark_sizes())
+def portal(request):
+    helpers.reset_db()
+    create_tables()
+    user = factories.Sysadmin()
+    packages, resources, versions = SIZES[request.param]
+    portal = create_portal(user['id'], packages, resources, versions)
+    portal.update(size=request.param, context=get_context(user))
+    # A resource in the middle of the portal, with a full history
+    portal['resource_id'] = portal['resource_ids'][
+        len(portal['resource_ids']) // 2]
+    action.clear_version_cache()
+    return portal
+
+
+def _describe(benchmark, name, portal):
+    benchmark.group = '{}: {}'.format(name, portal['size'])
+    benchmark.extra_info.update(
+        size=portal['size'], versions=portal['versions'],
+        resources=len(portal['resource_ids']))
+
+
+def test_resource_version_list(benchmark, portal):
+    _describe(benchmark, 'resource_version_list', portal)
+    data_dict = {'resource_id': portal['resource_id']}
+
+    versions = benchmark.pedantic(
+        action.resource_version_list, args=(portal['context'], data_dict),
+        setup=action.clear_version_cache, rounds=ROUNDS)
+
+    assert versions
+
+
+def test_resource_history(benchmark, portal):
+    _describe(benchmark, 'resource_history', portal)
+    data_dict = {'resource_id': portal['resource_id']}
+
+    history = benchmark.pedantic(
+        action.resource_history, args=(portal['context'], data_dict),
+        setup=action.clear_version_cache, rounds=ROUNDS)
+
+    assert history
+
+
+def test_resource_version_create(benchmark, portal):
+    _describe(benchmark, 'resource_version_create', portal)
+    names = ('benchmark-{}'.format(i) for i in itertools.count())
+
+    def setup():
+        return (portal['context'], {
+            'resource_id': portal['resource_id'], 'name': next(names)}), {}
+
+    version = benchmark.pedantic(
+        action.resource_version_create, setup=setup, rounds=ROUNDS)
+
+    assert version['name'].startswith('benchmark-')
+
+
+def test_version_download(benchmark, portal, app):
+    _describe(benchmark, 'version_download', portal)
+    version = action.resource_version_current(
+        portal['context'], {'resource_id': portal['resource_id']})
+    url = toolkit.url_for(
+        'versions.version_download', id=version['package_id'],
+        resource_id=version['resource_id'], version_id=version['id'])
+
+    response = benchmark.pedantic(
+        app.get, args=(url,), kwargs={'follow_redirects': False},
+        setup=action.clear_version_cache, rounds=ROUNDS)
+
+    assert response.status_code == 302
+
+
+def _packages(num_resources):
+    old = package_dict('dataset-id', 'dataset', num_resources)
+    return old, edited_package(old, changed_resources=num_resources // 10)
+
+
+@pytest.mark.parametrize('num_resources', RESOURCE_COUNTS)
+@pytest.mark.parametrize('diff_type', ['unified', 'json_patch'])
+def test_generate_diff(benchmark, num_resources, diff_type):
+    benchmark.group = '_generate_diff {}: {} resources'.format(
+        diff_type, num_resources)
+    old, new = _packages(num_resources)
+
+    diff = benchmark.pedantic(
+        action._generate_diff, args=(old, new, diff_type), rounds=5)
+
+    assert diff
+
+
+@pytest.mark.parametrize('num_resources', RESOURCE_COUNTS)
+def test_check_resource_changes(benchmark, num_resources):
+    benchmark.group = 'check_resource_changes: {} resources'.format(
+        num_resources)
+    old, new = _packages(num_resources)
+
+    def check():
+        changes = []
+        check_resource_changes(changes, old, new, 'old-activity-id')
+        return changes
+
+    changes = benchmark.pedantic(check, rounds=5)
+
+    assert changes
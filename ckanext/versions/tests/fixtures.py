@@ -1,9 +1,90 @@
+import contextlib
+import gc
+import tracemalloc
+
 import pytest
 
-from ckanext.versions.model import create_tables, tables_exist
+from ckanext.versions.lib import queries
+from ckanext.versions.logic import action
+from ckanext.versions.model import create_tables, tables_exist, update_tables
 
 
 @pytest.fixture
 def versions_setup():
     if not tables_exist():
         create_tables()
+    else:
+        update_tables()
+    # Cached versions would outlive the tables cleaned by clean_db
+    action.clear_version_cache()
+    # Created again on first use, with the configuration of the test
+    action._version_cache = None
+    action._get_compare_cache().clear()
+
+
+@pytest.fixture
+def query_budget():
+    """Returns a context manager that fails the test if the block runs more
+    SQL statements than allowed, in total or mentioning a table::
+
+        with query_budget(version=1) as scope:
+            version_show(context, {'version_id': version_id})
+
+    The QueryScope returned lists the statements that were run.
+    """
+    @contextlib.contextmanager
+    def budget(total=None, **tables):
+        with queries.scope() as scope:
+            yield scope
+        if total is not None:
+            assert scope.count <= total, scope.report()
+        for table, allowed in tables.items():
+            assert scope.touching(table) <= allowed, \
+                '{} statements on {}, {} allowed\n{}'.format(
+                    scope.touching(table), table, allowed, scope.report())
+    return budget
+
+
+class MemoryUsage(object):
+    """The memory allocated by a block, see `memory_budget`."""
+
+    def __init__(self):
+        self.peak = 0
+        self.snapshot = None
+
+    def report(self, limit=10):
+        lines = ['Peak of {:.1f} MB'.format(self.peak / 1e6)]
+        if self.snapshot is not None:
+            lines.extend('  {}'.format(stat) for stat in
+                         self.snapshot.statistics('lineno')[:limit])
+        return '\n'.join(lines)
+
+
+@pytest.fixture
+def memory_budget():
+    """Returns a context manager that fails the test if the memory allocated
+    by the block peaks above max_bytes, as measured by tracemalloc::
+
+        with memory_budget(8 * 1000 * 1000) as usage:
+            resource_history(context, {'resource_id': resource_id})
+
+    Memory allocated before the block, like its inputs, is not counted. The
+    report of a failure lists the lines holding the most memory at the end
+    of the block.
+    """
+    @contextlib.contextmanager
+    def budget(max_bytes):
+        usage = MemoryUsage()
+        # Started afresh, so the peak only covers the block
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            yield usage
+            usage.snapshot = tracemalloc.take_snapshot()
+        finally:
+            usage.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        assert usage.peak <= max_bytes, usage.report()
+    return budget
@@ -1,5 +1,9 @@
+import io
+from datetime import datetime, timedelta
+from unittest import mock
 import pytest
 
+from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 
@@ -8,8 +12,12 @@ from ckanext.versions.logic.action import (
     resource_has_versions, resource_in_activity,
     resource_version_create, resource_version_current,
     resource_version_list, version_delete, version_show,
-    resource_version_clear
+    resource_version_clear, version_prune, version_feed,
+    resource_version_patch, version_compare, version_change_show,
+    resource_version_changelog, version_data_compare, resource_version_at
 )
+from ckanext.versions.logic import action
+from ckanext.versions.model import Version
 from ckanext.versions.tests import get_context
 
 
@@ -211,6 +219,68 @@ class TestCreateResourceVersion(object):
         assert version['name'] == '1'
         assert version['creator_user_id'] == user_creator['id']
 
+    def test_unchanged_resource_is_created_by_default(self):
+        resource = factories.Resource()
+        context = get_context(factories.Sysadmin())
+
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+
+        assert first['fingerprint']
+        assert second['fingerprint'] == first['fingerprint']
+        assert second['id'] != first['id']
+
+    def test_unchanged_resource_is_skipped(self):
+        resource = factories.Resource()
+        context = get_context(factories.Sysadmin())
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+
+        version = resource_version_create(context, {
+            'resource_id': resource['id'], 'name': '2',
+            'if_unchanged': 'skip'})
+
+        assert version['id'] == first['id']
+        assert len(resource_version_list(
+            context, {'resource_id': resource['id']})) == 1
+
+    def test_unchanged_resource_is_an_error(self):
+        resource = factories.Resource()
+        context = get_context(factories.Sysadmin())
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+
+        with pytest.raises(toolkit.ValidationError):
+            resource_version_create(context, {
+                'resource_id': resource['id'], 'name': '2',
+                'if_unchanged': 'error'})
+
+    def test_changed_resource_is_not_skipped(self):
+        resource = factories.Resource()
+        context = get_context(factories.Sysadmin())
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('resource_patch')(
+            context, {'id': resource['id'], 'url': 'http://example.com/new'})
+
+        version = resource_version_create(context, {
+            'resource_id': resource['id'], 'name': '2',
+            'if_unchanged': 'skip'})
+
+        assert version['id'] != first['id']
+        assert version['fingerprint'] != first['fingerprint']
+
+    def test_invalid_if_unchanged(self):
+        resource = factories.Resource()
+
+        with pytest.raises(toolkit.ValidationError):
+            resource_version_create(
+                get_context(factories.Sysadmin()), {
+                    'resource_id': resource['id'], 'name': '1',
+                    'if_unchanged': 'ignore'})
+
 
 @pytest.mark.usefixtures('clean_db', 'versions_setup')
 class TestResourceVersionUpdate(object):
@@ -495,6 +565,782 @@ class TestVersionShow(object):
         assert result['creator_user_id'] == user['id']
 
 
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+@pytest.mark.ckan_config('ckanext.versions.cache.enabled', 'true')
+class TestVersionCache(object):
+
+    def test_version_list_is_cached(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        resource_version_list(context, {'resource_id': resource['id']})
+
+        # Versions written without the actions are not seen until the cache
+        # is cleared
+        model.Session.query(Version).\
+            filter(Version.id == version['id']).update({'name': 'changed'})
+        model.Session.commit()
+        cached = resource_version_list(
+            context, {'resource_id': resource['id']})
+        action.clear_version_cache()
+        fresh = resource_version_list(
+            context, {'resource_id': resource['id']})
+
+        assert [v['name'] for v in cached] == ['1']
+        assert [v['name'] for v in fresh] == ['changed']
+
+    def test_write_actions_invalidate_the_cache(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        data_dict = {'resource_id': resource['id']}
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        assert resource_version_current(context, data_dict)['name'] == '1'
+        assert version_show(context, {'version_id': first['id']})
+
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        assert resource_version_current(context, data_dict)['name'] == '2'
+
+        resource_version_patch(
+            context, {'version_id': first['id'], 'name': 'patched'})
+        assert version_show(
+            context, {'version_id': first['id']})['name'] == 'patched'
+
+        version_delete(context, {'version_id': second['id']})
+        assert resource_version_current(
+            context, data_dict)['name'] == 'patched'
+        with pytest.raises(toolkit.ObjectNotFound):
+            version_show(context, {'version_id': second['id']})
+
+        resource_version_clear(context, data_dict)
+        assert resource_version_list(context, data_dict) == []
+        assert resource_version_current(context, data_dict) is None
+
+    def test_version_cache_stats(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        version_show(context, {'version_id': version['id']})
+        version_show(context, {'version_id': version['id']})
+
+        stats = helpers.call_action('version_cache_stats', context)
+
+        assert stats['versions']['local']['hits'] >= 1
+        assert stats['versions']['local']['misses'] >= 1
+        assert 'hits' in stats['compare']
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+def test_version_cache_is_off_by_default():
+    user = factories.Sysadmin()
+    context = get_context(user)
+    resource = factories.Resource()
+    version = resource_version_create(
+        context, {'resource_id': resource['id'], 'name': '1'})
+    version_show(context, {'version_id': version['id']})
+    resource_version_list(context, {'resource_id': resource['id']})
+
+    stats = helpers.call_action('version_cache_stats', context)
+
+    assert action._get_version_cache() is None
+    assert stats['versions'] is None
+
+
+def _create_dated_versions(context, resource, *dates):
+    versions = []
+    for i, created in enumerate(dates):
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': str(i + 1)})
+        model.Session.query(Version).\
+            filter(Version.id == version['id']).\
+            update({'created': created})
+        versions.append(version)
+    model.Session.commit()
+    action.clear_version_cache()
+    return versions
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestResourceVersionAt(object):
+
+    @pytest.mark.parametrize('index', [False, pytest.param(
+        True, marks=pytest.mark.ckan_config(
+            'ckanext.versions.index.enabled', 'true'))])
+    def test_version_at(self, index):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        _create_dated_versions(
+            context, resource, '2021-01-01 00:00:00', '2021-02-01 00:00:00')
+
+        def name_at(timestamp):
+            version = resource_version_at(context, {
+                'resource_id': resource['id'], 'timestamp': timestamp})
+            return version['name'] if version else None
+
+        assert name_at('2020-12-31T23:59:59') is None
+        assert name_at('2021-01-01T00:00:00') == '1'
+        assert name_at('2021-01-31') == '1'
+        assert name_at('2021-02-01T01:00:00+02:00') == '1'
+        assert name_at('2021-02-01T00:00:00Z') == '2'
+        assert name_at('2030-01-01') == '2'
+        assert (action._version_index is not None) == index
+
+    @pytest.mark.parametrize('index', [False, pytest.param(
+        True, marks=pytest.mark.ckan_config(
+            'ckanext.versions.index.enabled', 'true'))])
+    def test_partial_timestamps_are_the_end_of_their_period(self, index):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        _create_dated_versions(
+            context, resource, '2021-01-15 00:00:00', '2021-02-01 00:00:00')
+
+        def name_at(timestamp):
+            version = resource_version_at(context, {
+                'resource_id': resource['id'], 'timestamp': timestamp})
+            return version['name'] if version else None
+
+        assert name_at('2020') is None
+        assert name_at('2021-01') == '1'
+        assert name_at('2021-01-31T23') == '1'
+        assert name_at('2021') == '2'
+        assert name_at('2021-02') == '2'
+
+    @pytest.mark.parametrize('index', [False, pytest.param(
+        True, marks=pytest.mark.ckan_config(
+            'ckanext.versions.index.enabled', 'true'))])
+    def test_versions_created_at_the_same_time(self, index):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        versions = _create_dated_versions(
+            context, resource, '2021-01-01 00:00:00', '2021-01-01 00:00:00')
+
+        version = resource_version_at(context, {
+            'resource_id': resource['id'], 'timestamp': '2021-01-01'})
+
+        assert version['id'] == max(v['id'] for v in versions)
+
+    @pytest.mark.parametrize('index', [False, pytest.param(
+        True, marks=pytest.mark.ckan_config(
+            'ckanext.versions.index.enabled', 'true'))])
+    def test_current_version_of_versions_created_at_the_same_time(
+            self, index):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        versions = _create_dated_versions(
+            context, resource, '2021-01-01 00:00:00', '2021-01-01 00:00:00')
+
+        version = resource_version_current(
+            context, {'resource_id': resource['id']})
+
+        assert version['id'] == max(v['id'] for v in versions)
+
+    @pytest.mark.parametrize('timestamp', ['yesterday', '05-15', '10:30'])
+    def test_invalid_timestamp(self, timestamp):
+        context = get_context(factories.Sysadmin())
+        resource = factories.Resource()
+
+        with pytest.raises(toolkit.ValidationError):
+            resource_version_at(context, {
+                'resource_id': resource['id'], 'timestamp': timestamp})
+
+    def test_unknown_resource(self):
+        context = get_context(factories.Sysadmin())
+
+        with pytest.raises(toolkit.ObjectNotFound):
+            resource_version_at(context, {
+                'resource_id': 'unknown', 'timestamp': '2021-01-01'})
+
+
+@pytest.mark.ckan_config('ckanext.versions.index.enabled', 'true')
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionIndex(object):
+
+    def test_lookups_use_the_index(self, query_budget):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        data_dict = {'resource_id': resource['id']}
+        assert not resource_has_versions(context, data_dict)
+
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        # The resource is reloaded once after the versions were created
+        assert resource_has_versions(context, data_dict)
+
+        with query_budget(version=0):
+            assert resource_has_versions(context, data_dict)
+            current = resource_version_current(context, data_dict)
+            assert get_activity_id_from_resource_version_name(
+                context, dict(data_dict, version_name='1')) == \
+                first['activity_id']
+            assert resource_version_at(context, dict(
+                data_dict, timestamp=first['created']))['id'] == first['id']
+
+        assert current == version_show(context, {'version_id': second['id']})
+        assert action._version_index.stats()['reloaded_resources'] == 1
+
+    def test_write_actions_update_the_index(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        data_dict = {'resource_id': resource['id']}
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        assert resource_version_current(context, data_dict)['name'] == '2'
+
+        resource_version_patch(
+            context, {'version_id': second['id'], 'notes': 'Patched'})
+        assert resource_version_current(
+            context, data_dict)['notes'] == 'Patched'
+
+        version_delete(context, {'version_id': second['id']})
+        assert resource_version_current(
+            context, data_dict)['id'] == first['id']
+        with pytest.raises(toolkit.ObjectNotFound):
+            get_activity_id_from_resource_version_name(
+                context, dict(data_dict, version_name='2'))
+
+        version_delete(context, {'version_id': first['id']})
+        assert not resource_has_versions(context, data_dict)
+
+    @pytest.mark.ckan_config('ckanext.versions.index.rebuild', '0')
+    def test_versions_deleted_by_other_processes_leave_on_rebuild(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        data_dict = {'resource_id': resource['id']}
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        assert resource_version_current(context, data_dict)['name'] == '2'
+
+        # Deleted by another process, without invalidating this index
+        model.Session.query(Version).\
+            filter(Version.id == second['id']).delete()
+        model.Session.commit()
+
+        assert resource_version_current(context, data_dict)['name'] == '1'
+
+    def test_unknown_resource(self):
+        context = get_context(factories.Sysadmin())
+
+        with pytest.raises(toolkit.ObjectNotFound):
+            resource_has_versions(context, {'resource_id': 'unknown'})
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+@pytest.mark.ckan_config('ckanext.versions.feed_delay', '0')
+class TestVersionFeed(object):
+
+    def test_version_feed_polling(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        for name in ('1', '2', '3'):
+            resource_version_create(
+                context, {'resource_id': resource['id'], 'name': name})
+
+        result = version_feed(context, {'limit': 2})
+        assert [v['name'] for v in result['versions']] == ['1', '2']
+
+        result = version_feed(context, {'cursor': result['cursor']})
+        assert [v['name'] for v in result['versions']] == ['3']
+
+        cursor = result['cursor']
+        result = version_feed(context, {'cursor': cursor})
+        assert result == {'versions': [], 'cursor': cursor}
+
+    def test_version_feed_includes_edited_versions(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        cursor = version_feed(context, {})['cursor']
+
+        resource_version_patch(
+            context, {'version_id': version['id'], 'notes': 'Edited'})
+
+        result = version_feed(context, {'cursor': cursor})
+        assert [v['id'] for v in result['versions']] == [version['id']]
+        assert result['versions'][0]['notes'] == 'Edited'
+
+    def test_version_feed_filters(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        resource = factories.Resource(package_id=dataset['id'])
+        other_resource = factories.Resource()
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        resource_version_create(
+            context, {'resource_id': other_resource['id'], 'name': '2'})
+
+        result = version_feed(context, {'organization': org['name']})
+        assert [v['name'] for v in result['versions']] == ['1']
+
+        result = version_feed(
+            context, {'package_id': other_resource['package_id']})
+        assert [v['name'] for v in result['versions']] == ['2']
+
+    def test_version_feed_hides_private_datasets(self):
+        user = factories.Sysadmin()
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'], private=True)
+        resource = factories.Resource(package_id=dataset['id'])
+        resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+
+        assert len(version_feed(get_context(user), {})['versions']) == 1
+        assert version_feed(
+            get_context(factories.User()), {})['versions'] == []
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+@pytest.mark.ckan_config('ckanext.versions.feed_delay', '60')
+def test_version_feed_holds_back_recent_versions():
+    user = factories.Sysadmin()
+    context = get_context(user)
+    resource = factories.Resource()
+    version = resource_version_create(
+        context, {'resource_id': resource['id'], 'name': '1'})
+
+    result = version_feed(context, {})
+    assert result['versions'] == []
+
+    model.Session.query(Version).filter(Version.id == version['id']).\
+        update({'modified': datetime.utcnow() - timedelta(minutes=2)})
+    model.Session.commit()
+    result = version_feed(context, {'cursor': result['cursor']})
+    assert [v['id'] for v in result['versions']] == [version['id']]
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionCompare(object):
+
+    def _create_two_versions(self, context):
+        dataset = factories.Dataset(title='Old title')
+        resource = factories.Resource(
+            package_id=dataset['id'], name='Old name')
+        old_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('package_patch')(
+            context, {'id': dataset['id'], 'title': 'New title'})
+        toolkit.get_action('resource_patch')(
+            context, {'id': resource['id'], 'name': 'New name'})
+        new_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        return old_version, new_version
+
+    def test_version_compare(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        result = version_compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+        })
+
+        assert result['old_version']['id'] == old_version['id']
+        assert result['new_version']['id'] == new_version['id']
+        assert 'diff' not in result
+        changes = {change['type']: change for change in result['changes']}
+        assert changes['title']['old_title'] == 'Old title'
+        assert changes['title']['new_title'] == 'New title'
+        assert changes['resource_name']['old_resource_name'] == 'Old name'
+        assert changes['resource_name']['new_resource_name'] == 'New name'
+
+    def test_version_compare_with_diff(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        result = version_compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+            'diff_type': 'unified',
+        })
+
+        assert '-  "title": "Old title",' in result['diff']
+        assert '+  "title": "New title",' in result['diff']
+
+    def test_version_compare_with_json_patch(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        result = version_compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+            'diff_type': 'json_patch',
+        })
+
+        assert {'op': 'replace', 'path': '/title',
+                'value': 'New title'} in result['diff']
+        assert {'op': 'replace', 'path': '/resources/0/name',
+                'value': 'New name'} in result['diff']
+
+    def test_version_compare_resource_only(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        result = version_compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+            'resource_only': True,
+            'diff_type': 'unified',
+        })
+
+        assert [change['type'] for change in result['changes']] == \
+            ['resource_name']
+        assert '"title"' not in result['diff']
+        assert '+    "name": "New name",' in result['diff']
+
+    def test_version_compare_is_cached(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+        data_dict = {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+        }
+
+        with mock.patch.object(action, '_compare_activities',
+                               wraps=action._compare_activities) as compare:
+            first = version_compare(context, data_dict)
+            first['changes'].append('modified by the caller')
+            second = version_compare(context, data_dict)
+            version_compare(context, dict(data_dict, diff_type='html'))
+
+        assert compare.call_count == 2
+        assert 'modified by the caller' not in second['changes']
+
+    def test_version_compare_invalid_diff_type(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        with pytest.raises(toolkit.ValidationError):
+            version_compare(context, {
+                'old_version_id': old_version['id'],
+                'new_version_id': new_version['id'],
+                'diff_type': 'xml',
+            })
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionDataCompare(object):
+
+    def _create_two_versions(self, context, data_format='CSV'):
+        resource = factories.Resource(format=data_format)
+        old_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('resource_patch')(
+            context, {'id': resource['id'], 'description': 'New data'})
+        new_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        return old_version, new_version
+
+    def _compare(self, context, data_dict, old, new):
+        files = [io.BytesIO(old), io.BytesIO(new)]
+        with mock.patch.object(action, '_open_version_data',
+                               side_effect=files):
+            return version_data_compare(context, data_dict)
+
+    def test_version_data_compare(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        result = self._compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+            'key': 'id',
+        }, b'id,value\n1,a\n2,b\n3,c\n', b'id,value\n1,a\n2,x\n4,d\n')
+
+        assert result['old_version']['id'] == old_version['id']
+        assert (result['added'], result['removed'], result['changed'],
+                result['unchanged']) == (1, 1, 1, 1)
+        assert result['rows']['changed'] == [{
+            'old': {'id': '2', 'value': 'b'},
+            'new': {'id': '2', 'value': 'x'},
+        }]
+
+    def test_version_data_compare_unknown_key(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        with pytest.raises(toolkit.ValidationError):
+            self._compare(context, {
+                'old_version_id': old_version['id'],
+                'new_version_id': new_version['id'],
+                'key': ['missing'],
+            }, b'id\n1\n', b'id\n1\n')
+
+    @pytest.mark.ckan_config('ckanext.versions.data_diff_max_size', '100')
+    def test_version_data_compare_max_size(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            self._compare(context, {
+                'old_version_id': old_version['id'],
+                'new_version_id': new_version['id'],
+            }, b'id\n' + b'1\n' * 100, b'id\n1\n')
+        assert 'larger than 100 bytes' in str(e.value.error_dict)
+
+    @pytest.mark.ckan_config('ckanext.versions.data_diff_memory', '5000')
+    def test_version_data_compare_spills_over_memory(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(context)
+        old = b'id,value\n' + b''.join(
+            b'%d,%d\n' % (i, i % 7) for i in range(1000))
+        new = b'id,value\n' + b''.join(
+            b'%d,%d\n' % (i, i % 5) for i in range(500, 1500))
+
+        result = self._compare(context, {
+            'old_version_id': old_version['id'],
+            'new_version_id': new_version['id'],
+            'key': 'id',
+        }, old, new)
+
+        assert (result['added'], result['removed'], result['changed'],
+                result['unchanged']) == (500, 500, 430, 70)
+
+    def test_version_data_compare_requires_editors(self):
+        user = factories.Sysadmin()
+        old_version, new_version = self._create_two_versions(
+            get_context(user))
+
+        with pytest.raises(toolkit.NotAuthorized):
+            self._compare(get_context(factories.User()), {
+                'old_version_id': old_version['id'],
+                'new_version_id': new_version['id'],
+            }, b'id\n1\n', b'id\n1\n')
+
+    def test_version_data_compare_requires_tabular_files(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        old_version, new_version = self._create_two_versions(
+            context, data_format='JSON')
+
+        with pytest.raises(toolkit.ValidationError):
+            version_data_compare(context, {
+                'old_version_id': old_version['id'],
+                'new_version_id': new_version['id'],
+            })
+
+
+class _Version(object):
+    id = 'version-id'
+    resource_id = 'resource-id'
+
+
+class TestOpenVersionData(object):
+
+    @pytest.mark.parametrize('url', [
+        'http://127.0.0.1/data.csv',
+        'http://localhost:5000/data.csv',
+        'http://169.254.169.254/latest/meta-data',
+        'http://[::1]/data.csv',
+        'file:///etc/passwd',
+    ])
+    def test_internal_urls_are_refused(self, url):
+        with mock.patch('requests.get') as get:
+            with pytest.raises(toolkit.ValidationError):
+                action._open_version_data(_Version(), {'url': url})
+        get.assert_not_called()
+
+    @pytest.mark.ckan_config(
+        'ckanext.versions.data_diff_allowed_hosts', 'data.example.com')
+    def test_allowed_hosts(self):
+        with pytest.raises(toolkit.ValidationError):
+            action._check_data_url('http://other.example.com/data.csv')
+        action._check_data_url('https://data.example.com/data.csv')
+
+    @pytest.mark.ckan_config(
+        'ckanext.versions.data_diff_allowed_hosts', 'data.example.com')
+    def test_links_are_downloaded_without_credentials(self):
+        response = mock.Mock(is_redirect=False)
+        with mock.patch('requests.get', return_value=response) as get:
+            f = action._open_version_data(
+                _Version(), {'url': 'http://data.example.com/data.csv'})
+
+        assert f is response.raw
+        assert 'headers' not in get.call_args[1]
+        assert get.call_args[1]['allow_redirects'] is False
+
+    @pytest.mark.ckan_config(
+        'ckanext.versions.data_diff_allowed_hosts', 'data.example.com')
+    def test_redirects_are_checked(self):
+        response = mock.Mock(
+            is_redirect=True,
+            headers={'Location': 'http://127.0.0.1/data.csv'})
+        with mock.patch('requests.get', return_value=response) as get:
+            with pytest.raises(toolkit.ValidationError):
+                action._open_version_data(
+                    _Version(), {'url': 'http://data.example.com/data.csv'})
+        assert get.call_count == 1
+
+    @pytest.mark.usefixtures('clean_db', 'versions_setup')
+    def test_uploads_are_read_through_the_uploader(self, tmp_path):
+        resource = factories.Resource(url_type='upload', url='data.csv')
+        resource = toolkit.get_action('resource_show')(
+            {'ignore_auth': True}, {'id': resource['id']})
+        path = tmp_path / 'data.csv'
+        path.write_bytes(b'id\n1\n')
+        version = _Version()
+        version.resource_id = resource['id']
+        upload = mock.Mock(get_path=mock.Mock(return_value=str(path)))
+
+        with mock.patch.object(action.uploader, 'get_resource_uploader',
+                               return_value=upload):
+            with action._open_version_data(version, resource) as f:
+                assert f.read() == b'id\n1\n'
+            # Fields added by plugins are not part of the file
+            with action._open_version_data(
+                    version, dict(resource, extra_field='value')) as f:
+                assert f.read() == b'id\n1\n'
+            # An older file of the resource
+            with pytest.raises(toolkit.ValidationError):
+                action._open_version_data(
+                    version, dict(resource, size=1234))
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionChangelog(object):
+
+    def test_first_version_has_no_changes(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+
+        result = version_change_show(context, {'version_id': version['id']})
+
+        assert result['version_id'] == version['id']
+        assert result['previous_version_id'] is None
+        assert result['changes'] == []
+        assert datetime.fromisoformat(result['created']) >= \
+            datetime.fromisoformat(version['created'])
+
+    def test_changes_are_stored_on_create(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset(title='Old title')
+        resource = factories.Resource(
+            package_id=dataset['id'], name='Old name')
+        other_resource = factories.Resource(package_id=dataset['id'])
+        old_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('package_patch')(
+            context, {'id': dataset['id'], 'title': 'New title'})
+        toolkit.get_action('resource_patch')(
+            context, {'id': other_resource['id'], 'name': 'Other name'})
+        toolkit.get_action('resource_patch')(
+            context, {'id': resource['id'], 'name': 'New name'})
+        new_version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+
+        result = version_change_show(
+            context, {'version_id': new_version['id']})
+
+        assert result['previous_version_id'] == old_version['id']
+        assert sorted(change['type'] for change in result['changes']) == \
+            ['resource_name', 'title']
+
+    def test_changes_are_not_computed_for_the_same_activity(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+
+        with mock.patch.object(action, '_get_activity_packages') as get:
+            version = resource_version_create(
+                context, {'resource_id': resource['id'], 'name': '2'})
+
+        assert not get.called
+        assert version_change_show(
+            context, {'version_id': version['id']})['changes'] == []
+
+    def test_create_does_not_fail_if_changes_fail(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'])
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('package_patch')(
+            context, {'id': dataset['id'], 'title': 'New title'})
+
+        with mock.patch.object(action, '_get_activity_packages',
+                               side_effect=Exception('Boom')):
+            version = resource_version_create(
+                context, {'resource_id': resource['id'], 'name': '2'})
+
+        assert version_show(context, {'version_id': version['id']})
+        with pytest.raises(toolkit.ObjectNotFound):
+            version_change_show(context, {'version_id': version['id']})
+
+    def test_resource_version_changelog(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset(title='Old title')
+        resource = factories.Resource(package_id=dataset['id'])
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('package_patch')(
+            context, {'id': dataset['id'], 'title': 'New title'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+
+        changelog = resource_version_changelog(
+            context, {'resource_id': resource['id']})
+
+        assert [v['id'] for v in changelog] == [second['id'], first['id']]
+        assert changelog[0]['previous_version_id'] == first['id']
+        assert [c['type'] for c in changelog[0]['changes']] == ['title']
+        assert changelog[1]['previous_version_id'] is None
+        assert changelog[1]['changes'] == []
+
+    def test_changelog_requires_read_access(self):
+        dataset = factories.Dataset(private=True,
+                                    owner_org=factories.Organization()['id'])
+        resource = factories.Resource(package_id=dataset['id'])
+
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'resource_version_changelog',
+                context={'user': factories.User()['name'],
+                         'ignore_auth': False},
+                resource_id=resource['id'])
+
+
 @pytest.mark.usefixtures('clean_db', 'versions_setup')
 class TestVersionDelete(object):
 
@@ -538,11 +1384,128 @@ class TestVersionDelete(object):
                 }
             )
 
-        assert len(resource_version_list(context, {'resource_id': resource['id']})) == 3
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+        assert len(versions) == 3
 
         resource_version_clear(context, {'resource_id': resource['id']})
 
-        assert len(resource_version_list(context, {'resource_id': resource['id']})) == 0
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+        assert len(versions) == 0
+
+    def test_resource_version_clear_in_batches(self):
+        resource = factories.Resource()
+        user = factories.Sysadmin()
+        context = get_context(user)
+
+        for i in range(0, 5):
+            resource_version_create(
+                context, {'resource_id': resource['id'], 'name': str(i)}
+            )
+
+        resource_version_clear(
+            context, {'resource_id': resource['id'], 'batch_size': 2}
+        )
+
+        assert resource_version_list(
+            context, {'resource_id': resource['id']}) == []
+
+    def test_resource_version_clear_fails_if_no_versions(self):
+        resource = factories.Resource()
+        user = factories.Sysadmin()
+
+        with pytest.raises(toolkit.ObjectNotFound):
+            resource_version_clear(
+                get_context(user), {'resource_id': resource['id']}
+            )
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionPrune(object):
+
+    def _create_versions(self, context, resource, count):
+        for i in range(0, count):
+            resource_version_create(
+                context, {'resource_id': resource['id'], 'name': str(i)}
+            )
+
+    def test_keep_last(self):
+        resource = factories.Resource()
+        other_resource = factories.Resource()
+        user = factories.Sysadmin()
+        context = get_context(user)
+        self._create_versions(context, resource, 5)
+        self._create_versions(context, other_resource, 2)
+
+        result = version_prune(context, {'keep_last': 2, 'batch_size': 2})
+
+        assert result['deleted'] == 3
+        assert result['cursor'] is None
+        names = [v['name'] for v in resource_version_list(
+            context, {'resource_id': resource['id']})]
+        assert names == ['4', '3']
+        assert len(resource_version_list(
+            context, {'resource_id': other_resource['id']})) == 2
+
+    def test_keep_last_ranks_a_few_resources_at_a_time(self):
+        resources = [factories.Resource() for i in range(4)]
+        user = factories.Sysadmin()
+        context = get_context(user)
+        for count, resource in zip((1, 3, 1, 2), resources):
+            self._create_versions(context, resource, count)
+
+        result = version_prune(context, {'keep_last': 1, 'batch_size': 1})
+
+        assert result['deleted'] == 3
+        assert result['cursor'] is None
+        for resource in resources:
+            assert len(resource_version_list(
+                context, {'resource_id': resource['id']})) == 1
+
+    def test_older_than(self):
+        resource = factories.Resource()
+        user = factories.Sysadmin()
+        context = get_context(user)
+        self._create_versions(context, resource, 3)
+        newest = resource_version_current(
+            context, {'resource_id': resource['id']})
+
+        result = version_prune(context, {
+            'resource_id': resource['id'],
+            'older_than': newest['created'],
+        })
+
+        assert result['deleted'] == 2
+        assert [v['id'] for v in resource_version_list(
+            context, {'resource_id': resource['id']})] == [newest['id']]
+
+    def test_resumes_from_cursor(self):
+        resource = factories.Resource()
+        user = factories.Sysadmin()
+        context = get_context(user)
+        self._create_versions(context, resource, 5)
+
+        result = version_prune(context, {
+            'keep_last': 0, 'batch_size': 2, 'max_batches': 1
+        })
+        assert result['deleted'] == 2
+        assert result['cursor']['resource_id'] == resource['id']
+
+        result = version_prune(context, {
+            'keep_last': 0, 'batch_size': 2, 'cursor': result['cursor']
+        })
+        assert result['deleted'] == 3
+        assert result['cursor'] is None
+        assert resource_version_list(
+            context, {'resource_id': resource['id']}) == []
+
+    def test_requires_a_policy(self):
+        user = factories.Sysadmin()
+
+        with pytest.raises(toolkit.ValidationError):
+            version_prune(get_context(user), {})
+
 
 @pytest.mark.usefixtures('clean_db', 'versions_setup')
 class TestActivityActions(object):
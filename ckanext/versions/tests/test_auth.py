@@ -77,6 +77,37 @@ class TestVersionsAuth(object):
                 context=context,
                 package_id=dataset['id'])
 
+    @pytest.mark.parametrize("user_type, dataset_type", [
+        ('org_editor', 'public_dataset'),
+        ('admin_user', 'public_dataset'),
+    ])
+    def test_data_compare_is_authorized(self, user_type, dataset_type):
+        """Test that editors can compare the data files of versions
+        """
+        user = getattr(self, user_type)
+        dataset = getattr(self, dataset_type)
+        context = self._get_context(user)
+        assert helpers.call_auth('version_data_compare',
+                                 context=context,
+                                 package_id=dataset['id'])
+
+    @pytest.mark.parametrize("user_type, dataset_type", [
+        ('org_member', 'public_dataset'),
+        ('other_org_admin', 'public_dataset'),
+    ])
+    def test_data_compare_is_unauthorized(self, user_type, dataset_type):
+        """Test that users who can only read a dataset cannot make the server
+        download and compare its files
+        """
+        user = getattr(self, user_type)
+        dataset = getattr(self, dataset_type)
+        context = self._get_context(user)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth(
+                'version_data_compare',
+                context=context,
+                package_id=dataset['id'])
+
     @pytest.mark.parametrize("user_type, dataset_type", [
         ('org_admin', 'private_dataset'),
         ('org_admin', 'public_dataset'),
@@ -187,3 +218,52 @@ class TestVersionsAuth(object):
                 'version_show',
                 context=context,
                 package_id=dataset['id'])
+
+    @pytest.mark.parametrize("user_type, dataset_type", [
+        ('org_admin', 'private_dataset'),
+        ('org_editor', 'public_dataset'),
+        ('admin_user', 'private_dataset'),
+    ])
+    def test_prune_dataset_is_authorized(self, user_type, dataset_type):
+        """Test that users who can modify a dataset can prune its versions
+        """
+        user = getattr(self, user_type)
+        dataset = getattr(self, dataset_type)
+        context = self._get_context(user)
+        assert helpers.call_auth('version_prune',
+                                 context=context,
+                                 package_id=dataset['id'])
+
+    @pytest.mark.parametrize("user_type", [
+        'org_admin',
+        'org_editor',
+        'other_org_admin',
+    ])
+    def test_prune_site_is_unauthorized(self, user_type):
+        """Test that only sysadmins can prune versions of the whole site
+        """
+        user = getattr(self, user_type)
+        context = self._get_context(user)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth('version_prune', context=context)
+
+    def test_cache_stats_is_unauthorized(self):
+        """Test that only sysadmins can see the cache stats
+        """
+        context = self._get_context(self.org_admin)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth('version_cache_stats', context=context)
+
+    def test_metrics_is_unauthorized(self):
+        """Test that only sysadmins can see the metrics
+        """
+        context = self._get_context(self.org_admin)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth('version_metrics', context=context)
+
+    def test_profile_is_unauthorized(self):
+        """Test that only sysadmins can see the profiles
+        """
+        context = self._get_context(self.org_admin)
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth('version_profile', context=context)
@@ -0,0 +1,109 @@
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories
+
+from ckanext.versions.lib.backfill import (
+    backfill_changes, backfill_packages, iter_package_id_batches,
+    read_checkpoint, write_checkpoint)
+from ckanext.versions.logic.action import (
+    resource_version_changelog, resource_version_create,
+    resource_version_list)
+from ckanext.versions.model import VersionChange
+from ckanext.versions.tests import get_context
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestBackfill(object):
+
+    def test_creates_versions_for_resources_without_versions(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'])
+        versioned_resource = factories.Resource(package_id=dataset['id'])
+        resource_version_create(
+            context, {'resource_id': versioned_resource['id'], 'name': 'v1'})
+
+        result = backfill_packages(
+            [dataset['id']], '1.0', 'Initial version', user['id'])
+
+        assert result['resources'] == 2
+        assert result['versions'] == 1
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+        assert len(versions) == 1
+        assert versions[0]['name'] == '1.0'
+        assert versions[0]['notes'] == 'Initial version'
+        assert versions[0]['fingerprint']
+        assert [v['name'] for v in resource_version_list(
+            context, {'resource_id': versioned_resource['id']})] == ['v1']
+
+    def test_running_twice_does_not_duplicate_versions(self):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'])
+
+        assert backfill_packages(
+            [dataset['id']], '1.0', None, user['id'])['versions'] == 1
+        assert backfill_packages(
+            [dataset['id']], '1.0', None, user['id'])['versions'] == 0
+
+    def test_iter_package_id_batches(self):
+        dataset_ids = sorted(factories.Dataset()['id'] for _ in range(5))
+
+        batches = list(iter_package_id_batches(2))
+        assert batches == [dataset_ids[0:2], dataset_ids[2:4], dataset_ids[4:]]
+
+        batches = list(iter_package_id_batches(2, after=dataset_ids[2]))
+        assert batches == [dataset_ids[3:]]
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestBackfillChanges(object):
+
+    def test_computes_missing_changes(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset(title='Old title')
+        resource = factories.Resource(package_id=dataset['id'])
+        first = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        toolkit.get_action('package_patch')(
+            context, {'id': dataset['id'], 'title': 'New title'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        expected = resource_version_changelog(
+            context, {'resource_id': resource['id']})
+        model.Session.query(VersionChange).delete()
+        model.Session.commit()
+
+        result = backfill_changes(batch_size=1)
+
+        assert result == {'versions': 2, 'changes': 2}
+        changelog = resource_version_changelog(
+            context, {'resource_id': resource['id']})
+        assert [v['id'] for v in changelog] == [second['id'], first['id']]
+        assert [(v['previous_version_id'], v['changes'])
+                for v in changelog] == \
+            [(v['previous_version_id'], v['changes']) for v in expected]
+
+    def test_running_twice_does_not_duplicate_changes(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+
+        assert backfill_changes(batch_size=10) == \
+            {'versions': 1, 'changes': 0}
+
+
+def test_checkpoint_round_trip(tmpdir):
+    path = str(tmpdir.join('checkpoint.json'))
+    assert read_checkpoint(path)['last_package_id'] is None
+
+    progress = {'last_package_id': 'abc',
+                'packages': 1, 'resources': 2, 'versions': 3}
+    write_checkpoint(path, progress)
+
+    assert read_checkpoint(path) == progress
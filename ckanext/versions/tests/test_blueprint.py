@@ -42,3 +42,109 @@ def test_download_url_preserves_params(app):
     resp = app.get(download_url, follow_redirects=False)
 
     assert "sensitive=True" in resp.headers["Location"]
+
+
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+@pytest.mark.ckan_config("ckanext.versions.feed_delay", "0")
+def test_version_feed(app):
+    resource = factories.Resource()
+    user = factories.Sysadmin()
+    version = resource_version_create(
+        get_context(user), {"resource_id": resource["id"], "name": "1"}
+    )
+
+    resp = app.get(toolkit.url_for("versions.version_feed"))
+
+    assert resp.status_code == 200
+    assert [v["id"] for v in resp.json["versions"]] == [version["id"]]
+    assert "cursor=" in resp.json["next"]
+
+    resp = app.get(resp.json["next"])
+
+    assert resp.json["versions"] == []
+
+
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_version_feed_invalid_cursor(app):
+    url = toolkit.url_for("versions.version_feed", cursor="not-a-cursor")
+
+    resp = app.get(url, status=400)
+
+    assert resp.status_code == 400
+
+
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_download_at_timestamp(app):
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset["id"])
+    user = factories.Sysadmin()
+    version = resource_version_create(
+        get_context(user), {"resource_id": resource["id"], "name": "1"})
+
+    url = toolkit.url_for(
+        "versions.version_at_download",
+        id=dataset["id"],
+        resource_id=resource["id"],
+        timestamp="2100-01-01T00:00:00",
+    )
+    resp = app.get(url, follow_redirects=False)
+
+    assert resp.status_code == 302
+    assert version["activity_id"] in resp.headers["Location"]
+
+    url = toolkit.url_for(
+        "versions.version_at_download",
+        id=dataset["id"],
+        resource_id=resource["id"],
+        timestamp="2000-01-01T00:00:00",
+    )
+    app.get(url, status=404)
+
+
+@pytest.mark.ckan_config("ckanext.versions.metrics.enabled", "true")
+@pytest.mark.ckan_config("ckanext.versions.metrics.token", "secret")
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_metrics(app):
+    url = toolkit.url_for("versions.version_metrics")
+    app.get(toolkit.url_for("versions.version_feed"))
+
+    app.get(url, status=403)
+    app.get(url, headers={"Authorization": "Bearer wrong"}, status=403)
+    resp = app.get(url, headers={"Authorization": "Bearer secret"})
+
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    assert 'versions_calls_total{kind="view",name="version_feed"}' in \
+        resp.body
+
+
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_metrics_disabled(app):
+    app.get(toolkit.url_for("versions.version_metrics"), status=404)
+
+
+@pytest.mark.ckan_config("ckanext.versions.profiling.enabled", "true")
+@pytest.mark.ckan_config("ckanext.versions.profiling.rate", "1")
+@pytest.mark.ckan_config("ckanext.versions.profiling.token", "secret")
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_profile(app):
+    url = toolkit.url_for("versions.version_profile")
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset["id"])
+    helpers.call_action("resource_version_list", resource_id=resource["id"])
+
+    app.get(url, status=403)
+    app.get(url, headers={"Authorization": "Bearer wrong"}, status=403)
+    app.get(toolkit.url_for("versions.version_profile", sort="name"),
+            headers={"Authorization": "Bearer secret"}, status=400)
+    resp = app.get(
+        toolkit.url_for("versions.version_profile",
+                        name="resource_version_list"),
+        headers={"Authorization": "Bearer secret"})
+
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    assert "=== resource_version_list ===" in resp.body
+
+
+@pytest.mark.usefixtures("clean_db", "versions_setup")
+def test_profile_disabled(app):
+    app.get(toolkit.url_for("versions.version_profile"), status=404)
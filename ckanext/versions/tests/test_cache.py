@@ -0,0 +1,221 @@
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from ckanext.versions.lib.cache import LRUCache, MmapCache, TwoTierCache
+
+
+class TestLRUCache(object):
+
+    def test_discards_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_items_expire(self):
+        cache = LRUCache(10, ttl=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            cache.set('a', 1)
+        with mock.patch('time.monotonic', return_value=1059):
+            assert cache.get('a') == 1
+        with mock.patch('time.monotonic', return_value=1061):
+            assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def test_fill_after_invalidation_is_discarded(self):
+        cache = LRUCache(10)
+
+        # A miss, then another thread invalidates the key while the value
+        # is being loaded
+        assert cache.get('a') is None
+        cache.delete('a')
+        cache.set('a', 'stale')
+
+        assert cache.get('a') is None
+        cache.set('a', 'fresh')
+        assert cache.get('a') == 'fresh'
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+
+class TestMmapCache(object):
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        return str(tmp_path / 'versions.cache')
+
+    def test_shared_between_instances(self, path):
+        MmapCache(path, slots=64).set('current:a', '{"id": 1}')
+        other = MmapCache(path, slots=64)
+
+        assert other.get('current:a') == '{"id": 1}'
+        assert other.get('current:b') is None
+        assert other.stats() == {'hits': 1, 'misses': 1}
+
+    def test_delete_is_seen_by_other_instances(self, path):
+        cache = MmapCache(path, slots=64)
+        other = MmapCache(path, slots=64)
+        cache.set('a', '1')
+
+        other.delete('a')
+
+        assert cache.get('a') is None
+
+    def test_fill_after_invalidation_is_discarded(self, path):
+        cache = MmapCache(path, slots=64)
+        other = MmapCache(path, slots=64)
+
+        # A miss, then another process invalidates the key while the value
+        # is being loaded
+        assert cache.get('a') is None
+        other.delete('a')
+        cache.set('a', 'stale')
+
+        assert other.get('a') is None
+        other.set('a', 'fresh')
+        assert cache.get('a') == 'fresh'
+
+    def test_keys_in_the_same_slot_evict_each_other(self, path):
+        cache = MmapCache(path, slots=1)
+        cache.set('a', '1')
+        cache.set('b', '2')
+
+        assert cache.get('a') is None
+        assert cache.get('b') == '2'
+
+    def test_values_larger_than_a_slot_are_not_stored(self, path):
+        cache = MmapCache(path, slots=4, slot_size=64)
+        cache.set('a', 'x' * 64)
+
+        assert cache.get('a') is None
+
+    def test_clear(self, path):
+        cache = MmapCache(path, slots=8)
+        cache.set('a', '1')
+        cache.set('b', '2')
+
+        MmapCache(path, slots=8).clear()
+
+        assert cache.get('a') is None
+        assert cache.get('b') is None
+
+    def test_values_expire(self, path):
+        cache = MmapCache(path, slots=8, ttl=60)
+        with mock.patch('time.time', return_value=1000):
+            cache.set('a', '1')
+        with mock.patch('time.time', return_value=1059):
+            assert cache.get('a') == '1'
+        with mock.patch('time.time', return_value=1061):
+            assert cache.get('a') is None
+
+    def test_writes_from_threads_do_not_interleave(self, path):
+        cache = MmapCache(path, slots=1)
+
+        def write(value):
+            for i in range(200):
+                cache.set('a', value)
+                cache.delete('a')
+            cache.set('a', value)
+
+        threads = [threading.Thread(target=write, args=(str(i) * 100,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every write left the slot readable, with an even generation
+        assert cache.get('a') in [str(i) * 100 for i in range(8)]
+
+    def test_other_settings_use_another_file(self, path):
+        cache = MmapCache(path, slots=8)
+        cache.set('a', '1')
+
+        other = MmapCache(path, slots=16)
+
+        assert other.get('a') is None
+        assert cache.get('a') == '1'
+        assert other.path != cache.path
+        assert os.path.getsize(cache.path) == 64 + 8 * 2048
+        assert os.path.getsize(other.path) == 64 + 16 * 2048
+
+    def test_existing_file_is_not_reset(self, path):
+        MmapCache(path, slots=8).set('a', '1')
+
+        assert MmapCache(path, slots=8).get('a') == '1'
+
+    def test_foreign_file_is_refused(self, path):
+        cache = MmapCache(path, slots=8)
+        with open(cache.path, 'r+b') as f:
+            f.write(b'OTHER')
+
+        with pytest.raises(ValueError):
+            MmapCache(path, slots=8)
+
+    def test_two_tier_without_local_tier(self, path):
+        cache = TwoTierCache(None, MmapCache(path, slots=8))
+        cache.set('a', {'id': 1})
+
+        assert TwoTierCache(None, MmapCache(path, slots=8)).get('a') == \
+            {'id': 1}
+        assert cache.stats()['local'] is None
+
+
+class TestTwoTierCache(object):
+
+    def test_values_are_copied(self):
+        cache = TwoTierCache(LRUCache(10))
+        value = {'versions': [1, 2]}
+        cache.set('a', value)
+        value['versions'].append(3)
+        cache.get('a')['versions'].append(4)
+
+        assert cache.get('a') == {'versions': [1, 2]}
+
+    def test_local_tier_is_filled_from_shared_tier(self):
+        shared = LRUCache(10)
+        TwoTierCache(LRUCache(10), shared).set('a', [1])
+        cache = TwoTierCache(LRUCache(10), shared)
+
+        assert cache.get('a') == [1]
+        assert cache.get('a') == [1]
+        assert cache.stats() == {
+            'local': {'hits': 1, 'misses': 1, 'size': 1},
+            'shared': {'hits': 1, 'misses': 0, 'size': 1},
+        }
+
+    def test_stale_fill_does_not_reach_shared_tier(self):
+        shared = LRUCache(10)
+        cache = TwoTierCache(LRUCache(10), shared)
+        other = TwoTierCache(LRUCache(10), shared)
+
+        assert cache.get('a') is None
+        other.delete('a')
+        cache.set('a', 'stale')
+
+        assert other.get('a') is None
+
+    def test_delete_reaches_shared_tier(self):
+        shared = LRUCache(10)
+        cache = TwoTierCache(LRUCache(10), shared)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        cache.delete('a', 'b')
+
+        assert TwoTierCache(LRUCache(10), shared).get('a') is None
+        assert cache.get('b') is None
@@ -0,0 +1,222 @@
+import json
+from unittest import mock
+
+from ckanext.versions.lib import changes
+from ckanext.versions.lib.changes import (
+    MetadataComparator, check_resource_changes, compare_schemas,
+    get_comparator)
+
+
+def _resource(id, **kwargs):
+    resource = {
+        'id': id,
+        'package_id': 'dataset-id',
+        'name': 'Resource {}'.format(id),
+        'format': 'CSV',
+        'description': '',
+        'url': 'http://example.com/{}.csv'.format(id),
+    }
+    resource.update(kwargs)
+    return resource
+
+
+def _dataset(resources):
+    return {
+        'id': 'dataset-id',
+        'title': 'Dataset',
+        'organization': None,
+        'resources': resources,
+    }
+
+
+class TestCheckResourceChanges(object):
+
+    def test_changes_for_all_resources(self):
+        old = _dataset([_resource('1'), _resource('2')])
+        new = _dataset([_resource('1', name='New name'), _resource('3')])
+
+        change_list = []
+        check_resource_changes(change_list, old, new, 'activity-id')
+
+        assert sorted(
+            (change['type'], change['resource_id']) for change in change_list
+        ) == [
+            ('delete_resource', '2'),
+            ('new_resource', '3'),
+            ('resource_name', '1'),
+        ]
+
+    def test_changes_for_some_resources(self):
+        old = _dataset([_resource('1'), _resource('2')])
+        new = _dataset([_resource('1', name='New name'), _resource('3')])
+
+        change_list = []
+        check_resource_changes(
+            change_list, old, new, 'activity-id', resource_ids=['1'])
+
+        assert change_list == [{
+            'type': 'resource_name',
+            'title': 'Dataset',
+            'old_pkg_id': 'dataset-id',
+            'new_pkg_id': 'dataset-id',
+            'resource_id': '1',
+            'old_resource_name': 'Resource 1',
+            'new_resource_name': 'New name',
+            'old_activity_id': 'activity-id',
+        }]
+
+    def test_scoped_changes_match_full_changes(self):
+        old = _dataset([_resource(str(i)) for i in range(50)])
+        new = _dataset(
+            [_resource(str(i), format='JSON', extra='value')
+             for i in range(50)])
+
+        full = []
+        check_resource_changes(full, old, new, 'activity-id')
+        scoped = []
+        check_resource_changes(
+            scoped, old, new, 'activity-id', resource_ids=['7'])
+
+        assert scoped == [
+            change for change in full if change['resource_id'] == '7']
+        assert len(scoped) == 2
+
+    def test_id_is_not_reported_as_extra_field(self):
+        old = _dataset([_resource('1')])
+        new = _dataset([_resource('1')])
+
+        change_list = []
+        check_resource_changes(change_list, old, new, 'activity-id')
+
+        assert change_list == []
+
+    def test_schema_changes(self):
+        old_schema = {'fields': [
+            {'name': 'id', 'type': 'integer'},
+            {'name': 'name', 'type': 'string'},
+            {'name': 'value', 'type': 'number'},
+        ]}
+        new_schema = json.dumps({'fields': [
+            {'name': 'id', 'type': 'integer'},
+            {'name': 'value', 'type': 'string'},
+            {'name': 'date', 'type': 'date'},
+        ]})
+        old = _dataset([_resource('1', schema=old_schema)])
+        new = _dataset([_resource('1', schema=new_schema)])
+
+        change_list = []
+        check_resource_changes(change_list, old, new, 'activity-id')
+
+        assert change_list == [{
+            'type': 'resource_schema',
+            'pkg_id': 'dataset-id',
+            'title': 'Dataset',
+            'resource_id': '1',
+            'resource_name': 'Resource 1',
+            'added_fields': ['date'],
+            'removed_fields': ['name'],
+            'type_changes': [{'field': 'value', 'old_type': 'number',
+                              'new_type': 'string'}],
+            'reordered': False,
+            'breaking': True,
+        }]
+
+
+class TestCompareSchemas(object):
+
+    def test_reordered_fields(self):
+        result = compare_schemas(
+            [{'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'int'}],
+            [{'id': 'b', 'type': 'int'}, {'id': 'a', 'type': 'text'},
+             {'id': 'c', 'type': 'text'}])
+
+        assert result['reordered']
+        assert result['added_fields'] == ['c']
+        assert not result['breaking']
+
+    def test_added_schema(self):
+        result = compare_schemas(None, {'fields': [{'name': 'a'}]})
+
+        assert result['added_fields'] == ['a']
+        assert not result['breaking']
+
+    def test_unreadable_schema(self):
+        assert compare_schemas('not json', {'fields': []}) is None
+
+
+def _metadata(**kwargs):
+    dataset = {
+        'id': 'dataset-id',
+        'name': 'dataset',
+        'title': 'Dataset',
+        'owner_org': None,
+        'maintainer': None,
+        'maintainer_email': None,
+        'author': None,
+        'author_email': None,
+        'private': False,
+        'notes': '',
+        'tags': [],
+        'license_title': None,
+        'url': '',
+        'version': '',
+        'extras': [],
+    }
+    dataset.update(kwargs)
+    return dataset
+
+
+class TestMetadataComparator(object):
+
+    def test_default_fields(self):
+        old = _metadata()
+        new = _metadata(title='New title', private=True,
+                        tags=[{'name': 'a'}])
+
+        change_list = MetadataComparator().compare([], old, new)
+
+        assert [change['type'] for change in change_list] == \
+            ['title', 'private', 'tags']
+
+    def test_spec_fields_are_checked_in_order(self):
+        old = _metadata(spatial='a', theme='b')
+        new = _metadata(spatial='c', theme='d', other='e')
+        comparator = MetadataComparator(['theme', 'title', 'spatial'])
+
+        change_list = comparator.compare([], old, new)
+
+        assert [(change['type'], change['key']) for change in change_list] \
+            == [('extension_fields', 'theme'),
+                ('extension_fields', 'spatial'),
+                ('extension_fields', 'other')]
+
+    def test_removed_fields_are_not_reported(self):
+        old = _metadata(spatial='a')
+        new = _metadata()
+
+        assert MetadataComparator(['spatial']).compare([], old, new) == []
+
+    def test_from_scheming_schema(self):
+        schema = {'dataset_fields': [
+            {'field_name': 'title'}, {'field_name': 'spatial'}]}
+        old = _metadata(spatial='a')
+        new = _metadata(spatial='b')
+
+        comparator = MetadataComparator.from_scheming_schema(schema)
+
+        assert comparator.compare([], old, new) == [{
+            'type': 'extension_fields',
+            'pkg_id': 'dataset-id',
+            'title': 'Dataset',
+            'key': 'spatial',
+            'value': 'b',
+        }]
+
+    @mock.patch.dict(changes._comparators, clear=True)
+    def test_comparator_without_scheming(self):
+        comparator = get_comparator('dataset')
+
+        assert comparator is get_comparator('dataset')
+        assert comparator.compare(
+            [], _metadata(), _metadata(notes='New notes')
+        )[0]['type'] == 'notes'
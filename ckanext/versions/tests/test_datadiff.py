@@ -0,0 +1,113 @@
+import io
+
+import pytest
+
+from ckanext.versions.lib.datadiff import FileTooLarge, diff_rows, limit_size
+
+OLD = u'id,name,value\n1,a,10\n2,b,20\n3,c,30\n3,c,30\n'
+NEW = u'id,name,value\n3,c,30\n1,a,11\n4,d,40\n'
+
+
+def _diff(old, new, **kwargs):
+    return diff_rows(io.BytesIO(old.encode('utf-8')),
+                     io.BytesIO(new.encode('utf-8')), **kwargs)
+
+
+def _counts(result):
+    return (result['added'], result['removed'], result['changed'],
+            result['unchanged'])
+
+
+class TestDiffRows(object):
+
+    @pytest.mark.parametrize('memory', [1024 * 1024, 1000])
+    def test_keyed_rows(self, memory):
+        result = _diff(OLD, NEW, key=['id'], memory=memory)
+
+        assert _counts(result) == (1, 2, 1, 1)
+        assert result['rows']['added'] == [
+            {'id': '4', 'name': 'd', 'value': '40'}]
+        assert result['rows']['changed'] == [{
+            'old': {'id': '1', 'name': 'a', 'value': '10'},
+            'new': {'id': '1', 'name': 'a', 'value': '11'},
+        }]
+        assert sorted(row['id'] for row in result['rows']['removed']) == \
+            ['2', '3']
+
+    @pytest.mark.parametrize('memory', [1024 * 1024, 1000])
+    def test_whole_rows(self, memory):
+        result = _diff(OLD, NEW, memory=memory)
+
+        assert _counts(result) == (2, 3, 0, 1)
+
+    def test_spilling_gives_the_same_result(self):
+        old = u'id,value\n' + u''.join(
+            u'{},{}\n'.format(i, i % 7) for i in range(1000))
+        new = u'id,value\n' + u''.join(
+            u'{},{}\n'.format(i, i % 5) for i in range(500, 1500))
+
+        results = [_diff(old, new, key=['id'], memory=memory, limit=1000)
+                   for memory in (1024 * 1024, 50000, 5000)]
+
+        assert _counts(results[0]) == (500, 500, 430, 70)
+        for result in results[1:]:
+            assert _counts(result) == _counts(results[0])
+            for kind in ('added', 'removed', 'changed'):
+                assert sorted(result['rows'][kind], key=repr) == \
+                    sorted(results[0]['rows'][kind], key=repr)
+
+    def test_repeated_keys_keep_their_order_when_spilled(self):
+        old = u'id,value\n' + u''.join(
+            u'{},{}\n'.format(i % 5, i) for i in range(100))
+        new = u'id,value\n' + u''.join(
+            u'{},{}\n'.format(i % 5, i) for i in range(50))
+
+        result = _diff(old, new, key=['id'], memory=14000)
+
+        assert _counts(result) == (0, 50, 0, 50)
+
+    def test_too_many_rows_with_the_same_key(self):
+        old = u'id,value\n' + u''.join(
+            u'1,{}\n'.format(i) for i in range(100))
+
+        with pytest.raises(ValueError):
+            _diff(old, old, key=['id'], memory=1000)
+
+    def test_compares_common_columns(self):
+        result = _diff(u'id,name\n1,a\n', u'id,name,extra\n1,a,x\n2,b,y\n',
+                       key=['id'])
+
+        assert result['columns'] == {'added': ['extra'], 'removed': []}
+        assert _counts(result) == (1, 0, 0, 1)
+
+    def test_limit(self):
+        new = u'id\n' + u''.join(u'{}\n'.format(i) for i in range(10))
+
+        result = _diff(u'id\n', new, limit=3)
+
+        assert result['added'] == 10
+        assert len(result['rows']['added']) == 3
+
+    def test_tab_separated(self):
+        result = _diff(u'id\tvalue\n1\ta\n', u'id\tvalue\n1\tb\n',
+                       key=['id'], delimiter=u'\t')
+
+        assert _counts(result) == (0, 0, 1, 0)
+
+    def test_unknown_key(self):
+        with pytest.raises(ValueError):
+            _diff(u'id\n1\n', u'other\n1\n', key=['id'])
+
+
+class TestLimitSize(object):
+
+    def test_files_up_to_the_limit_are_read(self):
+        content = b'id\n1\n2\n'
+
+        assert limit_size(io.BytesIO(content), len(content)).read() == \
+            content
+
+    def test_larger_files_raise(self):
+        with pytest.raises(FileTooLarge):
+            diff_rows(limit_size(io.BytesIO(b'id\n' + b'1\n' * 1000), 100),
+                      io.BytesIO(b'id\n'))
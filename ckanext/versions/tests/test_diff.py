@@ -0,0 +1,224 @@
+import copy
+import difflib
+import json
+
+import pytest
+
+from ckanext.versions.lib import diff as json_diff
+from ckanext.versions.lib.diff import context_diff, json_patch, unified_diff
+
+
+def _dataset(resources=3):
+    return {
+        'id': 'dataset-id',
+        'title': 'Dataset',
+        'notes': 'Some notes',
+        'num_resources': resources,
+        'extras': [{'key': 'k{}'.format(i), 'value': 'v'} for i in range(5)],
+        'resources': [{
+            'id': 'resource-{}'.format(i),
+            'name': 'Resource {}'.format(i),
+            'format': 'CSV',
+            'position': i,
+            'url': 'http://example.com/{}.csv'.format(i),
+        } for i in range(resources)],
+        'tags': [],
+    }
+
+
+def _difflib_diff(func, obj1, obj2):
+    lines = [json.dumps(obj, indent=2, sort_keys=True).split('\n')
+             for obj in (obj1, obj2)]
+    return '\n'.join(func(*lines))
+
+
+def _change_title(dataset):
+    dataset['title'] = 'New title'
+
+
+def _change_resource(dataset):
+    dataset['resources'][1]['name'] = 'New name'
+
+
+def _add_last_key(dataset):
+    dataset['version'] = '1.0'
+
+
+def _remove_key(dataset):
+    del dataset['notes']
+
+
+def _add_resource(dataset):
+    dataset['resources'].append(dict(dataset['resources'][0], id='new'))
+
+
+def _add_tag(dataset):
+    dataset['tags'].append({'name': 'economy'})
+
+
+def _change_type(dataset):
+    dataset['num_resources'] = float(dataset['num_resources'])
+
+
+def _change_extra(dataset):
+    dataset['extras'][2]['value'] = 'w'
+
+
+@pytest.mark.parametrize('change', [
+    _change_title, _change_resource, _add_last_key, _remove_key,
+    _add_resource, _add_tag, _change_type, _change_extra,
+])
+@pytest.mark.parametrize('funcs', [
+    (unified_diff, difflib.unified_diff),
+    (context_diff, difflib.context_diff),
+])
+def test_same_output_as_difflib(change, funcs):
+    old = _dataset()
+    new = copy.deepcopy(old)
+    change(new)
+
+    assert '\n'.join(funcs[0](old, new)) == \
+        _difflib_diff(funcs[1], old, new)
+
+
+def _insert_similar_resource(dataset):
+    dataset['resources'].insert(
+        2, dict(dataset['resources'][1], id='new', position=2))
+
+
+def _remove_middle_resource(dataset):
+    del dataset['resources'][2]
+
+
+def _swap_resources(dataset):
+    dataset['resources'].insert(1, dataset['resources'].pop(2))
+
+
+def _change_repeated_tag(dataset):
+    dataset['tags'][1] = {'name': 'y'}
+
+
+@pytest.mark.parametrize('change', [
+    _insert_similar_resource, _remove_middle_resource, _swap_resources,
+    _change_repeated_tag,
+])
+@pytest.mark.parametrize('funcs', [
+    (unified_diff, difflib.unified_diff),
+    (context_diff, difflib.context_diff),
+])
+def test_ambiguous_changes_are_placed_like_difflib(change, funcs):
+    old = _dataset(resources=5)
+    old['tags'] = [{'name': 'x'}, {'name': 'x'}, {'name': 'y'}]
+    new = copy.deepcopy(old)
+    change(new)
+
+    assert '\n'.join(funcs[0](old, new)) == \
+        _difflib_diff(funcs[1], old, new)
+
+
+def test_no_output_for_equal_objects():
+    assert list(unified_diff(_dataset(), _dataset())) == []
+    assert list(context_diff(_dataset(), _dataset())) == []
+
+
+def test_resources_are_matched_by_id(monkeypatch):
+    # Moved items are left to difflib in documents of this size
+    monkeypatch.setattr(json_diff, 'DIFFLIB_MAX_LINES', 0)
+    old = _dataset(resources=4)
+    new = copy.deepcopy(old)
+    new['resources'].insert(0, new['resources'].pop())
+    new['resources'][2]['name'] = 'New name'
+
+    diff = list(unified_diff(old, new))
+
+    assert '+      "name": "New name",' in diff
+    assert '-      "name": "Resource 1",' in diff
+    # The moved resource is removed and added once, and the renamed one is
+    # only changed in its name
+    assert len([line for line in diff if line.startswith('-') and
+                '"id":' in line]) == 1
+
+
+def test_diff_can_be_applied():
+    old = _dataset(resources=20)
+    new = copy.deepcopy(old)
+    del new['resources'][3:15:2]
+    new['resources'][0]['format'] = 'JSON'
+    new['extras'].append({'key': 'new', 'value': 1.5})
+
+    old_lines = json.dumps(old, indent=2, sort_keys=True).split('\n')
+    new_lines = json.dumps(new, indent=2, sort_keys=True).split('\n')
+    diff = [line.rstrip('\n') for line in unified_diff(old, new)]
+
+    # Keeping the context and added lines of every hunk, and the unchanged
+    # lines between hunks, gives back the new document
+    result = []
+    position = 0
+    for line in diff[2:]:
+        if line.startswith('@@'):
+            start = int(line.split()[1][1:].split(',')[0]) - 1
+            result.extend(old_lines[position:start])
+            position = start
+        elif line.startswith(' '):
+            result.append(line[1:])
+            position += 1
+        elif line.startswith('-'):
+            position += 1
+        else:
+            result.append(line[1:])
+    result.extend(old_lines[position:])
+
+    assert result == new_lines
+
+
+def _apply_patch(document, patch):
+    document = copy.deepcopy(document)
+    for operation in patch:
+        tokens = [token.replace('~1', '/').replace('~0', '~')
+                  for token in operation['path'].split('/')[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        key = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+        if operation['op'] == 'remove':
+            del parent[key]
+        elif operation['op'] == 'add' and isinstance(parent, list):
+            parent.insert(key, operation['value'])
+        else:
+            parent[key] = operation['value']
+    return document
+
+
+@pytest.mark.parametrize('change', [
+    _change_title, _change_resource, _add_last_key, _remove_key,
+    _add_resource, _add_tag, _change_type, _change_extra,
+])
+def test_json_patch_can_be_applied(change):
+    old = _dataset()
+    new = copy.deepcopy(old)
+    change(new)
+
+    assert _apply_patch(old, json_patch(old, new)) == new
+
+
+def test_json_patch_matches_resources_by_id():
+    old = _dataset(resources=4)
+    new = copy.deepcopy(old)
+    del new['resources'][0]
+    new['resources'][1]['name'] = 'New name'
+
+    assert json_patch(old, new) == [
+        {'op': 'remove', 'path': '/resources/0'},
+        {'op': 'replace', 'path': '/resources/1/name', 'value': 'New name'},
+    ]
+
+
+def test_json_patch_escapes_keys():
+    assert json_patch({'a/b': 1, 'c~d': 2}, {'a/b': 3}) == [
+        {'op': 'remove', 'path': '/c~0d'},
+        {'op': 'replace', 'path': '/a~1b', 'value': 3},
+    ]
+
+
+def test_json_patch_is_empty_for_equal_objects():
+    assert json_patch(_dataset(), _dataset()) == []
@@ -0,0 +1,32 @@
+from ckanext.versions.lib.fingerprint import resource_fingerprint
+
+RESOURCE = {
+    'id': 'resource-id',
+    'name': 'Resource',
+    'url': 'http://example.com/data.csv',
+    'hash': 'abc',
+    'size': 100,
+    'position': 0,
+    'metadata_modified': '2021-01-01T00:00:00',
+}
+
+
+def test_volatile_fields_are_ignored():
+    resource = dict(RESOURCE, position=3,
+                    metadata_modified='2021-02-01T00:00:00')
+
+    assert resource_fingerprint(resource) == resource_fingerprint(RESOURCE)
+
+
+def test_key_order_is_ignored():
+    resource = dict(reversed(list(RESOURCE.items())))
+
+    assert resource_fingerprint(resource) == resource_fingerprint(RESOURCE)
+
+
+def test_file_changes_are_detected():
+    for field, value in (('hash', 'def'), ('size', 101),
+                         ('url', 'http://example.com/other.csv')):
+        resource = dict(RESOURCE, **{field: value})
+        assert resource_fingerprint(resource) != \
+            resource_fingerprint(RESOURCE)
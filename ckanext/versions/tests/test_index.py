@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+from ckanext.versions.lib.index import VersionIndex
+
+RESOURCE = '9a1b7c0e-4d2f-4a8e-9a57-0f3c2d1e5b6a'
+OTHER = '0c6e3b1a-7f24-4d5e-8b19-2a6f4c8d0e13'
+PACKAGE = 'f3b0c442-98fc-4c14-8a5e-5c9d0b3e7a21'
+
+
+USER = '5d1e7f3a-2b4c-4e6f-9a8b-7c6d5e4f3a2b'
+
+
+def _row(resource_id, number, created):
+    return (resource_id, PACKAGE,
+            '00000000-0000-4000-8000-{:012d}'.format(number),
+            '11111111-0000-4000-8000-{:012d}'.format(number),
+            'v{}'.format(number), created, 'Notes {}'.format(number), USER,
+            created, None)
+
+
+ROWS = [
+    _row(OTHER, 1, datetime(2021, 1, 1)),
+    _row(RESOURCE, 2, datetime(2021, 1, 1)),
+    _row(RESOURCE, 3, datetime(2021, 2, 1, 12, 0, 0, 123456)),
+    _row(RESOURCE, 4, datetime(2021, 3, 1)),
+]
+
+
+class TestVersionIndex(object):
+
+    def test_current(self):
+        index = VersionIndex(ROWS)
+
+        assert index.current(RESOURCE) == {
+            'id': '00000000-0000-4000-8000-000000000004',
+            'package_id': PACKAGE,
+            'resource_id': RESOURCE,
+            'activity_id': '11111111-0000-4000-8000-000000000004',
+            'name': 'v4',
+            'notes': 'Notes 4',
+            'creator_user_id': USER,
+            'created': '2021-03-01T00:00:00',
+            'modified': '2021-03-01T00:00:00',
+            'fingerprint': None,
+        }
+        assert index.current(OTHER)['name'] == 'v1'
+        assert index.current('unknown') is None
+
+    def test_has_versions(self):
+        index = VersionIndex(ROWS)
+
+        assert index.has_versions(RESOURCE)
+        assert not index.has_versions('unknown')
+        assert index.package_id(RESOURCE) == PACKAGE
+        assert index.package_id('unknown') is None
+
+    def test_by_name(self):
+        index = VersionIndex(ROWS)
+
+        assert index.by_name(RESOURCE, 'v3')['created'] == \
+            '2021-02-01T12:00:00.123456'
+        assert index.by_name(RESOURCE, 'v1') is None
+
+    def test_at(self):
+        index = VersionIndex(ROWS)
+
+        assert index.at(RESOURCE, datetime(2020, 12, 31)) is None
+        assert index.at(RESOURCE, datetime(2021, 1, 1))['name'] == 'v2'
+        assert index.at(
+            RESOURCE, datetime(2021, 2, 1, 12, 0, 0, 123455))['name'] == 'v2'
+        assert index.at(
+            RESOURCE, datetime(2021, 2, 1, 12, 0, 0, 123456))['name'] == 'v3'
+        assert index.at(RESOURCE, datetime(2030, 1, 1))['name'] == 'v4'
+
+    def test_invalidated_resources_are_reloaded(self):
+        rows = {RESOURCE: ROWS[1:3], OTHER: []}
+        index = VersionIndex(ROWS, loader=lambda resource_id: rows[
+            resource_id])
+
+        index.invalidate(RESOURCE, OTHER)
+
+        assert index.current(RESOURCE)['name'] == 'v3'
+        assert not index.has_versions(OTHER)
+        assert index.stats()['reloaded_resources'] == 2
+
+    def test_stats(self):
+        stats = VersionIndex(ROWS).stats()
+
+        assert stats['resources'] == 2
+        assert stats['versions'] == 4
+        assert stats['bytes'] > 0
+
+    def test_unsorted_rows(self):
+        with pytest.raises(ValueError):
+            VersionIndex([ROWS[1], ROWS[0], ROWS[2]])
@@ -0,0 +1,66 @@
+'''
+Peak memory of the paths that hold whole dataset dicts, measured with
+tracemalloc at the scale of large portals: resource_history with 1000
+versions, and _generate_diff with dataset dicts of 10 MB.
+'''
+import json
+
+import pytest
+from ckan.tests import factories
+
+from ckanext.versions.logic import action
+from ckanext.versions.tests import get_context
+from ckanext.versions.tests.benchmarks.portal import (
+    create_portal, edited_package, package_dict)
+
+MB = 1000 * 1000
+NUM_VERSIONS = 1000
+# About 10 MB of JSON
+NUM_RESOURCES = 25000
+
+
+@pytest.fixture(scope='module')
+def large_packages():
+    old = package_dict('dataset-id', 'dataset', NUM_RESOURCES)
+    assert len(json.dumps(old, indent=2)) > 10 * MB
+    return old, edited_package(old, changed_resources=10)
+
+
+# Large lists are compared in chunks and rendered only around the changes,
+# so these diffs take less memory than the documents themselves
+@pytest.mark.parametrize('diff_type', ['unified', 'context', 'json_patch'])
+def test_generate_diff(memory_budget, large_packages, diff_type):
+    old, new = large_packages
+
+    with memory_budget(15 * MB):
+        diff = action._generate_diff(old, new, diff_type)
+
+    assert diff
+
+
+def test_generate_html_diff(memory_budget):
+    # HTML diffs render both documents in full, and take about 70 times
+    # their size, so they are only checked on a dataset of 100 KB
+    old = package_dict('dataset-id', 'dataset', 250)
+    new = edited_package(old, changed_resources=10)
+
+    with memory_budget(10 * MB):
+        diff = action._generate_diff(old, new, 'html')
+
+    assert diff
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+def test_resource_history(memory_budget):
+    user = factories.Sysadmin()
+    portal = create_portal(user['id'], 1, 10, NUM_VERSIONS)
+    resource_id = portal['resource_ids'][0]
+    action.clear_version_cache()
+
+    # Exceeded when the dataset dicts of all activities are kept at once
+    with memory_budget(8 * MB) as usage:
+        history = action.resource_history(
+            get_context(user), {'resource_id': resource_id})
+
+    assert len(history) == NUM_VERSIONS
+    assert usage.peak
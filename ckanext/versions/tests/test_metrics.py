@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from ckanext.versions.lib import metrics
+
+
+def _call_lines(text):
+    return [line for line in text.splitlines()
+            if line.startswith('versions_calls_total{')]
+
+
+class TestMetrics(object):
+
+    def test_render(self):
+        m = metrics.Metrics(buckets=(0.1, 1.0))
+        m.observe('action', 'version_show', 0.05, queries=2)
+        m.observe('action', 'version_show', 0.5, queries=1)
+        m.observe('action', 'version_show', 5, error='NotFound')
+
+        text = metrics.render(m.snapshot())
+
+        assert _call_lines(text) == [
+            'versions_calls_total{kind="action",name="version_show"} 3']
+        assert 'versions_queries_total{kind="action",name="version_show"} 3' \
+            in text
+        assert 'versions_errors_total{kind="action",name="version_show",' \
+            'error="NotFound"} 1' in text
+        for line in [
+            'versions_duration_seconds_bucket{kind="action",'
+            'name="version_show",le="0.1"} 1',
+            'versions_duration_seconds_bucket{kind="action",'
+            'name="version_show",le="1.0"} 2',
+            'versions_duration_seconds_bucket{kind="action",'
+            'name="version_show",le="+Inf"} 3',
+            'versions_duration_seconds_sum{kind="action",'
+            'name="version_show"} 5.55',
+            'versions_duration_seconds_count{kind="action",'
+            'name="version_show"} 3',
+        ]:
+            assert line in text
+
+    def test_merge(self):
+        first = metrics.Metrics()
+        second = metrics.Metrics()
+        first.observe('action', 'version_show', 0.01)
+        second.observe('action', 'version_show', 0.02)
+        second.observe('helper', 'versions_download_url', 0.001)
+
+        merged = metrics.merge([first.snapshot(), second.snapshot()])
+
+        assert merged['calls'] == [
+            ['action', 'version_show', 2],
+            ['helper', 'versions_download_url', 1],
+        ]
+
+    def test_processes_share_a_directory(self, tmp_path):
+        other = metrics.Metrics(directory=str(tmp_path), dump_interval=0)
+        other.observe('action', 'version_show', 0.01)
+        # Written as if by another process
+        (tmp_path / 'metrics-{}.json'.format(os.getpid())).rename(
+            tmp_path / 'metrics-1.json')
+        current = metrics.Metrics(directory=str(tmp_path))
+        current.observe('action', 'version_show', 0.01)
+
+        snapshot = current.collect()
+
+        assert snapshot['calls'] == [['action', 'version_show', 2]]
+
+    def test_snapshot_of_an_earlier_process_is_removed(self, tmp_path):
+        earlier = metrics.Metrics(directory=str(tmp_path), dump_interval=0)
+        earlier.observe('action', 'version_show', 0.01)
+
+        current = metrics.Metrics(directory=str(tmp_path))
+
+        assert list(tmp_path.iterdir()) == []
+        assert current.collect()['calls'] == []
+
+
+@pytest.mark.ckan_config('ckanext.versions.metrics.enabled', 'true')
+class TestInstrument(object):
+
+    def test_calls_and_errors_are_recorded(self):
+        def show(context, data_dict):
+            if data_dict.get('fail'):
+                raise ValueError()
+            return data_dict
+
+        show.side_effect_free = True
+        wrapped = metrics.instrument('action', 'test_show', show)
+
+        assert wrapped({}, {'id': 1}) == {'id': 1}
+        with pytest.raises(ValueError):
+            wrapped({}, {'fail': True})
+
+        snapshot = metrics.get_metrics().snapshot()
+        assert ['action', 'test_show', 2] in snapshot['calls']
+        assert ['action', 'test_show', 'ValueError', 1] in \
+            snapshot['errors']
+        assert wrapped.side_effect_free
+        assert wrapped.__name__ == 'show'
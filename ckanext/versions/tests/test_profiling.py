@@ -0,0 +1,101 @@
+import cProfile
+import os
+
+import pytest
+
+from ckanext.versions.lib import profiling
+
+
+def _profile(func, *args):
+    profile = cProfile.Profile()
+    profile.runcall(func, *args)
+    return profile
+
+
+def _history(count):
+    return [dict(id=i) for i in range(count)]
+
+
+class TestProfiler(object):
+
+    def test_report(self):
+        profiler = profiling.Profiler()
+        profiler.record('resource_history', _profile(_history, 10))
+        profiler.record('resource_history', _profile(_history, 10))
+        profiler.record('can_view', _profile(len, []))
+
+        report = profiler.report(['resource_history'], limit=5)
+
+        assert profiler.names() == ['can_view', 'resource_history']
+        assert report.startswith('=== resource_history ===')
+        assert '_history' in report
+        assert 'can_view' not in report
+
+    def test_processes_share_a_directory(self, tmp_path):
+        other = profiling.Profiler(directory=str(tmp_path), dump_interval=0)
+        other.record('resource_history', _profile(_history, 10))
+        # Written as if by another process
+        (tmp_path / 'resource_history.{}.prof'.format(os.getpid())).rename(
+            tmp_path / 'resource_history.1.prof')
+        current = profiling.Profiler(directory=str(tmp_path))
+        current.record('resource_history', _profile(_history, 10))
+
+        stats = current.stats('resource_history')
+
+        calls = [ncalls for (_, _, function), (_, ncalls, _, _, _)
+                 in stats.stats.items() if function == '_history']
+        assert calls == [2]
+        assert current.stats('can_view') is None
+
+
+@pytest.fixture
+def profiler():
+    profiling._profiler = None
+    yield profiling.get_profiler()
+    profiling._profiler = None
+
+
+class TestProfile(object):
+
+    @pytest.mark.ckan_config('ckanext.versions.profiling.enabled', 'true')
+    @pytest.mark.ckan_config('ckanext.versions.profiling.rate', '1')
+    def test_sampled_calls_are_profiled(self, profiler):
+        def resource_history(context, data_dict):
+            return version_list(context, data_dict)
+
+        version_list = profiling.profile('version_list', _history)
+        resource_history.side_effect_free = True
+        wrapped = profiling.profile('resource_history', resource_history)
+
+        assert wrapped({}, 3) == _history(3)
+        # Nested calls are part of the outer profile only
+        assert profiler.names() == ['resource_history']
+        assert wrapped.side_effect_free
+        assert wrapped.__name__ == 'resource_history'
+
+    @pytest.mark.ckan_config('ckanext.versions.profiling.enabled', 'true')
+    def test_not_sampled(self, profiler):
+        profiling.profile('version_list', _history)(3)
+
+        assert profiler.names() == []
+
+    @pytest.mark.ckan_config('ckanext.versions.profiling.rate', '1')
+    def test_disabled(self, profiler):
+        profiling.profile('version_list', _history)(3)
+
+        assert profiler.names() == []
+
+    @pytest.mark.ckan_config('ckanext.versions.profiling.enabled', 'true')
+    @pytest.mark.ckan_config('ckanext.versions.profiling.token', 'secret')
+    def test_requested_calls_are_profiled(self, app, profiler):
+        wrapped = profiling.profile('version_list', _history)
+
+        with app.flask_app.test_request_context(
+                headers={profiling.HEADER: 'wrong'}):
+            wrapped(3)
+        assert profiler.names() == []
+
+        with app.flask_app.test_request_context(
+                headers={profiling.HEADER: 'secret'}):
+            wrapped(3)
+        assert profiler.names() == ['version_list']
@@ -0,0 +1,129 @@
+import logging
+
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+from sqlalchemy import create_engine
+
+from ckanext.versions import helpers as versions_helpers
+from ckanext.versions.lib import queries
+from ckanext.versions.logic import action
+from ckanext.versions.logic.action import (
+    resource_history, resource_version_create)
+from ckanext.versions.tests import get_context
+
+
+@pytest.fixture
+def engine():
+    return create_engine('sqlite://')
+
+
+class TestQueryScope(object):
+
+    def test_statements_are_recorded(self, engine):
+        with queries.scope() as outer:
+            engine.execute('SELECT 1 AS version')
+            with queries.scope() as inner:
+                for i in range(3):
+                    engine.execute('SELECT ? AS other', i)
+
+        assert outer.count == 4
+        assert inner.count == 3
+        assert outer.touching('version') == 1
+        assert outer.repeated(2) == [('SELECT ? AS other', 3)]
+        assert '3 x SELECT ? AS other' in outer.report()
+
+    def test_request_counts_tracked_functions(self, engine, caplog):
+        queries.start_request()
+        engine.execute('SELECT 1')
+        with queries.tracking('resource_history'):
+            for i in range(3):
+                with queries.tracking('activity_resource_show'):
+                    engine.execute('SELECT ?', i)
+
+        with caplog.at_level(logging.WARNING):
+            request = queries.finish_request(
+                '/dataset/test', threshold=2, repeat_threshold=3)
+
+        assert request.counts == {'resource_history': 3}
+        assert not queries.in_request()
+        messages = [record.getMessage() for record in caplog.records]
+        assert '/dataset/test ran 3 SQL statements in versions actions and ' \
+            'helpers (threshold 2): resource_history 3' in messages
+        assert '/dataset/test ran the same SQL statement 3 times, a ' \
+            'possible N+1 pattern: SELECT ?' in messages
+
+    def test_nothing_is_tracked_outside_requests(self, engine):
+        with queries.tracking('version_show'):
+            engine.execute('SELECT 1')
+
+        assert queries.finish_request('', 0, 1) is None
+
+
+def _create_versions(context, resource, count):
+    for i in range(count):
+        helpers.call_action('resource_patch', id=resource['id'],
+                            description=str(i))
+        resource_version_create(context, {
+            'resource_id': resource['id'], 'name': 'v{}'.format(i)})
+    action.clear_version_cache()
+    model.Session.remove()
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestQueryBudgets(object):
+
+    def test_resource_history_does_not_grow_with_versions(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        data_dict = {'resource_id': resource['id']}
+
+        _create_versions(context, resource, 2)
+        with queries.scope() as few:
+            assert len(resource_history(context, data_dict)) == 2
+        _create_versions(context, resource, 4)
+        with queries.scope() as many:
+            assert len(resource_history(context, data_dict)) == 6
+
+        assert many.count == few.count, many.report()
+
+    @pytest.mark.ckan_config('ckanext.versions.cache.enabled', 'true')
+    def test_version_download(self, app, query_budget):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'])
+        version = resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+        url = toolkit.url_for(
+            'versions.version_download', id=dataset['id'],
+            resource_id=resource['id'], version_id=version['id'])
+
+        with query_budget(version=1):
+            app.get(url, follow_redirects=False)
+        with query_budget(version=0):
+            app.get(url, follow_redirects=False)
+
+    @pytest.mark.ckan_config('ckanext.versions.cache.enabled', 'true')
+    def test_dataset_page_helpers(self, app, query_budget):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        resources = [factories.Resource(package_id=dataset['id'])
+                     for i in range(3)]
+        for resource in resources:
+            resource_version_create(get_context(user), {
+                'resource_id': resource['id'], 'name': '1'})
+
+        with app.flask_app.test_request_context():
+            toolkit.c.user = user['name']
+            # One query per resource, then none once cached
+            with query_budget(version=len(resources)):
+                listed = versions_helpers.resources_list_with_current_version(
+                    [dict(resource) for resource in resources])
+            with query_budget(version=0):
+                versions_helpers.resources_list_with_current_version(
+                    [dict(resource) for resource in resources])
+
+        assert [resource['version'] for resource in listed] == \
+            ['1', '1', '1']
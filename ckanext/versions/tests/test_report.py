@@ -0,0 +1,89 @@
+import json
+from datetime import datetime
+
+import pytest
+from ckan.plugins import toolkit
+from ckan.tests import factories
+
+from ckanext.versions.lib.backfill import iter_package_id_batches
+from ckanext.versions.lib.report import CSV_FIELDS, csv_rows, report_packages
+from ckanext.versions.logic.action import resource_version_create
+from ckanext.versions.tests import get_context
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestChangesReport(object):
+
+    def _patch(self, user, dataset_id, **kwargs):
+        kwargs['id'] = dataset_id
+        toolkit.get_action('package_patch')(get_context(user), kwargs)
+
+    def test_compares_last_two_versions(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset(title='Old title')
+        resource = factories.Resource(package_id=dataset['id'])
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        self._patch(user, dataset['id'], title='New title')
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+        self._patch(user, dataset['id'], notes='Not versioned yet')
+
+        reports = report_packages([dataset['id']])
+
+        assert len(reports) == 1
+        assert reports[0]['new_activity_id'] == version['activity_id']
+        assert [change['type'] for change in reports[0]['changes']] == \
+            ['title']
+
+    def test_datasets_without_changes_are_left_out(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+
+        assert report_packages([resource['package_id']]) == []
+
+    def test_compares_dates(self):
+        user = factories.Sysadmin()
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'])
+        since = datetime.utcnow()
+        self._patch(user, dataset['id'], title='New title')
+        self._patch(user, dataset['id'], notes='New notes')
+        created_later = factories.Dataset()
+
+        reports = report_packages(
+            [dataset['id'], created_later['id']], since=since)
+
+        assert [report['package_id'] for report in reports] == \
+            [dataset['id']]
+        assert sorted(
+            change['type'] for change in reports[0]['changes']
+        ) == ['notes', 'title']
+
+    def test_csv_rows(self):
+        report = {
+            'package_id': 'dataset-id',
+            'package_name': 'dataset',
+            'old_activity_id': 'old',
+            'new_activity_id': 'new',
+            'old_timestamp': '2020-01-01T00:00:00',
+            'new_timestamp': '2020-01-02T00:00:00',
+            'changes': [{'type': 'title', 'new_title': 'New title'}],
+        }
+
+        rows = list(csv_rows(report))
+
+        assert len(rows) == 1
+        assert dict(zip(CSV_FIELDS, rows[0]))['type'] == 'title'
+        assert json.loads(rows[0][-1]) == report['changes'][0]
+
+    def test_iter_package_id_batches_by_organization(self):
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'])
+        factories.Dataset()
+
+        assert list(iter_package_id_batches(
+            10, owner_org=organization['id'])) == [[dataset['id']]]
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+from ckan.tests import factories
+
+from ckanext.versions.lib import tracing
+from ckanext.versions.logic import action
+from ckanext.versions.tests import get_context
+
+
+def _tree(spans):
+    '''Returns (name, parent name) pairs of spans, in the order they ended'''
+    names = {span.span_id: span.name for span in spans}
+    return [(span.name, names.get(span.parent_id)) for span in spans]
+
+
+class TestTracer(object):
+
+    def test_spans_are_nested(self):
+        exporter = tracing.InMemorySpanExporter()
+        tracer = tracing.Tracer(exporter)
+
+        with tracer.start_as_current_span('resource_history') as outer:
+            with tracer.start_as_current_span(
+                    'resource_version_list',
+                    attributes={'versions.count': 2}) as inner:
+                assert inner.is_recording()
+            outer.set_attribute('versions.count', 2)
+        with tracer.start_as_current_span('resource_history'):
+            pass
+
+        first, second, third = exporter.get_finished_spans()
+        assert _tree([first, second]) == [
+            ('resource_version_list', 'resource_history'),
+            ('resource_history', None),
+        ]
+        assert first.trace_id == second.trace_id != third.trace_id
+        assert first.attributes == {'versions.count': 2}
+        assert second.end_time >= first.end_time >= first.start_time
+
+    def test_errors_are_recorded(self):
+        exporter = tracing.InMemorySpanExporter()
+        tracer = tracing.Tracer(exporter)
+
+        with pytest.raises(ValueError):
+            with tracer.start_as_current_span('version_show'):
+                raise ValueError('Not a version')
+
+        span, = exporter.get_finished_spans()
+        assert span.status == 'ERROR'
+        assert span.attributes['exception.type'] == 'ValueError'
+
+    def test_file_exporter(self, tmp_path):
+        path = tmp_path / 'spans.jsonl'
+        tracer = tracing.Tracer(tracing.FileSpanExporter(str(path)))
+
+        for _ in range(2):
+            with tracer.start_as_current_span(
+                    'resource_history', attributes={'versions.count': 3}):
+                pass
+
+        spans = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [span['name'] for span in spans] == ['resource_history'] * 2
+        assert spans[0]['attributes'] == {'versions.count': 3}
+        assert spans[0]['duration_ms'] >= 0
+
+    def test_disabled(self):
+        with tracing.span('resource_history', count=1) as span:
+            assert not span.is_recording()
+        assert not tracing.current_span().is_recording()
+
+
+@pytest.fixture
+def spans(ckan_config):
+    tracing._tracers.clear()
+    yield tracing.get_tracer().exporter
+    tracing._tracers.clear()
+
+
+@pytest.mark.ckan_config('ckanext.versions.tracing.enabled', 'true')
+@pytest.mark.ckan_config('ckanext.versions.tracing.exporter', 'memory')
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVersionFlows(object):
+
+    def test_resource_history(self, spans):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        for name in ('1', '2'):
+            action.resource_version_create(
+                context, {'resource_id': resource['id'], 'name': name})
+        spans.clear()
+
+        action.resource_history(context, {'resource_id': resource['id']})
+
+        finished = spans.get_finished_spans()
+        assert _tree(finished) == [
+            ('resource_version_list', 'resource_history'),
+            ('load_activities', 'resource_history'),
+            ('resource_history', None),
+        ]
+        version_list, activities, history = finished
+        assert history.attributes['versions.resource_id'] == resource['id']
+        assert history.attributes['versions.count'] == 2
+        assert version_list.attributes['versions.count'] == 2
+        assert activities.attributes['versions.count'] == 1
+        assert activities.attributes['versions.payload_bytes'] > 0
+
+    def test_resource_version_create(self, spans):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'])
+        action.resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        factories.Resource(package_id=dataset['id'])
+        spans.clear()
+
+        action.resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+
+        assert _tree(spans.get_finished_spans()) == [
+            ('latest_activity', 'resource_version_create'),
+            ('activity_data_show', 'record_version_change'),
+            ('activity_data_show', 'record_version_change'),
+            ('record_version_change', 'resource_version_create'),
+            ('resource_version_create', None),
+        ]
+
+    def test_resource_in_activity(self, spans):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        version = action.resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+        spans.clear()
+
+        assert action.resource_in_activity(get_context(user), {
+            'resource_id': resource['id'],
+            'activity_id': version['activity_id']})
+
+        finished = spans.get_finished_spans()
+        assert _tree(finished) == [
+            ('activity_data_show', 'activity_resource_show'),
+            ('activity_resource_show', 'resource_in_activity'),
+            ('resource_in_activity', None),
+        ]
+        assert finished[0].attributes['versions.activity_id'] == \
+            version['activity_id']
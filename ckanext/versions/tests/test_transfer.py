@@ -0,0 +1,128 @@
+import io
+import json
+from unittest import mock
+
+import pytest
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.versions.lib.transfer import (
+    export_versions, import_versions, open_ndjson)
+from ckanext.versions.logic.action import (
+    resource_version_clear, resource_version_create, resource_version_list)
+from ckanext.versions.model import Version
+from ckanext.versions.tests import get_context
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestExportImport(object):
+
+    def test_export_and_import_round_trip(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        for name in ('1', '2', '3'):
+            resource_version_create(
+                context, {'resource_id': resource['id'], 'name': name})
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+
+        f = io.StringIO()
+        assert export_versions(f, batch_size=2) == 3
+        lines = f.getvalue().splitlines()
+        assert {json.loads(line)['id'] for line in lines} == \
+            {v['id'] for v in versions}
+
+        resource_version_clear(context, {'resource_id': resource['id']})
+        f.seek(0)
+        assert import_versions(f, batch_size=2) == 3
+
+        assert resource_version_list(
+            context, {'resource_id': resource['id']}) == versions
+
+    def test_import_updates_versions_with_the_same_name(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(context, {
+            'resource_id': resource['id'], 'name': '1', 'notes': 'Old notes'
+        })
+
+        row = dict(version, id='another-id', notes='New notes')
+        import_versions(io.StringIO(json.dumps(row) + '\n'))
+
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+        assert len(versions) == 1
+        assert versions[0]['id'] == version['id']
+        assert versions[0]['notes'] == 'New notes'
+
+    def test_import_updates_versions_with_the_same_id(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+
+        row = dict(version, name='renamed')
+        import_versions(io.StringIO(json.dumps(row) + '\n'))
+
+        versions = resource_version_list(
+            context, {'resource_id': resource['id']})
+        assert [(v['id'], v['name']) for v in versions] == \
+            [(version['id'], 'renamed')]
+
+    def test_import_refuses_conflicting_versions(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        second = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '2'})
+
+        row = dict(second, name='1')
+        with pytest.raises(ValueError):
+            import_versions(io.StringIO(json.dumps(row) + '\n'))
+
+    def test_import_does_not_duplicate_versions_without_resource(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        version = resource_version_create(
+            context, {'resource_id': resource['id'], 'name': '1'})
+        model.Session.query(Version).filter(Version.id == version['id']).\
+            update({'resource_id': None})
+        model.Session.commit()
+
+        f = io.StringIO()
+        export_versions(f)
+        for i in range(2):
+            f.seek(0)
+            import_versions(f)
+
+        assert model.Session.query(Version).count() == 1
+
+
+@pytest.mark.parametrize('filename', ['versions.ndjson', 'versions.ndjson.gz'])
+def test_open_ndjson_round_trip(tmpdir, filename):
+    path = str(tmpdir.join(filename))
+    with open_ndjson(path, 'w') as f:
+        f.write(u'{"name": "1"}\n')
+
+    with open_ndjson(path, 'r') as f:
+        assert f.read() == u'{"name": "1"}\n'
+
+    with open(path, 'rb') as f:
+        assert (f.read(2) == b'\x1f\x8b') == filename.endswith('.gz')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_open_ndjson_leaves_stdout_open(compress):
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    with mock.patch('sys.stdout', stdout):
+        with open_ndjson('-', 'w', compress) as f:
+            f.write(u'{"name": "1"}\n')
+
+    assert not stdout.buffer.closed
+    assert stdout.buffer.getvalue()
@@ -0,0 +1,108 @@
+import uuid
+
+import pytest
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.versions.lib.verify import (
+    ACTIVITY_NOT_FOUND, RESOURCE_NOT_IN_ACTIVITY, iter_version_batches,
+    verify_versions)
+from ckanext.versions.logic.action import resource_version_create
+from ckanext.versions.model import Version
+from ckanext.versions.tests import get_context
+
+
+@pytest.mark.usefixtures('clean_db', 'versions_setup')
+class TestVerify(object):
+
+    def _verify(self, batch_size=1000):
+        checked = 0
+        broken = []
+        for batch in iter_version_batches(batch_size):
+            result = verify_versions(batch)
+            checked += result['checked']
+            broken.extend(result['broken'])
+        return checked, broken
+
+    def test_valid_versions_are_not_reported(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+
+        assert self._verify() == (1, [])
+
+    def test_reports_missing_activities(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        version = resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+        model.Session.query(model.Activity).\
+            filter(model.Activity.id == version['activity_id']).delete()
+        model.Session.commit()
+
+        checked, broken = self._verify()
+
+        assert checked == 1
+        assert broken == [{
+            'version_id': version['id'],
+            'package_id': version['package_id'],
+            'resource_id': resource['id'],
+            'activity_id': version['activity_id'],
+            'problem': ACTIVITY_NOT_FOUND,
+        }]
+
+    def test_reports_resources_missing_from_activity(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        version = resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+        other_resource = factories.Resource()
+        model.Session.add(Version(
+            package_id=other_resource['package_id'],
+            resource_id=other_resource['id'],
+            activity_id=version['activity_id'],
+            name='1',
+            creator_user_id=user['id']))
+        model.Session.commit()
+
+        checked, broken = self._verify()
+
+        assert checked == 2
+        assert [(row['resource_id'], row['problem']) for row in broken] == \
+            [(other_resource['id'], RESOURCE_NOT_IN_ACTIVITY)]
+
+    def test_versions_without_resource_only_need_their_activity(self):
+        user = factories.Sysadmin()
+        resource = factories.Resource()
+        version = resource_version_create(
+            get_context(user), {'resource_id': resource['id'], 'name': '1'})
+        missing_activity_id = str(uuid.uuid4())
+        for name, activity_id in (('legacy', version['activity_id']),
+                                  ('missing', missing_activity_id)):
+            model.Session.add(Version(
+                package_id=resource['package_id'],
+                resource_id=None,
+                activity_id=activity_id,
+                name=name,
+                creator_user_id=user['id']))
+        model.Session.commit()
+
+        checked, broken = self._verify()
+
+        assert checked == 3
+        assert [(row['activity_id'], row['problem']) for row in broken] == \
+            [(missing_activity_id, ACTIVITY_NOT_FOUND)]
+
+    def test_batches_do_not_split_activities(self):
+        user = factories.Sysadmin()
+        context = get_context(user)
+        resource = factories.Resource()
+        # Nothing changes between versions, so they share the same activity
+        for name in ('1', '2', '3'):
+            resource_version_create(
+                context, {'resource_id': resource['id'], 'name': name})
+
+        batches = list(iter_version_batches(1))
+
+        assert [len(batch) for batch in batches] == [3]
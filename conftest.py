@@ -3,3 +3,12 @@
 pytest_plugins = [
     u'ckanext.versions.tests.fixtures',
 ]
+
+
+def pytest_ignore_collect(path, config):
+    # The fixtures of the benchmarks fill the test database with whole
+    # portals, even when the benchmarks themselves are skipped, so they are
+    # only collected by make benchmark
+    if path.basename == u'benchmarks' and \
+            not config.getoption(u'benchmark_only', False):
+        return True